@@ -0,0 +1,17 @@
+""" Benchmark suite of the simulation hot paths and paper workloads.
+
+Benchmarks are written in the style of asv: classes in the bench_* modules
+with optional `params`/`param_names`, a `setup` method, `time_*` methods
+that are timed, and `check_*` methods returning a dict of np.array that is
+compared against reference values stored in benchmarks/reference, so that a
+speedup that changes results is caught. The tolerance of checks is the
+class attribute `rtol` (relative to the largest reference value).
+
+Executed from the `python/` folder:
+
+    python -m benchmarks                      # time and check everything
+    python -m benchmarks -k Sidarthe         # benchmarks matching a pattern
+    python -m benchmarks --check-only        # accuracy checks only
+    python -m benchmarks --json bench.json   # also write timings as JSON
+    python -m benchmarks --update-references # store current results as reference
+"""
@@ -0,0 +1,135 @@
+""" Runs the benchmark suite, see benchmarks/__init__.py. """
+import argparse
+import importlib
+import inspect
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+MODULES = ['bench_micro', 'bench_macro']
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reference')
+
+
+def cases(pattern=None):
+    """ Yields (module, class, params) of all parametrized benchmarks. """
+    for name in MODULES:
+        module = importlib.import_module('benchmarks.' + name)
+        for _, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ != module.__name__:
+                continue
+            params = getattr(cls, 'params', None)
+            if params is None:
+                combinations = [()]
+            elif isinstance(params, tuple):
+                combinations = list(itertools.product(*params))
+            else:
+                combinations = [(p, ) for p in params]
+            for p in combinations:
+                if pattern is None or pattern in '{}.{}{}'.format(name, cls.__name__, p):
+                    yield name, cls, p
+
+
+def label(cls, method, params):
+    return '{}.{}({})'.format(cls.__name__, method, ', '.join(map(str, params)))
+
+
+def timeit(fn, repeat, min_time=0.05):
+    """ Best and median time per call of fn over repeat samples of at least
+    min_time seconds each. """
+    number = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(number):
+            fn()
+        t = time.perf_counter() - t
+        if t >= min_time or number >= 2**20:
+            break
+        number *= max(2, int(min_time / max(t, 1e-9)))
+    samples = [t / number]
+    for _ in range(repeat - 1):
+        t = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - t) / number)
+    return min(samples), float(np.median(samples))
+
+
+def check(result, reference, rtol):
+    """ Returns the largest deviation from the reference relative to the
+    largest reference value per key, and whether all keys are within rtol. """
+    errors = {}
+    for k, v in result.items():
+        if k not in reference or np.shape(reference[k]) != np.shape(v):
+            errors[k] = np.inf
+            continue
+        scale = max(np.max(np.abs(reference[k])), 1e-300)
+        errors[k] = float(np.max(np.abs(np.asarray(v, dtype=np.float64) - reference[k])) / scale) if np.size(v) else 0.
+    return errors, all(e <= rtol for e in errors.values())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-k', dest='pattern', help='run benchmarks whose name contains pattern')
+    parser.add_argument('--repeat', type=int, default=3, help='timing samples per benchmark')
+    parser.add_argument('--check-only', action='store_true', help='only run accuracy checks')
+    parser.add_argument('--update-references', action='store_true', help='store results as references')
+    parser.add_argument('--json', help='write timings and check results to this file')
+    args = parser.parse_args(argv)
+
+    references = {}
+    for name in MODULES:
+        filename = os.path.join(REFERENCE, name + '.npz')
+        if os.path.exists(filename):
+            with np.load(filename) as f:
+                references[name] = {k: f[k] for k in f.files}
+        else:
+            references[name] = {}
+
+    results, failed = [], []
+    for module, cls, params in cases(args.pattern):
+        bench = cls()
+        if hasattr(bench, 'setup'):
+            bench.setup(*params)
+        rtol = getattr(cls, 'rtol', 1e-9)
+        for method, fn in inspect.getmembers(bench, inspect.ismethod):
+            if method.startswith('check_'):
+                result = fn(*params)
+                key = label(cls, method, params)
+                if args.update_references:
+                    for k, v in result.items():
+                        references[module]['{}/{}'.format(key, k)] = np.asarray(v)
+                    continue
+                reference = {k.split('/', 1)[1]: v for k, v in references[module].items()
+                             if k.split('/', 1)[0] == key}
+                errors, ok = check(result, reference, rtol)
+                if not ok:
+                    failed.append(key)
+                results.append({'name': key, 'errors': errors, 'ok': ok})
+                print('{:<60} {} max rel. error {:.2e}'.format(
+                    key, 'ok  ' if ok else 'FAIL', max(errors.values(), default=0.)), flush=True)
+            elif method.startswith('time_') and not args.check_only and not args.update_references:
+                best, median = timeit(lambda: fn(*params), args.repeat)
+                key = label(cls, method, params)
+                results.append({'name': key, 'best': best, 'median': median})
+                print('{:<60} {:>12.3f} ms (median {:.3f} ms)'.format(key, best*1e3, median*1e3), flush=True)
+
+    if args.update_references:
+        os.makedirs(REFERENCE, exist_ok=True)
+        for name, arrays in references.items():
+            if arrays:
+                np.savez_compressed(os.path.join(REFERENCE, name + '.npz'), **arrays)
+        print('references written to', REFERENCE)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        print('{} accuracy checks failed'.format(len(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
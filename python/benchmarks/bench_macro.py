@@ -0,0 +1,94 @@
+""" Macro-benchmarks: scaled-down notebook workloads. """
+import numpy as np
+
+import clds
+import clds.fused
+
+from . import workloads
+
+
+class QuarantineEffectiveness:
+    """ Notebook 01 (Figure 8). """
+    rtol = 1e-6
+
+    def time_fpsp(self):
+        workloads.quarantine_effectiveness()
+
+    def check_fpsp(self):
+        return workloads.quarantine_effectiveness()
+
+    def time_outer_loop(self):
+        workloads.outer_loop()
+
+    def check_outer_loop(self):
+        return workloads.outer_loop()
+
+
+class CompensatoryBehavior:
+    """ Notebook 02 (Figure 9). """
+    rtol = 1e-6
+
+    def time_fpsp(self):
+        workloads.compensatory_behavior()
+
+    def check_fpsp(self):
+        return workloads.compensatory_behavior()
+
+    def time_outer_loop(self):
+        workloads.outer_loop(batch_size=20, compensation=np.arange(20)*0.2)
+
+    def check_outer_loop(self):
+        return workloads.outer_loop(batch_size=20, compensation=np.arange(20)*0.2)
+
+
+class ParameterUncertainty:
+    """ Notebook 03 (Figure 10). """
+    params = ['lockdown', 'fpsp']
+    param_names = ['policy']
+    rtol = 1e-6
+
+    def time_ensemble(self, policy):
+        workloads.parameter_uncertainty(policy=policy)
+
+    def check_ensemble(self, policy):
+        return workloads.parameter_uncertainty(policy=policy)
+
+
+class SEIRGamma:
+    """ Notebook 99 (SEIR with Gamma distributed delays). """
+    params = ['serial', 'batch', 'erlang']
+    param_names = ['model']
+    rtol = 1e-6
+
+    def time_closed_loop(self, model):
+        workloads.seir_gamma(model=model)
+
+    def check_closed_loop(self, model):
+        return workloads.seir_gamma(model=model)
+
+
+class FusedOuterLoop:
+    """ FPSP + SIDARTHE with outer loop as one fused kernel ('auto' uses numba
+    if installed) vs the Composite of batch agents. """
+    params = ['numpy', 'auto']
+    param_names = ['backend']
+    rtol = 1e-6
+
+    def setup(self, backend):
+        self.kwargs = dict(batch_size=11,
+                           lockdown_effectiveness=np.array([0.175 + 0.04*i for i in range(11)]),
+                           outer_loop=dict(period=14, x_init=0, x_max=14, alpha_x=0.4, alpha_y=0.),
+                           step_size=0.01,
+                           integrator='euler',
+                           peak_start=workloads.SWITCHING_START,
+                           backend=backend)
+        # compile outside of the timings
+        clds.fused.simulate(1, **self.kwargs)
+
+    def time_simulate(self, backend):
+        clds.fused.simulate(350, **self.kwargs)
+
+    def check_simulate(self, backend):
+        out = clds.fused.simulate(350, **self.kwargs)
+        return {'infected': workloads.infected(out['model']), 'duty_cycle': out['duty_cycle'],
+                'peak': out['peak']['max']}
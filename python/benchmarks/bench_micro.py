@@ -0,0 +1,129 @@
+""" Micro-benchmarks of the simulation hot paths. """
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+import clds
+
+from . import workloads
+
+
+def sample(x, n=100):
+    """ About n batch members of x, to keep reference files small. """
+    return x[::max(1, x.shape[0] // n)]
+
+
+class SidartheOde:
+    """ Time derivative of the SIDARTHE state vs batch size. """
+    params = [1, 100, 10000]
+    param_names = ['batch_size']
+
+    def setup(self, batch_size):
+        rng = np.random.RandomState(0)
+        self.model = workloads.sidarthe(batch_size, 0.1, alpha=0.57, beta=0.011, gamma=0.456, delta=0.011)
+        self.model.reset()
+        self.X = self.model.state * rng.uniform(0.5, 1.5, size=self.model.state.shape)
+        self.args = (0.57, 0.011, 0.456, 0.011)
+        self.XT = np.ascontiguousarray(self.X.T)
+        self.out = np.empty(self.XT.shape)
+
+    def time_ode(self, batch_size):
+        self.model._f(self.X, *self.args)
+
+    def time_ode_inplace(self, batch_size):
+        self.model._ode_inplace(self.XT, self.out, *self.args)
+
+    def check_ode(self, batch_size):
+        dX = self.model._f(self.X, *self.args)
+        dX_inplace = self.model._ode_inplace(self.XT, self.out, *self.args).T
+        return {'dX': sample(dX), 'dX_inplace': sample(dX_inplace)}
+
+
+class SidartheStep:
+    """ One simulated day of BatchSIDARTHE vs batch size, step size and
+    integrator. """
+    params = ([1, 1000, 10000], [0.1, 0.01], ['euler', 'rk4'])
+    param_names = ['batch_size', 'step_size', 'integrator']
+
+    def setup(self, batch_size, step_size, integrator):
+        self.model = workloads.sidarthe(batch_size, step_size, alpha=0.57, beta=0.011, gamma=0.456,
+                                        delta=0.011, integrator=integrator)
+        self.model.reset()
+
+    def time_step(self, batch_size, step_size, integrator):
+        self.model.step()
+
+    def check_step(self, batch_size, step_size, integrator):
+        self.model.reset()
+        for _ in range(30):
+            self.model.step()
+        return {'state': sample(self.model.state)}
+
+
+class SerialSEIRSubstep:
+    """ Substeps of SerialSEIR vs length of the delay kernels. """
+    params = [100, 1000, 10000]
+    param_names = ['kernel_length']
+
+    def setup(self, kernel_length):
+        t = np.arange(kernel_length)
+        kernel = np.exp(-((t - kernel_length/2) / (kernel_length/8))**2)
+        self.model = clds.agents.SerialSEIR(kernel/kernel.sum(), kernel/kernel.sum(), R0=2.78, dt=0.01)
+        self.model.reset()
+
+    def time_substep(self, kernel_length):
+        for _ in range(100):
+            self.model._substep(2.78)
+
+    def check_substep(self, kernel_length):
+        self.model.reset()
+        for _ in range(2*kernel_length):
+            self.model._substep(2.78)
+        return {'state': self.model.s}
+
+
+class CompositeStep:
+    """ Overhead of Composite.step with cheap agents vs number of agents. """
+    params = ([2, 8], ['concurrent', 'sequential'])
+    param_names = ['n_agents', 'order']
+
+    def setup(self, n_agents, order):
+        self.env = clds.Composite(order=order)
+        self.env.add(clds.Lambda(reset_fn=lambda: np.zeros(100), step_fn=lambda x: x['x0'] + 1), out='x0')
+        for i in range(1, n_agents):
+            self.env.add(clds.Lambda(reset_fn=lambda: np.zeros(100), step_fn=lambda x: x['a'] + 1),
+                         out='x{}'.format(i),
+                         pre=lambda x, i=i: {'a': x['x{}'.format(i-1)]*0.5})
+        self.env.reset()
+
+    def time_step(self, n_agents, order):
+        self.env.step()
+
+    def check_step(self, n_agents, order):
+        out = self.env.run(10)
+        return {k: v for k, v in out.items()}
+
+
+class Startup:
+    """ Time to start a fresh interpreter and import clds (as a sweep worker
+    or CLI call does), vs importing numpy only. """
+    # optional dependencies that `import clds` must not pull in
+    heavy_modules = ['gym', 'numpy.matlib', 'scipy', 'pandas', 'numba']
+
+    def _python(self, code):
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.run([sys.executable, '-c', code], cwd=cwd, check=True,
+                              stdout=subprocess.PIPE).stdout
+
+    def time_import_numpy(self):
+        self._python('import numpy')
+
+    def time_import_clds(self):
+        self._python('import clds')
+
+    def check_import_clds(self):
+        loaded = self._python('import sys, clds; print(*[m in sys.modules for m in {}])'.format(
+            self.heavy_modules))
+        return {'heavy_modules_loaded': np.array([x == b'True' for x in loaded.split()])}
@@ -0,0 +1,214 @@
+""" Scaled-down versions of the notebook simulations.
+
+Each workload builds its composite as in the corresponding notebook, with
+smaller batches and longer ODE substeps, and returns a dict of np.array
+compared against stored reference values by the macro-benchmarks.
+"""
+import math
+
+import numpy as np
+
+import clds
+
+N = 1e7
+SUPPRESSION_START = 20
+SWITCHING_START = 50
+ALPHA, BETA, GAMMA, DELTA = 0.570, 0.011, 0.456, 0.011
+
+
+def sidarthe(batch_size, step_size, alpha='a', beta='b', gamma='g', delta='d', **kwargs):
+    return clds.agents.BatchSIDARTHE(s0=clds.agents.sidarthe.initial_state(N),
+                                     alpha=alpha,
+                                     beta=beta,
+                                     gamma=gamma,
+                                     delta=delta,
+                                     N=N,
+                                     batch_size=batch_size,
+                                     step_size=step_size,
+                                     **kwargs)
+
+
+def contagion(channel, alpha=ALPHA, beta=BETA, gamma=GAMMA, delta=DELTA):
+    """ pre transform of the notebooks, modulating contagion rates by a policy. """
+    return lambda x: {'a': x[channel]*alpha,
+                      'b': x[channel]*beta,
+                      'g': x[channel]*gamma,
+                      'd': x[channel]*delta}
+
+
+def infected(s):
+    """ I+D+A+R+T of (T, batch, 8) trajectories. """
+    return np.sum(s[..., 1:6], axis=-1)
+
+
+def quarantine_effectiveness(n_steps=350, step_size=0.01, batch_size=6):
+    """ Notebook 01: FPSP-(1, 6) for several lockdown effectiveness values. """
+    lockdown_effectiveness = np.array([0.175 + 0.04*i for i in range(batch_size)])
+    model = sidarthe(batch_size, step_size)
+    fpsp = clds.agents.BatchFPSP(beta_high=1,
+                                 beta_low=0.175,
+                                 steps_high=1,
+                                 steps_low=6,
+                                 suppression_start=SUPPRESSION_START,
+                                 switching_start=SWITCHING_START,
+                                 batch_size=batch_size)
+    env = clds.Composite()
+    env.add(model, pre=contagion('fpsp'), out='model')
+    env.add(fpsp, out='fpsp')
+
+    def callback(i):
+        if i >= SWITCHING_START:
+            fpsp.beta_low = lockdown_effectiveness
+
+    out = env.run(n_steps, record=['model'], callback=callback)
+    return {'infected': infected(out['model'])}
+
+
+def outer_loop(n_steps=350, step_size=0.01, batch_size=11, compensation=None):
+    """ Notebooks 01 and 02: FPSP with supervisory outer loop (T=14), for
+    several lockdown effectiveness values or, if given, compensation values. """
+    model = sidarthe(batch_size, step_size)
+    u = clds.Lambda(reset_fn=lambda: 0, step_fn=lambda x: x['model'][:,2] + x['model'][:,4])
+    ol = clds.agents.BatchOuterLoopFPSP(start=SWITCHING_START,
+                                        o='o',
+                                        period=14,
+                                        x_init=0,
+                                        x_max=14,
+                                        alpha_x=0.4,
+                                        alpha_y=0.,
+                                        batch_size=batch_size)
+    fpsp = clds.agents.BatchFPSP(beta_high=1,
+                                 beta_low=0.175,
+                                 steps_high='x',
+                                 steps_low='y',
+                                 suppression_start=SUPPRESSION_START,
+                                 switching_start=SWITCHING_START,
+                                 batch_size=batch_size)
+    env = clds.Composite(order='sequential')
+    env.add(model, pre=contagion('fpsp'), out='model')
+    env.add(u, out='o')
+    env.add(ol, out='ol')
+    env.add(fpsp, out='fpsp', pre=lambda x: {'x': x['ol'][:,0], 'y': x['ol'][:,1]})
+
+    if compensation is None:
+        lockdown_effectiveness = np.array([0.175 + 0.04*i for i in range(batch_size)])
+        def callback(i):
+            if i >= SWITCHING_START:
+                fpsp.beta_low = lockdown_effectiveness
+    else:
+        def callback(i):
+            if i > SUPPRESSION_START:
+                fpsp.beta_high = 1 + compensation
+
+    out = env.run(n_steps, record=['model', 'ol'], callback=callback)
+    return {'infected': infected(out['model']), 'duty_cycle': out['ol'][..., 0]}
+
+
+def compensatory_behavior(n_steps=350, step_size=0.01, batch_size=20):
+    """ Notebook 02: FPSP-(1, 6) for several compensation values. """
+    compensation = np.array([0.1*i for i in range(batch_size)])
+    model = sidarthe(batch_size, step_size)
+    fpsp = clds.agents.BatchFPSP(beta_high=1,
+                                 beta_low=0.175,
+                                 steps_high=1,
+                                 steps_low=6,
+                                 suppression_start=SUPPRESSION_START,
+                                 switching_start=SWITCHING_START,
+                                 batch_size=batch_size)
+    env = clds.Composite()
+    env.add(model, pre=contagion('fpsp'), out='model')
+    env.add(fpsp, out='fpsp')
+
+    def callback(i):
+        if i > SUPPRESSION_START:
+            fpsp.beta_high = 1 + compensation
+
+    out = env.run(n_steps, record=['model'], callback=callback)
+    return {'infected': infected(out['model'])}
+
+
+def prior_samples(n_samples, seed=0, sd=0.1):
+    """ Parameters perturbed by truncated normal noise as in notebook 03,
+    drawn by rejection with a fixed seed. """
+    rng = np.random.RandomState(seed)
+    defaults = {'alpha': ALPHA, 'beta': BETA, 'gamma': GAMMA, 'delta': DELTA,
+                'epsilon': 0.171, 'theta': 0.371, 'zeta': 0.125, 'eta': 0.125,
+                'mu': 0.012, 'nu': 0.027, 'tau': 0.003, 'h': 0.034, 'rho': 0.034,
+                'kappa': 0.017, 'xi': 0.017, 'sigma': 0.017}
+    samples = {}
+    for k, v in defaults.items():
+        x = rng.normal(v, v*sd, size=n_samples)
+        while (x < 0).any():
+            x[x < 0] = rng.normal(v, v*sd, size=(x < 0).sum())
+        samples[k] = x
+    return samples
+
+
+def parameter_uncertainty(n_steps=350, step_size=0.01, batch_size=200, policy='lockdown'):
+    """ Notebook 03: quantiles of infected over an ensemble of perturbed
+    parameters, under prolonged lockdown or FPSP-(4, 10). """
+    samples = prior_samples(batch_size)
+    rates = {k: samples[k] for k in ['epsilon', 'theta', 'zeta', 'eta', 'mu', 'nu',
+                                     'tau', 'h', 'rho', 'kappa', 'xi', 'sigma']}
+    model = sidarthe(batch_size, step_size, **rates)
+    if policy == 'lockdown':
+        agent = clds.agents.BatchLockdown(beta_high=1.,
+                                          beta_low=0.175,
+                                          suppression_start=SUPPRESSION_START,
+                                          batch_size=1)
+    else:
+        agent = clds.agents.BatchFPSP(beta_high=1,
+                                      beta_low=0.175,
+                                      steps_high=4,
+                                      steps_low=10,
+                                      suppression_start=SUPPRESSION_START,
+                                      switching_start=SWITCHING_START,
+                                      batch_size=batch_size)
+    env = clds.Composite()
+    env.add(model, pre=contagion('policy', samples['alpha'], samples['beta'],
+                                 samples['gamma'], samples['delta']), out='model')
+    env.add(agent, out='policy')
+    out = env.run(n_steps, reducers={
+        'quantiles': clds.reducers.Quantiles(('model', slice(1, 6)), q=[0.5, 0.75, 0.95])})
+    return {'quantiles': out['quantiles']}
+
+
+def gamma_kernel(a, b, dt):
+    """ Gamma(a, scale=b) pdf at k*dt on 5 times its mean, normalized. """
+    t = np.linspace(0, a*b*5, num=int(a*b*5/dt)+1)
+    with np.errstate(divide='ignore'):
+        log_pdf = (a-1)*np.log(t) - t/b - math.lgamma(a) - a*math.log(b)
+    y = np.exp(log_pdf)
+    return y/y.sum()
+
+
+def seir_gamma(n_days=365, dt=0.05, model='serial'):
+    """ Notebook 99: SEIR with Gamma distributed delays under open-loop and
+    outer-loop controlled FPSP. """
+    R0, q = 2.78, 0.175
+    ei = gamma_kernel(12./0.1, 0.1, dt)
+    ir = gamma_kernel(2./0.99, 0.99, dt)
+    lockdown, switching = 30, 50
+    seir = {'serial': clds.agents.SerialSEIR,
+            'batch': clds.agents.BatchSEIR,
+            'erlang': clds.agents.BatchErlangSEIR}[model]
+
+    env = clds.Composite(order='sequential')
+    fpsp_cl = clds.agents.BatchFPSP(beta_high=R0, beta_low=R0*q, steps_high='x', steps_low='y',
+                                    suppression_start=lockdown, switching_start=switching)
+    env.add(fpsp_cl, out='fpsp_cl', pre=lambda x: {'x': x['outer'][:,0], 'y': x['outer'][:,1]})
+    fpsp_ol = clds.agents.BatchFPSP(beta_high=R0, beta_low=R0*q, steps_high=2, steps_low=12,
+                                    suppression_start=lockdown, switching_start=switching)
+    env.add(fpsp_ol, out='fpsp_ol')
+    if model == 'serial':
+        # SerialSEIR simulates a single scalar state
+        R0_ol, R0_cl = (lambda x: x['fpsp_ol'][0]), (lambda x: x['fpsp_cl'][0])
+    else:
+        R0_ol, R0_cl = 'fpsp_ol', 'fpsp_cl'
+    env.add(seir(ei, ir, N=N, i0=500/6, e0=0, R0=R0_ol, dt=dt), out='model_ol')
+    env.add(seir(ei, ir, N=N, i0=500/6, e0=0, R0=R0_cl, dt=dt), out='model_cl')
+    env.add(clds.Lambda(reset_fn=lambda: 0, step_fn=lambda x: np.reshape(x['model_cl'], -1)[2]), out='o')
+    env.add(clds.agents.BatchOuterLoopFPSP(start=switching, o='o', period=14, x_init=0, x_max=14,
+                                           alpha_x=0.4, alpha_y=0.), out='outer')
+    out = env.run(n_days, record=['model_ol', 'model_cl'])
+    return {k: np.reshape(v, (v.shape[0], -1)) for k, v in out.items()}
@@ -1,3 +1,3 @@
 from .core import *
 from . import agents
-
+from . import reducers
@@ -1,4 +1,4 @@
 from .fast_periodic_switching_policy import FPSP, BatchFPSP, BatchOuterLoopFPSP
 from .lockdown_policy import BatchLockdown
-from .seir import SerialSEIR
+from .seir import SerialSEIR, BatchSEIR, BatchErlangSEIR
 from .sidarthe import BatchSIDARTHE
\ No newline at end of file
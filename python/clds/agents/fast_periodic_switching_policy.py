@@ -1,5 +1,4 @@
 import numpy as np
-import numpy.matlib
 
 from ..core import Agent
 
@@ -14,6 +13,8 @@ class FPSP(Agent):
         [switching_start, ..., END]: beta_high for steps_high followed by beta_low for steps_low steps.
     
     """
+    state_attributes = ('steps', )
+    
     def __init__(self, steps_high, steps_low, beta_high=1, beta_low=0, suppression_start=0, switching_start=0):
         self.beta_high = beta_high
         self.beta_low = beta_low
@@ -63,11 +64,20 @@ class BatchFPSP(Agent):
         [suppression_start, ..., switching_start): beta_low
         [switching_start, ..., END]: beta_high for steps_high followed by beta_low for steps_low steps.
     
+    All parameters may be given per batch member as np.array of shape 
+    (batch, ), e.g. to sweep suppression_start and switching_start in one 
+    batch. steps_high and steps_low may also be placeholder keys or callables.
+    
+    If dtype is given (e.g. np.float32 together with BatchSIDARTHE(dtype=np.float32)),
+    beta is returned in dtype, otherwise in the dtype of beta_high and beta_low.
     """
-    def __init__(self, beta_high=1, beta_low=0, steps_high=1, steps_low=1, batch_size=1, suppression_start=0, switching_start=0):
+    state_attributes = ('steps', 'cycle_length')
+    
+    def __init__(self, beta_high=1, beta_low=0, steps_high=1, steps_low=1, batch_size=1, suppression_start=0, switching_start=0, dtype=None):
         self.batch_size = batch_size
-        self.beta_high = self._to_batch(beta_high)
-        self.beta_low = self._to_batch(beta_low)
+        self.dtype = dtype
+        self.beta_high = self._cast(self._to_batch(beta_high))
+        self.beta_low = self._cast(self._to_batch(beta_low))
         self.steps_high = steps_high
         self.steps_low = steps_low
         self.suppression_start = suppression_start
@@ -85,17 +95,22 @@ class BatchFPSP(Agent):
         if x_arr.shape == target_shape:
             return x_arr
         elif (x_arr.shape == shape):
-            return np.matlib.repmat(x_arr.reshape(shape), self.batch_size,1).reshape(target_shape)
+            return np.broadcast_to(x_arr, target_shape).copy()
         elif len(x_arr.shape) > 0 and x_arr.shape[0] == target_shape:
             return x_arr.reshape(target_shape)
         else:
             print("Warning: unable to convert to target shape", x, target_shape)
             return x
+
+    def _cast(self, x):
+        if self.dtype is None or isinstance(x, str) or callable(x):
+            return x
+        return np.asarray(x, dtype=self.dtype)
         
     def reset(self):
         self.steps = 1
         self.cycle_length = None
-        return self.beta_high
+        return self._cast(self.beta_high)
         
     def step(self, x):
         steps_high = self._to_batch(self._get_input(self.steps_high, x))
@@ -118,13 +133,25 @@ class BatchFPSP(Agent):
         out = is_phase_1 * self.beta_high + \
               is_phase_2 * self.beta_low + \
               is_phase_3 * (is_high_cycle * self.beta_high + (1-is_high_cycle) * self.beta_low)
-        return out
+        return self._cast(out)
 		
 class BatchOuterLoopFPSP(Agent):
     """ 
     FPSP Outer supervisory loop - batch version.
     
+    Every period steps from start on, the duty cycle x is increased by one if
+    the observations o accumulated over the period decreased by more than 
+    alpha_x relative to the preceding period, decreased by one if they
+    increased by more than alpha_y, and kept within [x_min, x_max]. All 
+    parameters may be given per batch member as np.array of shape (batch, ), 
+    e.g. to sweep hysteresis and supervisory period in one batch.
+    
+    If dtype is given, the accumulated observations and the returned duty
+    cycles are kept in dtype.
     """
+    state_attributes = ('steps', 'x', 'o_k1', 'o_k')
+    batch_attributes = ('x', 'o_k1', 'o_k')
+    
     def __init__(self, 
                  start=0, 
                  period=7, 
@@ -134,7 +161,8 @@ class BatchOuterLoopFPSP(Agent):
                  x_max=7, 
                  alpha_x=0.4, 
                  alpha_y=0.0, 
-                 batch_size=1):
+                 batch_size=1,
+                 dtype=None):
         
         self.start = start
         self.period = period
@@ -144,6 +172,7 @@ class BatchOuterLoopFPSP(Agent):
         self.alpha_x = alpha_x
         self.alpha_y = alpha_y
         self.batch_size = batch_size
+        self.dtype = dtype
         
         self.o = o # control signal
         
@@ -159,22 +188,27 @@ class BatchOuterLoopFPSP(Agent):
         if x_arr.shape == target_shape:
             return x_arr
         elif (x_arr.shape == shape):
-            return np.matlib.repmat(x_arr.reshape(shape), self.batch_size,1).reshape(target_shape)
+            return np.broadcast_to(x_arr, target_shape).copy()
         elif len(x_arr.shape) > 0 and x_arr.shape[0] == target_shape:
             return x_arr.reshape(target_shape)
         else:
             print("Warning: unable to convert to target shape", x, target_shape)
             return x
+
+    def _cast(self, x):
+        if self.dtype is None:
+            return x
+        return np.asarray(x, dtype=self.dtype)
         
     def reset(self):
         self.steps = 0
         self.x = self._to_batch(self.x_init)
-        self.o_k1 = np.zeros(self.batch_size)
-        self.o_k = np.zeros(self.batch_size)
-        return np.vstack([self.x, self.period-self.x]).T
+        self.o_k1 = np.zeros(self.batch_size, dtype=self.dtype)
+        self.o_k = np.zeros(self.batch_size, dtype=self.dtype)
+        return self._cast(np.vstack([self.x, self.period-self.x]).T)
     
     def step(self, x=None):
-        o = self._to_batch(self._get_input(self.o, x)) # fetch observed signal
+        o = self._cast(self._to_batch(self._get_input(self.o, x))) # fetch observed signal
         self.o_k += o
 
         do_update_buffer = (np.mod(self.steps-self.start, self.period) == 0)
@@ -194,7 +228,7 @@ class BatchOuterLoopFPSP(Agent):
         self.o_k = (1-do_update_buffer) * self.o_k
                 
         self.steps += 1
-        out = np.vstack([self.x, self.x_max-self.x]).T
+        out = self._cast(np.vstack([self.x, self.x_max-self.x]).T)
         return out, 0, False, None
                 
     
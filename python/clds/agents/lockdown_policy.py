@@ -9,11 +9,19 @@ class BatchLockdown(Agent):
         [0, ... suppression start]: beta_high
         [suppression_start, ..., suppression_end): beta_low
         [suppression_end, ..., END]: beta_high
+
+    beta_high, beta_low, suppression_start and suppression_end may be given
+    per batch member as np.array of shape (batch, ), e.g. to sweep the
+    timing of lockdowns in one batch. If dtype is given, beta is returned in 
+    dtype.
     """
-    def __init__(self, beta_high=1, beta_low=0, batch_size=1, suppression_start=0, suppression_end=None):
+    state_attributes = ('steps', )
+    
+    def __init__(self, beta_high=1, beta_low=0, batch_size=1, suppression_start=0, suppression_end=None, dtype=None):
         self.batch_size = batch_size
-        self.beta_high = self._to_batch(beta_high)
-        self.beta_low = self._to_batch(beta_low)
+        self.dtype = dtype
+        self.beta_high = self._cast(self._to_batch(beta_high))
+        self.beta_low = self._cast(self._to_batch(beta_low))
         self.suppression_start = suppression_start
         self.suppression_end = suppression_end
         
@@ -29,22 +37,26 @@ class BatchLockdown(Agent):
         if x_arr.shape == target_shape:
             return x_arr
         elif (x_arr.shape == shape):
-            return np.matlib.repmat(x_arr.reshape(shape), self.batch_size,1).reshape(target_shape)
+            return np.broadcast_to(x_arr, target_shape).copy()
         elif len(x_arr.shape) > 0 and x_arr.shape[0] == target_shape:
             return x_arr.reshape(target_shape)
         else:
             print("Warning: unable to convert to target shape", x, target_shape)
             return x
+
+    def _cast(self, x):
+        if self.dtype is None or isinstance(x, str) or callable(x):
+            return x
+        return np.asarray(x, dtype=self.dtype)
         
     def reset(self):
         self.steps = 1
-        return self.beta_high
+        return self._cast(self.beta_high)
         
     def step(self, x):
-        y = self.beta_high
-        if (self.steps >= self.suppression_start):
-            y = self.beta_low
-        if (self.suppression_end is not None) and (self.steps >= self.suppression_end):
-            y = self.beta_high
+        is_lockdown = self.steps >= self.suppression_start
+        if self.suppression_end is not None:
+            is_lockdown = is_lockdown & (self.steps < self.suppression_end)
+        y = np.where(is_lockdown, self.beta_low, self.beta_high)
         self.steps += 1
-        return y, 0, False, None
\ No newline at end of file
+        return self._cast(y), 0, False, None
\ No newline at end of file
@@ -3,6 +3,8 @@ import numpy as np
 from ..core import Agent
 
 class SerialSEIR(Agent):
+    state_attributes = ('s', 'substep', 'n_contacts', 'e2i', 'i2r')
+    
     def __init__(self, 
                  ei, 
                  ir, 
@@ -10,22 +12,25 @@ class SerialSEIR(Agent):
                  e0=0,
                  i0=500/6,
                  R0=2.78,
-                 max_steps=1000,
+                 max_steps=None,
                  dt=1):
         """
         SEIR agent with arbitrarily distributed transition delays between E->I and I->R.
         
         Args
         ----
-		ei (np.array): distribution of delays with which E transitions to I, discretized at k*dt, where 0 <= k <= max_steps/dt
-		ir (np.array): distribution of delays with which I transitions to R, discretized at k*dt, where 0 <= k <= max_steps/dt
+		ei (np.array): distribution of delays with which E transitions to I, discretized at k*dt.
+		ir (np.array): distribution of delays with which I transitions to R, discretized at k*dt.
 		N (float): population size.
 		e0 (float): initial number of exposed.
 		i0 (float): initial number of infectious.
 		R0 (float): average number of individuals infected per infectious.
-		max_steps (int): maximum number of simulation steps.
+		max_steps (int): unused, the number of simulation steps is not limited. 
 		dt (float): length of substep. In each step, 1/dt substeps of (internal) simulation are performed before latest state is returned.
 		
+        Scheduled contacts, incubations and recoveries are kept in circular 
+        buffers covering the support of the delay distributions, so that 
+        memory does not grow with the simulation horizon.
         """
         self.ei = ei
         self.ir = ir
@@ -38,6 +43,9 @@ class SerialSEIR(Agent):
         
         survival_ir = (1-np.cumsum(self.ir))
         self.psi = survival_ir/survival_ir.sum() # distribution of infectious contact delay after becoming infectious
+        # circular buffer length: schedules reach up to support-1 substeps ahead, 
+        # the contacts of the preceding substep are still live.
+        self.buffer_size = max(self.psi.shape[0], self.ir.shape[0], self.ei.shape[0] + 1) + 1
     
     def reset(self):
         
@@ -50,21 +58,18 @@ class SerialSEIR(Agent):
         self.substep = 0
         
         # init pre-scheduled contacts, incubations and recoveries
-        self.n_contacts = np.zeros(shape=int(self.max_steps/self.dt + self.psi.shape[0])+1)
-        self.e2i = np.zeros(shape=int(self.max_steps/self.dt + self.ei.shape[0])+1)
-        self.i2r = np.zeros(shape=int(self.max_steps/self.dt + self.ir.shape[0])+1)
+        self.n_contacts = np.zeros(shape=self.buffer_size)
+        self.e2i = np.zeros(shape=self.buffer_size)
+        self.i2r = np.zeros(shape=self.buffer_size)
         # pre-populate transition schedules
         s, e, i, r = self.s
-        self.n_contacts[0:self.psi.shape[0]] = i * self.psi # when do infectious spread from i0?
-        self.i2r[0:self.ir.shape[0]] = i * self.ir # when do i0 recover?
-        self.e2i[1:1+self.ei.shape[0]] = e * self.ei # when do e0 exposed become infectious?
+        self._schedule(self.n_contacts, 0, i * self.psi) # when do infectious spread from i0?
+        self._schedule(self.i2r, 1, i * self.ir[1:]) # when do i0 recover? (substep 0 has passed)
+        self._schedule(self.e2i, 1, e * self.ei) # when do e0 exposed become infectious?
         
         return self.s
     
     def step(self, x=None):
-        if self.substep > self.max_steps/self.dt:
-            return self.s, 0, True, none
-        
         R0 = self._get_input(self.R0, x)
         n_steps = int(1/self.dt)
         for _ in range(n_steps):
@@ -72,17 +77,28 @@ class SerialSEIR(Agent):
 
         return self.s, 0, False, None
     
+    def _schedule(self, buffer, t, values):
+        """ Adds values to the circular buffer at substeps t, t+1, ... """
+        i = t % self.buffer_size
+        n = min(values.shape[0], self.buffer_size - i)
+        buffer[i:i+n] += values[:n]
+        buffer[:values.shape[0]-n] += values[n:]
+    
     def _substep(self, R0):
         self.substep += 1
         t = self.substep
+        i_t, i_t1 = t % self.buffer_size, (t-1) % self.buffer_size
         s, e, i, r = self.s
         
-        s2e = self.n_contacts[t-1] * s/self.N * R0
-        self.e2i[t:t+self.ei.shape[0]] = self.e2i[t:t+self.ei.shape[0]] + s2e * self.ei
-        e2i = self.e2i[t]
-        self.n_contacts[t:t+self.psi.shape[0]] = self.n_contacts[t:t+self.psi.shape[0]] + e2i * self.psi # when do newyly infectious infect others?
-        self.i2r[t:t+self.ir.shape[0]] = self.i2r[t:t+self.ir.shape[0]] + e2i * self.ir # when do newly infectious recover?
-        i2r = self.i2r[t]
+        s2e = self.n_contacts[i_t1] * s/self.N * R0
+        self.n_contacts[i_t1] = 0 # free slot of preceding substep
+        self._schedule(self.e2i, t, s2e * self.ei)
+        e2i = self.e2i[i_t]
+        self._schedule(self.n_contacts, t, e2i * self.psi) # when do newyly infectious infect others?
+        self._schedule(self.i2r, t, e2i * self.ir) # when do newly infectious recover?
+        i2r = self.i2r[i_t]
+        self.e2i[i_t] = 0
+        self.i2r[i_t] = 0
         
         
         self.s = np.array([ 
@@ -90,4 +106,282 @@ class SerialSEIR(Agent):
             e + s2e - e2i,
             i + e2i - i2r,
             r + i2r
-        ])
\ No newline at end of file
+        ])
+
+
+class BatchSEIR(Agent):
+    state_attributes = ('_N', 's', 'substep', 'block_start', '_e2i', '_contacts', '_i2r', 
+                        '_s2e_block', '_e2i_block', '_last_contacts')
+    batch_attributes = ('_N', 's', '_e2i', '_contacts', '_i2r', '_s2e_block', '_e2i_block', '_last_contacts')
+    
+    def __init__(self, 
+                 ei, 
+                 ir, 
+                 N=1e7, 
+                 e0=0,
+                 i0=500/6,
+                 R0=2.78,
+                 dt=1,
+                 batch_size=1,
+                 block_size=64):
+        """
+        Batch of SEIR agents with arbitrarily distributed transition delays 
+        between E->I and I->R. Same dynamics as SerialSEIR, without limit 
+        on the number of steps.
+        
+        Transitions scheduled by the delay distributions are computed by 
+        blocked convolution: within a block of block_size substeps, new 
+        transitions contribute directly to the block, and at the end of each 
+        block their contribution to later substeps is added by FFT. The cost 
+        per substep is O(block_size + support*log(support)/block_size) 
+        instead of O(support).
+        
+        Args
+        ----
+        ei (np.array): distribution of delays with which E transitions to I, discretized at k*dt. 
+            Shape (support, ) if shared by all batch members, (batch, support) otherwise.
+        ir (np.array): distribution of delays with which I transitions to R, see ei.
+        N (float or np.array): population size.
+        e0 (float or np.array): initial number of exposed.
+        i0 (float or np.array): initial number of infectious.
+        R0 (float, np.array, str or callable): average number of individuals infected per infectious.
+        dt (float): length of substep. In each step, 1/dt substeps of (internal) simulation are performed before latest state is returned.
+        batch_size (int): number of simulations.
+        block_size (int): number of substeps per convolution block.
+        
+        """
+        self.batch_size = batch_size
+        self.N = N
+        self.e0 = e0
+        self.i0 = i0
+        self.R0 = R0
+        self.dt = dt
+        self.block_size = block_size
+        
+        ei, ir = np.asarray(ei, dtype=np.float64), np.asarray(ir, dtype=np.float64)
+        survival_ir = (1-np.cumsum(ir, axis=-1))
+        psi = survival_ir/survival_ir.sum(axis=-1, keepdims=True) # distribution of infectious contact delay after becoming infectious
+        self.support = max(ei.shape[-1], ir.shape[-1], block_size)
+        self.ei, self.ir, self.psi = [self._pad(k, self.support) for k in (ei, ir, psi)]
+        
+        # FFT length for convolving a block with a kernel
+        self.n_fft = 1 << int(np.ceil(np.log2(self.support + block_size - 1)))
+        self._ei_fft, self._ir_fft, self._psi_fft = [np.fft.rfft(k, n=self.n_fft, axis=-1) 
+                                                     for k in (self.ei, self.ir, self.psi)]
+        # leading taps, reversed, for direct convolution within a block
+        self._ei_rev, self._ir_rev, self._psi_rev = [k[..., block_size-1::-1].copy() 
+                                                     for k in (self.ei, self.ir, self.psi)]
+    
+    @staticmethod
+    def _pad(k, n):
+        pad = [(0, 0)] * (k.ndim - 1) + [(0, n - k.shape[-1])]
+        return np.pad(k, pad)
+    
+    def reset(self):
+        shape = (self.batch_size, )
+        N, e0, i0 = [np.broadcast_to(np.asarray(x, dtype=np.float64), shape) for x in (self.N, self.e0, self.i0)]
+        self._N = N
+        self.s = np.stack([N - e0 - i0, e0, i0, np.zeros(shape)], axis=1)
+        self.substep = 0
+        
+        # scheduled transitions at substeps block_start, block_start+1, ... 
+        # from transitions before the current block. 
+        B, L = self.block_size, self.support
+        self.block_start = 1
+        self._e2i = np.zeros((self.batch_size, L + B))
+        self._contacts = np.zeros((self.batch_size, L + B))
+        self._i2r = np.zeros((self.batch_size, L + B))
+        # new transitions in the current block
+        self._s2e_block = np.zeros((self.batch_size, B))
+        self._e2i_block = np.zeros((self.batch_size, B))
+        
+        # pre-populate transition schedules as SerialSEIR.reset
+        self._e2i[:, :L] = e0[:, None] * self.ei # when do e0 exposed become infectious?
+        self._contacts[:, :L-1] = i0[:, None] * self.psi[..., 1:] # when do infectious spread from i0?
+        self._i2r[:, :L-1] = i0[:, None] * self.ir[..., 1:] # when do i0 recover?
+        self._last_contacts = i0 * self.psi[..., 0]
+        
+        return np.array(self.s)
+    
+    def step(self, x=None):
+        R0 = self._get_input(self.R0, x)
+        n_steps = int(1/self.dt)
+        for _ in range(n_steps):
+            self._substep(R0)
+
+        return np.array(self.s), 0, False, None
+    
+    def _substep(self, R0):
+        self.substep += 1
+        j = self.substep - self.block_start
+        S, E, I, R = self.s.T
+        
+        s2e = self._last_contacts * S/self._N * R0
+        self._s2e_block[:, j] = s2e
+        e2i = self._e2i[:, j] + self._direct(self._s2e_block, self._ei_rev, j)
+        self._e2i_block[:, j] = e2i
+        # when do newly infectious infect others and recover?
+        self._last_contacts = self._contacts[:, j] + self._direct(self._e2i_block, self._psi_rev, j)
+        i2r = self._i2r[:, j] + self._direct(self._e2i_block, self._ir_rev, j)
+        
+        self.s = np.stack([
+            S - s2e,
+            E + s2e - e2i,
+            I + e2i - i2r,
+            R + i2r
+        ], axis=1)
+        
+        if j == self.block_size - 1:
+            self._end_block()
+    
+    def _direct(self, u, k_rev, j):
+        """ Contribution of transitions u[:, 0..j] of the current block to substep j. """
+        B = self.block_size
+        if k_rev.ndim == 1:
+            return u[:, :j+1] @ k_rev[B-1-j:]
+        return np.einsum('bi,bi->b', u[:, :j+1], k_rev[:, B-1-j:])
+    
+    def _end_block(self):
+        """ Adds the contribution of the current block to later substeps and 
+        shifts schedules to the next block. """
+        B, L = self.block_size, self.support
+        s2e_fft = np.fft.rfft(self._s2e_block, n=self.n_fft, axis=1)
+        e2i_fft = np.fft.rfft(self._e2i_block, n=self.n_fft, axis=1)
+        for schedule, u_fft, k_fft in [(self._e2i, s2e_fft, self._ei_fft), 
+                                       (self._contacts, e2i_fft, self._psi_fft), 
+                                       (self._i2r, e2i_fft, self._ir_fft)]:
+            y = np.fft.irfft(u_fft * k_fft, n=self.n_fft, axis=1)
+            # substeps within the block were computed directly
+            schedule[:, B:B+L-1] += y[:, B:B+L-1]
+            schedule[:, :L] = schedule[:, B:]
+            schedule[:, L:] = 0
+        self._s2e_block[...] = 0
+        self._e2i_block[...] = 0
+        self.block_start += B
+
+
+def fit_chain(kernel):
+    """ Fits a chain of identical geometric stages to a delay distribution.
+    
+    The delay of a chain of k stages, each left with probability p per 
+    substep, follows a negative binomial distribution, the discrete-time 
+    analogue of an Erlang distribution. k and p are chosen to match mean and 
+    variance of the kernel, the mean exactly.
+    
+    Args:
+        kernel (np.array): distribution of delays in substeps, as SerialSEIR.ei.
+        
+    Returns:
+        dict with number of stages 'stages', exit probability 'p', 'mean' and 
+        'var' of the kernel (in substeps) and the L1 distance 'l1' between the 
+        kernel and the delay distribution of the chain.
+    """
+    kernel = np.asarray(kernel, dtype=np.float64)
+    n = np.arange(kernel.shape[0])
+    mean = np.sum(n * kernel)
+    var = np.sum((n - mean)**2 * kernel)
+    stages = int(np.clip(np.round(mean**2 / (mean + var)), 1, max(1, np.floor(mean))))
+    p = min(1., stages / mean) if mean > 0 else 1.
+    
+    # negative binomial: P(n) = C(n-1, k-1) p^k (1-p)^(n-k) for n >= k
+    m = np.arange(2 * kernel.shape[0] + stages)
+    log_fact = np.concatenate([[0.], np.cumsum(np.log(np.arange(1, m.shape[0])))])
+    pmf = np.zeros(m.shape[0])
+    valid = m >= stages
+    mv = m[valid]
+    log_pmf = log_fact[mv-1] - log_fact[stages-1] - log_fact[mv-stages] + stages*np.log(p)
+    if p < 1:
+        log_pmf += (mv-stages)*np.log1p(-p)
+        pmf[valid] = np.exp(log_pmf)
+    else:
+        pmf[stages] = 1.
+    l1 = np.abs(pmf[:kernel.shape[0]] - kernel).sum() + pmf[kernel.shape[0]:].sum()
+    return {'stages': stages, 'p': float(p), 'mean': float(mean), 'var': float(var), 'l1': float(l1)}
+
+
+class BatchErlangSEIR(Agent):
+    state_attributes = ('_N', 'S', 'E', 'I', 'R')
+    batch_attributes = ('_N', 'S', 'E', 'I', 'R')
+    
+    def __init__(self, 
+                 ei, 
+                 ir, 
+                 N=1e7, 
+                 e0=0,
+                 i0=500/6,
+                 R0=2.78,
+                 dt=1,
+                 batch_size=1):
+        """
+        Batch of SEIR agents in which E and I are chains of sub-compartments 
+        (linear chain trick), as a compact alternative to the delay 
+        convolution of SerialSEIR and BatchSEIR. 
+        
+        Chain shapes are fitted to the delay distributions with fit_chain, 
+        the quality of the fit is reported in self.fit. The state of each 
+        scenario consists of 2 + stages(ei) + stages(ir) floats, independent 
+        of dt and of the support of the delay distributions.
+        
+        Args
+        ----
+        ei (np.array): distribution of delays with which E transitions to I, discretized at k*dt, e.g. from make_gamma.
+        ir (np.array): distribution of delays with which I transitions to R, discretized at k*dt.
+        N (float or np.array): population size.
+        e0 (float or np.array): initial number of exposed.
+        i0 (float or np.array): initial number of infectious.
+        R0 (float, np.array, str or callable): average number of individuals infected per infectious.
+        dt (float): length of substep. In each step, 1/dt substeps of (internal) simulation are performed before latest state is returned.
+        batch_size (int): number of simulations.
+        
+        """
+        self.batch_size = batch_size
+        self.N = N
+        self.e0 = e0
+        self.i0 = i0
+        self.R0 = R0
+        self.dt = dt
+        self.fit = {'ei': fit_chain(ei), 'ir': fit_chain(ir)}
+    
+    def reset(self):
+        shape = (self.batch_size, )
+        N, e0, i0 = [np.broadcast_to(np.asarray(x, dtype=np.float64), shape) for x in (self.N, self.e0, self.i0)]
+        self._N = N
+        self.S = N - e0 - i0
+        self.R = np.zeros(shape)
+        # initial exposed and infectious enter the first stage
+        self.E = np.zeros(shape + (self.fit['ei']['stages'], ))
+        self.I = np.zeros(shape + (self.fit['ir']['stages'], ))
+        self.E[:, 0] = e0
+        self.I[:, 0] = i0
+        return self.state
+    
+    @property
+    def state(self):
+        return np.stack([self.S, self.E.sum(axis=1), self.I.sum(axis=1), self.R], axis=1)
+    
+    def step(self, x=None):
+        R0 = self._get_input(self.R0, x)
+        n_steps = int(1/self.dt)
+        for _ in range(n_steps):
+            self._substep(R0)
+
+        return self.state, 0, False, None
+    
+    def _substep(self, R0):
+        # contacts per substep of an infectious individual: R0 / mean duration
+        s2e = self.I.sum(axis=1) * R0 / self.fit['ir']['mean'] * self.S/self._N
+        
+        out_e = self.fit['ei']['p'] * self.E
+        self.E -= out_e
+        self.E[:, 1:] += out_e[:, :-1]
+        e2i = out_e[:, -1]
+        
+        out_i = self.fit['ir']['p'] * self.I
+        self.I -= out_i
+        self.I[:, 1:] += out_i[:, :-1]
+        i2r = out_i[:, -1]
+        
+        self.E[:, 0] += s2e
+        self.I[:, 0] += e2i
+        self.S = self.S - s2e
+        self.R = self.R + i2r
@@ -1,7 +1,4 @@
-import gym
-
 import numpy as np
-import numpy.matlib
 
 from ..core import Agent
 
@@ -14,7 +11,41 @@ from ..core import Agent
 # H: (healed)
 # E: (extinct)
 
+def initial_state(N=1e7, I=500/6, D=20, A=1, R=2, T=0, H=0, E=0):
+    """ Initial state (S, I, D, A, R, T, H, E) used throughout the notebooks. """
+    S = N - I - D - A - R - T - H - E
+    return np.array([S, I, D, A, R, T, H, E])
+
 class BatchSIDARTHE(Agent):
+    
+    # contagion rates, which may be inputs, and constant rates
+    contagion_names = ['alpha', 'beta', 'gamma', 'delta']
+    rate_names = ['epsilon', 'zeta', 'eta', 'theta', 'kappa', 'h', 'mu', 'nu', 'xi', 'rho', 'sigma', 'tau']
+    
+    # dynamic state, see Agent.get_state, and that of cycle extrapolation
+    state_attributes = ('state', 'steps', 'requested_active', 'n_evals', 'h_adaptive', 'max_drift', 
+                        '_drift_warned', '_V')
+    batch_attributes = ('state', 'h_adaptive')
+    periodic_attributes = ('_history', '_next_boundary', '_ratio', '_drift', '_gap', '_jump_left', 
+                           'n_extrapolated', 'n_extrapolations')
+    
+    # integrator name -> integration method
+    integrators = {'euler': 'euler_step', 
+                   'rk4': 'rk4_step', 
+                   'rk45': 'adaptive_step'}
+    
+    # Dormand-Prince 5(4) tableau
+    _dp_c = np.array([0, 1/5, 3/10, 4/5, 8/9, 1, 1])
+    _dp_a = [[],
+             [1/5],
+             [3/40, 9/40],
+             [44/45, -56/15, 32/9],
+             [19372/6561, -25360/2187, 64448/6561, -212/729],
+             [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+             [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+    _dp_b = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0])
+    _dp_e = _dp_b - np.array([5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40])
+    
     def __init__(self,
                  s0, # initial state
                  N,
@@ -36,7 +67,19 @@ class BatchSIDARTHE(Agent):
                  sigma=0.017, # T-> H
                  tau=0.003, # T -> E
                  round_state=False, 
-                 step_size=0.01):
+                 step_size=0.01,
+                 integrator='euler',
+                 rtol=1e-6,
+                 atol=1e-3,
+                 dtype=np.float64,
+                 conservation_rtol=1e-4,
+                 on_drift='warn',
+                 sensitivities=None,
+                 input_sensitivities=None,
+                 period=None,
+                 period_start=0,
+                 period_rtol=1e-4,
+                 max_cycles=64):
         
         """Class for SIDARTHE dynamics of the environment
         https://arxiv.org/abs/2003.09861
@@ -46,74 +89,501 @@ class BatchSIDARTHE(Agent):
         
         N (int, default=10000): the total siwe of the population
         round_state(bool): round state to nearest integer after each step.
+        step_size (float): length of integration substeps (in days). For 
+            'rk45' the initial step length of the adaptive integrator.
+        integrator (str): one of
+            'euler': forward Euler with int(1/step_size) substeps per day (reference).
+            'rk4': classical fixed-step Runge-Kutta with int(1/step_size) substeps per day.
+            'rk45': embedded Dormand-Prince 5(4) pair with per batch member 
+                error control. With the default tolerances, trajectories agree 
+                with the Euler reference at step_size=0.0005 to within 1e-3 
+                relative error while using ~100x fewer ode evaluations.
+        rtol (float): relative tolerance of the 'rk45' integrator.
+        atol (float): absolute tolerance (in individuals) of the 'rk45' integrator.
+        dtype (np.dtype, default=np.float64): precision of state, rates and
+            ode buffers. np.float32 halves memory traffic of the integration
+            loop and the footprint of recorded trajectories of large batches.
+            'rk45' integrates in float64 and casts the state back to dtype.
+        conservation_rtol (float): if dtype is not float64, the population 
+            S+I+D+A+R+T+H+E is compared to N after each step, and a relative
+            drift above conservation_rtol triggers on_drift. 
+        on_drift (str): one of
+            'warn': print a warning (once) and continue in dtype.
+            'fallback': print a warning and continue in float64.
+            'ignore': only track the drift in self.max_drift.
+        sensitivities (list of str): parameters p whose forward sensitivities
+            dState/dp are integrated along with the state ('euler' and 'rk4'),
+            exposed as self.sensitivity of shape (batch, 8, len(sensitivities)).
+            Each p is a rate epsilon..tau, one of alpha..delta given as a number,
+            or a key of input_sensitivities.
+        input_sensitivities (dict): maps parameters p acting through the 
+            contagion inputs (e.g. the lockdown effectiveness of a policy) to a 
+            tuple of the derivatives (dalpha/dp, dbeta/dp, dgamma/dp, ddelta/dp) 
+            of the inputs, specified like alpha..delta (placeholder key, 
+            callable or number).
+        period (int or np.array): if given, the inputs are periodic with this 
+            period (in days, per batch member) from period_start onwards, e.g. 
+            steps_high + steps_low of FPSP. Once the ratio of infected 
+            (I+D+A+R+T) between consecutive cycles of a member has settled, its
+            trajectory is extrapolated over several cycles instead of 
+            integrated, see _periodic_step. Only decaying infections are 
+            extrapolated. Members with period <= 0 are always integrated.
+        period_start (int or np.array): first day of periodic inputs.
+        period_rtol (float): tolerated relative error of infected per 
+            extrapolation, estimated from the drift of the cycle ratio, see
+            _periodic_step. Errors of successive extrapolations add up, 
+            self.n_extrapolations counts them per member.
+        max_cycles (int): maximum number of cycles extrapolated at once.
 
         Attributes
         ----------
         observation_space (gym.spaces.Box, shape=(3,)): at each step, the
             environment only returns the true values S, I, R
         action_space (gym.spaces.Box, shape=(1)): the value beta
-
-        #TODO necessary to wrap gym.Env?
+        Both spaces import gym on first access, gym is not required otherwise.
 
         """
     
         self.batch_size = batch_size  
+        self.dtype = np.dtype(dtype)
         self.s0 = s0
         self.N = self._to_batch(N)
         assert (np.sum(self.s0) == self.N).all()
+        self.N = self._cast(self.N)
+        
+        self.alpha = self._cast(self._to_batch(alpha))
+        self.beta = self._cast(self._to_batch(beta))
+        self.gamma = self._cast(self._to_batch(gamma))
+        self.delta = self._cast(self._to_batch(delta))
+        self.epsilon = self._cast(self._to_batch(epsilon))
+        self.zeta = self._cast(self._to_batch(zeta))
+        self.eta = self._cast(self._to_batch(eta))
+        self.theta = self._cast(self._to_batch(theta))
+        self.kappa = self._cast(self._to_batch(kappa))
+        self.h = self._cast(self._to_batch(h))
+        self.mu = self._cast(self._to_batch(mu))
+        self.nu = self._cast(self._to_batch(nu))
+        self.xi = self._cast(self._to_batch(xi))
+        self.rho = self._cast(self._to_batch(rho))
+        self.sigma = self._cast(self._to_batch(sigma))
+        self.tau = self._cast(self._to_batch(tau))
         
-        self.alpha = self._to_batch(alpha)
-        self.beta = self._to_batch(beta)
-        self.gamma = self._to_batch(gamma)
-        self.delta = self._to_batch(delta)
-        self.epsilon = self._to_batch(epsilon)
-        self.zeta = self._to_batch(zeta)
-        self.eta = self._to_batch(eta)
-        self.theta = self._to_batch(theta)
-        self.kappa = self._to_batch(kappa)
-        self.h = self._to_batch(h)
-        self.mu = self._to_batch(mu)
-        self.nu = self._to_batch(nu)
-        self.xi = self._to_batch(xi)
-        self.rho = self._to_batch(rho)
-        self.sigma = self._to_batch(sigma)
-        self.tau = self._to_batch(tau)
+        assert on_drift in ('warn', 'fallback', 'ignore'), on_drift
+        self.conservation_rtol = conservation_rtol
+        self.on_drift = on_drift
+        
+        self.sensitivities = [] if sensitivities is None else list(sensitivities)
+        self.input_sensitivities = {} if input_sensitivities is None else input_sensitivities
+        for p in self.sensitivities:
+            assert p in self.rate_names or p in self.input_sensitivities or \
+                (p in self.contagion_names and not isinstance(getattr(self, p), str) and not callable(getattr(self, p))), p
+        assert not self.sensitivities or integrator in ('euler', 'rk4'), integrator
+        
+        self.period = period
+        self.period_start = period_start
+        self.period_rtol = period_rtol
+        self.max_cycles = max_cycles
+        assert period is None or not (round_state or self.sensitivities), \
+            'cycle extrapolation does not support round_state and sensitivities'
+        if period is not None:
+            self.state_attributes = self.state_attributes + self.periodic_attributes
         
         self.round_state = round_state
         self.step_size = step_size
+        assert integrator in self.integrators, integrator
+        self.integrator = integrator
+        self.rtol = rtol
+        self.atol = atol
+
+    @property
+    def observation_space(self):
+        import gym
+        return gym.spaces.Box(0, np.inf, shape=(4,), dtype=np.float64)  # check dtype
 
-        self.observation_space = gym.spaces.Box(
-            0, np.inf, shape=(4,), dtype=np.float64)  # check dtype
-        self.action_space = gym.spaces.Box(
-            0, np.inf, shape=(1,), dtype=np.float64)
+    @property
+    def action_space(self):
+        import gym
+        return gym.spaces.Box(0, np.inf, shape=(1,), dtype=np.float64)
 
     def reset(self):
         """returns initial state (s0,  i0, r0)"""
-        self.state = self._to_batch(self.s0, (8,))
+        self.state = self._cast(self._to_batch(self.s0, (8,)))
         if self.round_state:
             self.state = self._pround(self.state)
+        self.n_evals = 0 # number of ode evaluations since reset
+        self.h_adaptive = np.full(self.batch_size, self.step_size) # rk45 step lengths
+        self.max_drift = 0. # largest relative population drift since reset
+        self._drift_warned = False
+        # forward sensitivities dState/dp, (parameter, 8, batch)
+        self._V = np.zeros((len(self.sensitivities), 8, self.batch_size), dtype=self.dtype)
+        # tangents of the constant rates, (parameter, 1) per rate
+        self._drates = {k: np.array([[float(p == k)] for p in self.sensitivities], dtype=self.dtype)
+                        for k in self.rate_names}
+        self.steps = 0 # days since reset
+        self.requested_active = None
+        if self.period is not None:
+            self._reset_periodic()
+        self.set_active(None)
 
         return self.state
+    
+    def set_active(self, idx):
+        """ Restricts integration to batch members idx (all if None).
+        
+        The state of inactive members is frozen at its current value, and 
+        the ode is only evaluated for active members. Used by Composite.run 
+        to compact finished simulations out of the batch.
+        """
+        self.requested_active = None if idx is None else np.asarray(idx)
+        self.active = self.requested_active
+        if self.period is not None:
+            if idx is not None:
+                # frozen members are not extrapolated either
+                stopped = np.ones(self.batch_size, dtype=bool)
+                stopped[self.requested_active] = False
+                self._jump_left[stopped] = 0
+            self.active = self._integrated()
+        self._precompute()
+    
+    def _precompute(self):
+        """ Gathers the rates of active members, precomputes constant rate 
+        sums and allocates the contiguous (8, batch) state block and scratch 
+        buffers used by the in-place ode kernel. """
+        rates = [self.N, self.epsilon, self.zeta, self.eta, self.theta, self.kappa, 
+                 self.h, self.mu, self.nu, self.xi, self.rho, self.sigma, self.tau]
+        self._rates = tuple(self._select_active(x) for x in rates)
+        N, epsilon, zeta, eta, theta, kappa, h, mu, nu, xi, rho, sigma, tau = self._rates
+        self._rate_sums = (epsilon + zeta + h, # I -> D, A, H
+                           eta + rho, # D -> R, H
+                           theta + mu + kappa, # A -> R, T, H
+                           nu + xi, # R -> T, H
+                           sigma + tau) # T -> H, E
+        
+        n = self.batch_size if self.active is None else self.active.shape[0]
+        self._X = np.empty((8, n), dtype=self.dtype)
+        self._dX = np.empty((8, n), dtype=self.dtype)
+        self._tmp = np.empty(n, dtype=self.dtype)
+        self._tmp2 = np.empty(n, dtype=self.dtype)
+        self._k = None # rk4 stage buffers, allocated on first use
+    
+    def _select_active(self, x):
+        """ Selects active members of per-member arrays. """
+        if self.active is None or np.ndim(x) == 0 or np.shape(x)[0] != self.batch_size:
+            return x
+        return x[self.active]
 
     def step(self, action=None):
         """performs integration step"""
         
-        alpha = self._to_batch(self._get_input(self.alpha, action))
-        beta = self._to_batch(self._get_input(self.beta, action))
-        gamma = self._to_batch(self._get_input(self.gamma, action))
-        delta = self._to_batch(self._get_input(self.delta, action))
-        
-        self.state = self.euler_step(self.state, 
-                                     dt=1, 
-                                     alpha=alpha,
-                                     beta=beta, 
-                                     gamma=gamma, 
-                                     delta=delta)
+        alpha = self._cast(self._to_batch(self._get_input(self.alpha, action)))
+        beta = self._cast(self._to_batch(self._get_input(self.beta, action)))
+        gamma = self._cast(self._to_batch(self._get_input(self.gamma, action)))
+        delta = self._cast(self._to_batch(self._get_input(self.delta, action)))
+        
+        if self.sensitivities:
+            self._sensitivity_step(alpha, beta, gamma, delta, action)
+        elif self.active is None:
+            integrate = getattr(self, self.integrators[self.integrator])
+            self.state = integrate(self.state, 
+                                   dt=1, 
+                                   alpha=alpha,
+                                   beta=beta, 
+                                   gamma=gamma, 
+                                   delta=delta)
+        elif self.active.shape[0] > 0:
+            integrate = getattr(self, self.integrators[self.integrator])
+            X = integrate(self.state[self.active], 
+                          dt=1, 
+                          alpha=self._select_active(alpha),
+                          beta=self._select_active(beta), 
+                          gamma=self._select_active(gamma), 
+                          delta=self._select_active(delta))
+            self.state = np.array(self.state)
+            self.state[self.active] = X
         if self.round_state:
             self.state = self._pround(self.state)
+        self.steps += 1
+        if self.period is not None:
+            self._periodic_step()
+        if self.dtype != np.float64:
+            self._check_conservation()
             
         return self.state, 0, False, None
 
+    def _reset_periodic(self):
+        """ Allocates the per-member state of cycle extrapolation. """
+        P = np.maximum(np.asarray(self._to_batch(self.period)).astype(np.int64), 0)
+        n = self.batch_size
+        self._period = P
+        self._period2 = 2*np.maximum(P, 1)
+        self._members = np.arange(n)
+        # states of the last two cycles, day t of member i at [i, t % (2*period[i])]
+        self._history = np.zeros((n, 2*max(1, int(P.max())), 8), dtype=self.dtype)
+        self._history[:, 0] = self.state
+        # next cycle boundary at which the cycle ratio is evaluated, -1 if none
+        self._start = self._to_batch(self.period_start)
+        self._next_boundary = np.where(P > 0, self._start + 2*P, -1)
+        self._ratio = np.full(n, np.nan) # last cycle ratio of infected
+        self._drift = np.full(n, np.nan) # last drift of the ratio per cycle
+        self._gap = np.ones(n, dtype=np.int64) # cycles since the last ratio
+        self._jump_left = np.zeros(n, dtype=np.int64) # days left to extrapolate
+        self.n_extrapolated = 0 # number of extrapolated member days since reset
+        self.n_extrapolations = np.zeros(n, dtype=np.int64) # per member since reset
+
+    def _integrated(self):
+        """ Members to integrate: requested active members that are not 
+        extrapolated. """
+        jumping = self._jump_left > 0
+        if not jumping.any():
+            return self.requested_active
+        integrate = ~jumping
+        if self.requested_active is not None:
+            mask = np.zeros(self.batch_size, dtype=bool)
+            mask[self.requested_active] = True
+            integrate &= mask
+        return np.flatnonzero(integrate)
+
+    def _periodic_step(self):
+        """ Extrapolates members over settled cycles and updates the cycle 
+        statistics at cycle boundaries.
+        
+        With periodic inputs in the suppressed regime, infected compartments
+        change by a nearly constant factor r per cycle while S changes little,
+        so that the change of the state over a cycle is scaled by r from cycle
+        to cycle. Extrapolated days t are therefore
+        
+            x(t) = x(t - period) + r * (x(t - period) - x(t - 2*period))
+            
+        which conserves the population. The ratio r is measured at each cycle
+        boundary reached by integration. If r drifts by d per cycle (relative
+        to r), the relative error of infected after n extrapolated cycles is 
+        about d*n*(n+1)/2, hence members are extrapolated over the largest 
+        n <= max_cycles within period_rtol. d is estimated by the larger of 
+        the last two measured drifts, so that ratios near an extremum do not
+        appear settled.
+        
+        After each extrapolation two cycles are integrated. The first checks
+        the extrapolation: its ratio, compared with the extrapolated r, gives
+        the drift actually realized over the jump, which enters the estimate
+        of the next jump and shrinks it where the previous one was too long.
+        The second is the basis of the next extrapolation, since differences
+        of extrapolated states amplify their errors. Growing infections are 
+        never extrapolated, as S changes too fast.
+        
+        period_rtol bounds the error of each extrapolation, estimated from 
+        past drifts. Errors of successive extrapolations add up, the relative
+        error of infected of a member is about n_extrapolations*period_rtol.
+        """
+        t = self.steps
+        P = self._period
+        H = self._history
+        jumping = np.flatnonzero(self._jump_left)
+        if jumping.shape[0] > 0:
+            p = P[jumping]
+            x = H[jumping, (t - p) % (2*p)]
+            x_ = H[jumping, t % (2*p)]
+            self.state = np.array(self.state)
+            self.state[jumping] = x + (x - x_) * self._ratio[jumping, None]
+            self._jump_left[jumping] -= 1
+            self.n_extrapolated += jumping.shape[0]
+        H[self._members, t % self._period2] = self.state
+        
+        b = np.flatnonzero(self._next_boundary == t)
+        if self.requested_active is not None:
+            b = b[np.isin(b, self.requested_active)]
+        if b.shape[0] > 0:
+            self._next_boundary[b] += P[b]
+            y = self.state[b, 1:6].sum(axis=1)
+            y_ = H[b, (t - P[b]) % self._period2[b], 1:6].sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = np.where((y > 0) & (y_ > 0), y / y_, np.nan)
+                # drift per cycle since the last measurement, i.e. over the 
+                # last jump (gap > 1) if the first cycle after it is checked
+                drift = np.abs(r - self._ratio[b]) / (r * self._gap[b])
+                d = np.maximum(drift, self._drift[b])
+                n = np.floor((np.sqrt(1 + 8*self.period_rtol/d) - 1) / 2)
+            n = np.where(np.isfinite(n), np.minimum(n, self.max_cycles), 0).astype(np.int64)
+            # the basis of a jump are two integrated cycles, and infections decay
+            n[(self._gap[b] > 1) | ~(r < 1)] = 0
+            self._ratio[b] = r
+            self._drift[b] = drift
+            self._jump_left[b] = n * P[b]
+            self.n_extrapolations[b] += n > 0
+            # the first cycle after a jump is checked at its end
+            self._next_boundary[b] += n * P[b]
+            self._gap[b] = n + 1
+        
+        if jumping.shape[0] > 0 or b.shape[0] > 0:
+            active = self._integrated()
+            if (active is None) != (self.active is None) or \
+                    active is not None and not np.array_equal(active, self.active):
+                self.active = active
+                self._precompute()
+
+    @property
+    def sensitivity(self):
+        """ Forward sensitivities dState/dp of shape (batch, 8, len(sensitivities)), 
+        ordered as self.sensitivities. """
+        return self._V.transpose(2, 1, 0)
+
+    def _input_tangents(self, action):
+        """ Derivatives of alpha..delta w.r.t. each sensitivity parameter, 
+        4 arrays of shape (len(sensitivities), active batch). """
+        n = self._X.shape[1]
+        dinputs = np.zeros((4, len(self.sensitivities), n), dtype=self.dtype)
+        for i, p in enumerate(self.sensitivities):
+            if p in self.input_sensitivities:
+                for j, spec in enumerate(self.input_sensitivities[p]):
+                    dinputs[j, i] = self._select_active(self._to_batch(self._get_input(spec, action)))
+            elif p in self.contagion_names:
+                dinputs[self.contagion_names.index(p), i] = 1
+        return dinputs
+
+    def _tangent(self, X, V, alpha, beta, gamma, delta, dinputs):
+        """ Time derivative of the sensitivities V of shape (parameter, 8, batch) 
+        at the (8, batch) state X, i.e. the Jacobian of the ode applied to V 
+        plus its derivative w.r.t. the parameters. """
+        S, I, D, A, R, T, H, E = X
+        VS, VI, VD, VA, VR, VT, VH, VE = V.transpose(1, 0, 2)
+        N, epsilon, zeta, eta, theta, kappa, h, mu, nu, xi, rho, sigma, tau = self._rates
+        r_I, r_D, r_A, r_R, r_T = self._rate_sums
+        dalpha, dbeta, dgamma, ddelta = dinputs
+        d = self._drates
+        
+        infected = alpha*I + beta*D + gamma*A + delta*R
+        dinfected = (alpha*VI + beta*VD + gamma*VA + delta*VR 
+                     + dalpha*I + dbeta*D + dgamma*A + ddelta*R)
+        dnewly_infected = S/N * dinfected + infected/N * VS
+        
+        dV = np.empty_like(V)
+        dV[:, 0] = -dnewly_infected
+        dV[:, 1] = dnewly_infected - r_I*VI - (d['epsilon'] + d['zeta'] + d['h'])*I
+        dV[:, 2] = epsilon*VI + d['epsilon']*I - r_D*VD - (d['eta'] + d['rho'])*D
+        dV[:, 3] = zeta*VI + d['zeta']*I - r_A*VA - (d['theta'] + d['mu'] + d['kappa'])*A
+        dV[:, 4] = eta*VD + d['eta']*D + theta*VA + d['theta']*A - r_R*VR - (d['nu'] + d['xi'])*R
+        dV[:, 5] = mu*VA + d['mu']*A + nu*VR + d['nu']*R - r_T*VT - (d['sigma'] + d['tau'])*T
+        dV[:, 6] = (h*VI + d['h']*I + rho*VD + d['rho']*D + kappa*VA + d['kappa']*A 
+                    + xi*VR + d['xi']*R + sigma*VT + d['sigma']*T)
+        dV[:, 7] = tau*VT + d['tau']*T
+        return dV
+
+    def _sensitivity_step(self, alpha, beta, gamma, delta, action):
+        """ Integrates state and sensitivities over one step with the stages 
+        of euler_step or rk4_step. The state takes the same arithmetic as 
+        without sensitivities. """
+        inputs = [self._select_active(x) for x in (alpha, beta, gamma, delta)]
+        dinputs = self._input_tangents(action)
+        idx = slice(None) if self.active is None else self.active
+        X_ = self._X
+        X_[...] = self.state[idx].T
+        V = self._V[:, :, idx]
+        n_steps = int(1/self.step_size)
+        h = 1/n_steps
+        if self.integrator == 'euler':
+            dX = self._dX
+            for _ in range(n_steps):
+                dV = self._tangent(X_, V, *inputs, dinputs)
+                self._ode_inplace(X_, dX, *inputs)
+                np.multiply(dX, h, out=dX)
+                np.add(X_, dX, out=X_)
+                V = V + dV*h
+            self.n_evals += n_steps
+        else:
+            if self._k is None:
+                self._k = np.empty((5, ) + self._X.shape, dtype=self.dtype)
+            k1, k2, k3, k4, Y = self._k
+            for _ in range(n_steps):
+                self._ode_inplace(X_, k1, *inputs)
+                l1 = self._tangent(X_, V, *inputs, dinputs)
+                np.multiply(k1, h/2, out=Y)
+                np.add(Y, X_, out=Y)
+                self._ode_inplace(Y, k2, *inputs)
+                l2 = self._tangent(Y, l1*(h/2) + V, *inputs, dinputs)
+                np.multiply(k2, h/2, out=Y)
+                np.add(Y, X_, out=Y)
+                self._ode_inplace(Y, k3, *inputs)
+                l3 = self._tangent(Y, l2*(h/2) + V, *inputs, dinputs)
+                np.multiply(k3, h, out=Y)
+                np.add(Y, X_, out=Y)
+                self._ode_inplace(Y, k4, *inputs)
+                l4 = self._tangent(Y, l3*h + V, *inputs, dinputs)
+                np.add(k2, k3, out=k2)
+                np.multiply(k2, 2, out=k2)
+                np.add(k1, k2, out=k1)
+                np.add(k1, k4, out=k1)
+                np.multiply(k1, h/6, out=k1)
+                np.add(X_, k1, out=X_)
+                V = V + ((l1 + (l2 + l3)*2) + l4)*(h/6)
+            self.n_evals += 4*n_steps
+        
+        if self.active is None:
+            self.state = X_.T.copy()
+            self._V = V.astype(self.dtype, copy=False)
+        else:
+            self.state = np.array(self.state)
+            self.state[self.active] = X_.T
+            self._V[:, :, self.active] = V
+
+    def _cast(self, x):
+        """ Casts numeric parameters to self.dtype, placeholder keys and 
+        callables are returned as is. """
+        if isinstance(x, str) or callable(x):
+            return x
+        return np.asarray(x, dtype=self.dtype)
+
+    def _check_conservation(self):
+        """ Tracks the relative drift of the population S+...+E from N, 
+        accumulated in float64, and applies self.on_drift if it exceeds 
+        self.conservation_rtol. """
+        drift = np.abs(np.sum(self.state, axis=1, dtype=np.float64) - self.N) / self.N
+        drift = float(np.max(drift))
+        self.max_drift = max(self.max_drift, drift)
+        if drift <= self.conservation_rtol or self.on_drift == 'ignore':
+            return
+        if self.on_drift == 'fallback':
+            print("Warning: population drift {:.2e} exceeds {:.2e} in {}, continuing in float64".format(
+                drift, self.conservation_rtol, self.dtype))
+            self.set_dtype(np.float64)
+        elif not self._drift_warned:
+            print("Warning: population drift {:.2e} exceeds {:.2e} in {}".format(
+                drift, self.conservation_rtol, self.dtype))
+            self._drift_warned = True
+
+    def set_state(self, state):
+        """ Restores a snapshot, see Agent.set_state, and the integrated 
+        members. """
+        assert np.shape(state['state']) == (self.batch_size, 8), np.shape(state['state'])
+        super().set_state(state)
+        self.set_active(self.requested_active)
+        
+    def fork_state(self, state, index):
+        """ Replicates members of a snapshot, see Agent.fork_state. Cycle 
+        statistics of extrapolation depend on the period of each member, 
+        hence snapshots are forked before period_start only, where this 
+        agent's statistics from reset apply. """
+        assert self.period is None or state['steps'] <= np.min(self.period_start), \
+            'cannot fork after period_start with cycle extrapolation'
+        state = {k: v for k, v in state.items() if k not in self.periodic_attributes}
+        forked = super().fork_state(state, index)
+        forked['_V'] = state['_V'][..., index]
+        if state['requested_active'] is not None:
+            active = np.zeros(np.shape(state['state'])[0], dtype=bool)
+            active[state['requested_active']] = True
+            forked['requested_active'] = np.flatnonzero(active[index])
+        return forked
+
+    def set_dtype(self, dtype):
+        """ Casts state and rates to dtype and reallocates the ode buffers. """
+        self.dtype = np.dtype(dtype)
+        for k in ['N', 'alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta',
+                  'kappa', 'h', 'mu', 'nu', 'xi', 'rho', 'sigma', 'tau']:
+            setattr(self, k, self._cast(getattr(self, k)))
+        if hasattr(self, 'state'):
+            self.state = self._cast(self.state)
+            self._V = self._cast(self._V)
+            self._drates = {k: self._cast(v) for k, v in self._drates.items()}
+            self._precompute()
+
     @staticmethod
     def _pround(x):
         dx = np.random.uniform(size=x.shape) < (x-x.astype(np.int32))
@@ -131,7 +601,7 @@ class BatchSIDARTHE(Agent):
         if x_arr.shape == target_shape:
             return x_arr
         elif (x_arr.shape == shape):
-            return np.matlib.repmat(x_arr.reshape(shape), self.batch_size,1).reshape(target_shape)
+            return np.broadcast_to(x_arr, target_shape).copy()
         elif len(x_arr.shape) > 0 and x_arr.shape[0] == target_shape:
             return x_arr.reshape(target_shape)
         else:
@@ -140,30 +610,161 @@ class BatchSIDARTHE(Agent):
     
     def euler_step(self, X, dt, alpha, beta, gamma, delta):
         
-        X_ = np.array(X)
+        X_, dX = self._X, self._dX
+        X_[...] = X.T
         n_steps = int(1/self.step_size)
+        h = dt/n_steps
         for _ in range(n_steps):
-            dxdt = self._ode(X_, 
-                             dt/n_steps, 
-                             self.N, 
-                             alpha,
-                             beta,
-                             gamma,
-                             delta,
-                             self.epsilon,
-                             self.zeta,
-                             self.eta,
-                             self.theta,
-                             self.kappa,
-                             self.h,
-                             self.mu,
-                             self.nu,
-                             self.xi,
-                             self.rho,
-                             self.sigma,
-                             self.tau)
-            X_ = X_ + dxdt
-        return X_
+            self._ode_inplace(X_, dX, alpha, beta, gamma, delta)
+            np.multiply(dX, h, out=dX)
+            np.add(X_, dX, out=X_)
+        self.n_evals += n_steps
+        return X_.T.copy()
+    
+    def rk4_step(self, X, dt, alpha, beta, gamma, delta):
+        
+        if self._k is None:
+            self._k = np.empty((5, ) + self._X.shape, dtype=self.dtype)
+        X_ = self._X
+        k1, k2, k3, k4, Y = self._k
+        X_[...] = X.T
+        n_steps = int(1/self.step_size)
+        h = dt/n_steps
+        for _ in range(n_steps):
+            self._ode_inplace(X_, k1, alpha, beta, gamma, delta)
+            np.multiply(k1, h/2, out=Y)
+            np.add(Y, X_, out=Y)
+            self._ode_inplace(Y, k2, alpha, beta, gamma, delta)
+            np.multiply(k2, h/2, out=Y)
+            np.add(Y, X_, out=Y)
+            self._ode_inplace(Y, k3, alpha, beta, gamma, delta)
+            np.multiply(k3, h, out=Y)
+            np.add(Y, X_, out=Y)
+            self._ode_inplace(Y, k4, alpha, beta, gamma, delta)
+            # X += h/6 * (k1 + 2*k2 + 2*k3 + k4)
+            np.add(k2, k3, out=k2)
+            np.multiply(k2, 2, out=k2)
+            np.add(k1, k2, out=k1)
+            np.add(k1, k4, out=k1)
+            np.multiply(k1, h/6, out=k1)
+            np.add(X_, k1, out=X_)
+        self.n_evals += 4*n_steps
+        return X_.T.copy()
+    
+    def adaptive_step(self, X, dt, alpha, beta, gamma, delta):
+        """ Dormand-Prince 5(4) integration over [0, dt]. 
+        
+        Each batch member advances with its own step length, steps are 
+        accepted or rejected per member and finished members are excluded 
+        from further ode evaluations. Step lengths are carried over to the 
+        next call in self.h_adaptive.
+        """
+        X_ = np.array(X, dtype=np.float64)
+        t = np.zeros(X_.shape[0])
+        args = [np.broadcast_to(x, t.shape) for x in (alpha, beta, gamma, delta)]
+        h = np.minimum(self._select_active(self.h_adaptive), dt)
+        while True:
+            idx = np.flatnonzero(t < dt * (1 - 1e-12))
+            if idx.shape[0] == 0:
+                break
+            
+            h_ = np.minimum(h[idx], dt - t[idx])
+            truncated = h_ < h[idx]
+            Y = X_[idx]
+            args_ = [x[idx] for x in args]
+            k = []
+            for a, c in zip(self._dp_a, self._dp_c):
+                Y_ = Y + h_[:,None] * sum(a_ * k_ for a_, k_ in zip(a, k)) if k else Y
+                k.append(self._f(Y_, *args_, idx=idx))
+            Y_5 = Y + h_[:,None] * sum(b_ * k_ for b_, k_ in zip(self._dp_b, k) if b_ != 0)
+            err = h_[:,None] * sum(e_ * k_ for e_, k_ in zip(self._dp_e, k) if e_ != 0)
+            
+            scale = self.atol + self.rtol * np.maximum(np.abs(Y), np.abs(Y_5))
+            err_norm = np.sqrt(np.mean((err / scale)**2, axis=1))
+            accept = err_norm <= 1
+            
+            X_[idx[accept]] = Y_5[accept]
+            t[idx[accept]] += h_[accept]
+            
+            with np.errstate(divide='ignore'):
+                factor = np.clip(0.9 * err_norm**(-1/5), 0.2, 5.)
+            factor[~accept] = np.minimum(factor[~accept], 1.)
+            h_new = h_ * factor
+            # do not shrink step length because of a truncated final step
+            h_new[truncated & accept] = np.maximum(h_new[truncated & accept], h[idx][truncated & accept])
+            h[idx] = h_new
+        
+        if self.active is None:
+            self.h_adaptive = h
+        else:
+            self.h_adaptive[self.active] = h
+        return X_.astype(self.dtype, copy=False)
+    
+    def _f(self, X, alpha, beta, gamma, delta, idx=None):
+        """ Time derivative of state X for active batch members idx (all by default). """
+        self.n_evals += 1
+        rates = self._rates
+        if idx is not None:
+            rates = [x[idx] for x in rates]
+        N, rates = rates[0], rates[1:]
+        return self._ode(X, 1, N, alpha, beta, gamma, delta, *rates)
+
+    def _ode_inplace(self, X, out, alpha, beta, gamma, delta):
+        """ Writes the time derivative of the (8, batch) state X into out 
+        without allocating temporaries. Same arithmetic as _ode. """
+        S, I, D, A, R, T, H, E = X
+        dS, dI, dD, dA, dR, dT, dH, dE = out
+        N, epsilon, zeta, eta, theta, kappa, h, mu, nu, xi, rho, sigma, tau = self._rates
+        r_I, r_D, r_A, r_R, r_T = self._rate_sums
+        tmp, tmp2 = self._tmp, self._tmp2
+        
+        # newly_infected = S/N * (alpha*I + beta*D + gamma*A + delta*R)
+        np.multiply(alpha, I, out=tmp)
+        np.multiply(beta, D, out=tmp2)
+        np.add(tmp, tmp2, out=tmp)
+        np.multiply(gamma, A, out=tmp2)
+        np.add(tmp, tmp2, out=tmp)
+        np.multiply(delta, R, out=tmp2)
+        np.add(tmp, tmp2, out=tmp)
+        np.divide(S, N, out=tmp2)
+        np.multiply(tmp2, tmp, out=tmp)
+        
+        np.negative(tmp, out=dS)
+        np.multiply(r_I, I, out=dI)
+        np.subtract(tmp, dI, out=dI)
+        
+        np.multiply(epsilon, I, out=dD)
+        np.multiply(r_D, D, out=tmp)
+        np.subtract(dD, tmp, out=dD)
+        
+        np.multiply(zeta, I, out=dA)
+        np.multiply(r_A, A, out=tmp)
+        np.subtract(dA, tmp, out=dA)
+        
+        np.multiply(eta, D, out=dR)
+        np.multiply(theta, A, out=tmp)
+        np.add(dR, tmp, out=dR)
+        np.multiply(r_R, R, out=tmp)
+        np.subtract(dR, tmp, out=dR)
+        
+        np.multiply(mu, A, out=dT)
+        np.multiply(nu, R, out=tmp)
+        np.add(dT, tmp, out=dT)
+        np.multiply(r_T, T, out=tmp)
+        np.subtract(dT, tmp, out=dT)
+        
+        np.multiply(h, I, out=dH)
+        np.multiply(rho, D, out=tmp)
+        np.add(dH, tmp, out=dH)
+        np.multiply(kappa, A, out=tmp)
+        np.add(dH, tmp, out=dH)
+        np.multiply(xi, R, out=tmp)
+        np.add(dH, tmp, out=dH)
+        np.multiply(sigma, T, out=tmp)
+        np.add(dH, tmp, out=dH)
+        
+        np.multiply(tau, T, out=dE)
+        return out
 
     @staticmethod
     def _ode(Y, dt, N,
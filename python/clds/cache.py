@@ -0,0 +1,241 @@
+""" Content-addressed on-disk cache of simulation results.
+
+Results are keyed by a canonical hash of everything that determines them:
+agent parameters, the wiring of Composite agents (order, channels, pre and
+post transforms), run arguments and the source code of clds itself. Functions
+(e.g. `pre` lambdas) are hashed by their code, constants, closure variables
+and the values of the globals they reference.
+
+Example:
+
+    cache = clds.cache.Cache('results/cache', max_bytes=2**30)
+    out = cache.run(env, n_steps=365, record={'infected': ('model', slice(1, 6))})
+
+    @cache.memoize
+    def simulate(R0, q, d, period, X):
+        ...
+
+Entries are written as compressed .npz files by atomic rename, so that
+several processes can share a cache directory. Once the cache exceeds
+max_bytes, least recently used entries are evicted.
+"""
+import functools
+import hashlib
+import inspect
+import json
+import os
+import types
+
+import numpy as np
+
+from .core import Agent, Composite
+from .reducers import Reducer
+
+
+_library_version = None
+
+
+def library_version():
+    """ Digest of the clds source files. """
+    global _library_version
+    if _library_version is None:
+        h = hashlib.sha256()
+        root = os.path.dirname(os.path.abspath(__file__))
+        for dirpath, dirnames, filenames in sorted(os.walk(root)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    h.update(os.path.relpath(os.path.join(dirpath, filename), root).encode())
+                    with open(os.path.join(dirpath, filename), 'rb') as f:
+                        h.update(f.read())
+        _library_version = h.hexdigest()
+    return _library_version
+
+
+def canonical(x, _visited=None):
+    """ Canonical, hashable representation of parameters, agents and functions.
+
+    Raises TypeError for objects that cannot be represented reliably.
+    """
+    visited = set() if _visited is None else _visited
+    if x is None or isinstance(x, (bool, int, str, bytes)):
+        return (type(x).__name__, x)
+    if isinstance(x, float):
+        return ('float', repr(x))
+    if isinstance(x, (np.ndarray, np.generic)):
+        x = np.ascontiguousarray(x)
+        if x.dtype == object:
+            return ('object_array', x.shape, tuple(canonical(v, visited) for v in x.reshape(-1)))
+        return ('array', str(x.dtype), x.shape, hashlib.sha256(x.tobytes()).hexdigest())
+    if isinstance(x, np.dtype):
+        return ('dtype', x.str)
+    if isinstance(x, (list, tuple)):
+        return (type(x).__name__, tuple(canonical(v, visited) for v in x))
+    if isinstance(x, dict):
+        return ('dict', tuple(sorted((repr(k), canonical(v, visited)) for k, v in x.items())))
+    if isinstance(x, slice):
+        return ('slice', canonical((x.start, x.stop, x.step), visited))
+    if isinstance(x, types.ModuleType):
+        return ('module', x.__name__)
+    if isinstance(x, type):
+        return ('type', x.__module__, x.__qualname__)
+
+    # objects may reference each other, e.g. callbacks referencing agents
+    if id(x) in visited:
+        return ('ref', type(x).__qualname__)
+    visited = visited | {id(x)}
+
+    if isinstance(x, Composite):
+        return ('Composite', x.order, tuple(
+            (a.out, canonical(a.agent, visited), canonical(a.pre, visited), canonical(a.post, visited))
+            for a in x.agents))
+    if isinstance(x, (Agent, Reducer)):
+        # agents and reducers are defined by the current values of their 
+        # __init__ parameters, not by their simulation state
+        params = inspect.signature(type(x).__init__).parameters
+        return ('Agent' if isinstance(x, Agent) else 'Reducer', type(x).__module__, type(x).__qualname__, tuple(
+            (p, canonical(getattr(x, p), visited)) for p in params if p != 'self' and hasattr(x, p)))
+    if isinstance(x, functools.partial):
+        return ('partial', canonical(x.func, visited), canonical(x.args, visited), canonical(x.keywords, visited))
+    if isinstance(x, types.MethodType):
+        return ('method', canonical(x.__func__, visited), canonical(x.__self__, visited))
+    if isinstance(x, types.FunctionType):
+        return ('function', _code(x.__code__, x.__globals__, visited),
+                canonical(x.__defaults__, visited),
+                canonical(x.__kwdefaults__, visited),
+                tuple(canonical(c.cell_contents, visited) for c in (x.__closure__ or ())))
+    if callable(x) and hasattr(x, '__qualname__') and not hasattr(x, '__self__'):
+        # builtins, ufuncs and other library callables are referenced by name
+        return ('callable', getattr(x, '__module__', None), x.__qualname__)
+    if hasattr(x, '__dict__'):
+        return ('object', type(x).__module__, type(x).__qualname__, canonical(vars(x), visited))
+    raise TypeError('cannot compute canonical representation of {}'.format(type(x)))
+
+
+def _code(code, globals_, visited):
+    """ Canonical representation of a code object and the globals it reads. """
+    consts = tuple(_code(c, globals_, visited) if isinstance(c, types.CodeType) else canonical(c, visited)
+                   for c in code.co_consts)
+    names = tuple((name, canonical(globals_[name], visited)) if name in globals_ else (name, None)
+                  for name in code.co_names)
+    return ('code', code.co_code, consts, names, code.co_varnames)
+
+
+def key(*args, **kwargs):
+    """ Hash of the canonical representation of args, kwargs and the library. """
+    r = canonical((library_version(), args, kwargs))
+    return hashlib.sha256(repr(r).encode()).hexdigest()
+
+
+class Cache:
+    """ Size-bounded, least-recently-used on-disk cache.
+
+    Args:
+        path (str): cache directory, shared by processes using the cache.
+        max_bytes (int): total size of cached files above which least
+            recently used entries are evicted.
+    """
+    def __init__(self, path, max_bytes=2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def get(self, key):
+        """ Returns the cached result for key, None if missing. """
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as f:
+                arrays = {k: f[k] for k in f.files}
+            os.utime(filename) # mark as recently used
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        return _unpack(json.loads(str(arrays.pop('__structure__'))), arrays)
+
+    def put(self, key, result):
+        """ Stores a result, i.e. arrays or (nested) dicts, lists and tuples
+        of arrays and numbers. """
+        arrays = {}
+        structure = _pack(result, arrays)
+        arrays['__structure__'] = np.array(json.dumps(structure))
+        tmp = os.path.join(self.path, '{}.{}.tmp.npz'.format(key, os.getpid()))
+        np.savez_compressed(tmp, **arrays)
+        os.replace(tmp, self._filename(key))
+        self.evict()
+
+    def evict(self):
+        """ Removes least recently used entries until the cache fits max_bytes. """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npz') and not entry.name.endswith('.tmp.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(e[1] for e in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npz'):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def run(self, env, n_steps, **kwargs):
+        """ Cached `env.run(n_steps, **kwargs)`. Runs continuing from the 
+        current state (reset=False) are also keyed by the snapshot of env, 
+        see Composite.get_state. env is not stepped when the result is 
+        cached. """
+        state = None if kwargs.get('reset', True) else env.get_state()
+        k = key('Composite.run', env, n_steps, kwargs, state)
+        out = self.get(k)
+        if out is None:
+            out = env.run(n_steps, **kwargs)
+            self.put(k, out)
+        return out
+
+    def memoize(self, fn):
+        """ Decorator caching the results of fn by its code and arguments. """
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            k = key('memoize', fn, args, kwargs)
+            out = self.get(k)
+            if out is None:
+                out = fn(*args, **kwargs)
+                self.put(k, out)
+            return out
+        return wrapper
+
+
+def _pack(x, arrays):
+    """ Stores arrays of a nested result in arrays and returns its structure. """
+    if isinstance(x, dict):
+        return {'type': 'dict', 'items': {str(k): _pack(v, arrays) for k, v in x.items()}}
+    if isinstance(x, (list, tuple)):
+        return {'type': type(x).__name__, 'items': [_pack(v, arrays) for v in x]}
+    name = 'a{}'.format(len(arrays))
+    arrays[name] = np.asarray(x)
+    return {'type': 'array' if isinstance(x, np.ndarray) else 'scalar', 'key': name}
+
+
+def _unpack(structure, arrays):
+    t = structure['type']
+    if t == 'dict':
+        return {k: _unpack(v, arrays) for k, v in structure['items'].items()}
+    if t in ('list', 'tuple'):
+        items = [_unpack(v, arrays) for v in structure['items']]
+        return items if t == 'list' else tuple(items)
+    x = arrays[structure['key']]
+    return x if t == 'array' else x.item()
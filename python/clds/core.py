@@ -1,7 +1,12 @@
-import gym
+import copy
 
-class Agent(gym.Env):
-    """ Implements the gym.Env interface. 
+import numpy as np
+
+from .profiling import Profiler
+
+class Agent:
+    """ Implements the gym.Env interface without depending on gym, see 
+    clds.gym_env.GymEnv to use agents where a gym.Env is required.
     
     Each agent in a Closed Loop Data Science simulation acts on the union 
     of observations made available by other agents, and returns an object 
@@ -23,7 +28,22 @@ class Agent(gym.Env):
         render
         close
         seed
+    
+    Agents declaring state_attributes also support snapshots of their 
+    dynamic state, see get_state, set_state and fork_state.
     """
+    # attributes of gym.Env
+    metadata = {'render.modes': []}
+    reward_range = (-float('inf'), float('inf'))
+    spec = None
+    action_space = None
+    observation_space = None
+    
+    # attributes set by reset and step, i.e. the dynamic state (None if 
+    # snapshots are not supported), and those of them with a leading batch 
+    # axis.
+    state_attributes = None
+    batch_attributes = ()
     
     def reset(self):
         """Resets the state of the agent and returns an initial observable.
@@ -103,6 +123,49 @@ class Agent(gym.Env):
               this won't be true if seed=None, for example.
         """
         return
+
+    def get_state(self):
+        """ Returns a snapshot of the dynamic state, i.e. copies of the 
+        state_attributes, from which `set_state` continues the simulation. 
+        Parameters given to __init__ are not part of the snapshot.
+        """
+        if self.state_attributes is None:
+            raise NotImplementedError('{} does not support snapshots'.format(type(self).__name__))
+        return {k: copy.deepcopy(getattr(self, k)) for k in self.state_attributes}
+    
+    def set_state(self, state):
+        """ Restores a snapshot of `get_state` (or `fork_state`). The agent
+        must have been reset, so that attributes derived from its parameters
+        exist. The snapshot is copied, hence it can be restored repeatedly.
+        """
+        for k, v in state.items():
+            setattr(self, k, copy.deepcopy(v))
+            
+    def fork_state(self, state, index):
+        """ Replicates batch members of a snapshot, e.g. taken with a batch 
+        of one, for this agent's batch: member i continues member index[i] 
+        of the snapshot.
+        
+        Args:
+            state (dict): snapshot of an agent of the same type.
+            index (np.array): snapshot member of each member of this agent.
+            
+        Returns:
+            snapshot to be restored by `set_state`.
+        """
+        return {k: np.asarray(v)[index] if k in self.batch_attributes and np.ndim(v) > 0 
+                else copy.deepcopy(v) for k, v in state.items()}
+
+    @property
+    def unwrapped(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
         
     @staticmethod
     def _get_input(var, action):
@@ -124,14 +187,111 @@ class Agent(gym.Env):
 
 class Lambda(Agent):
     """ Supports lambda expressions for reset and step. """
+    state_attributes = () # step_fn is assumed to be stateless
+    
     def __init__(self, reset_fn, step_fn):
         self.reset = reset_fn
+        self.reset_fn = reset_fn
         self.step_fn = step_fn
         
     def step(self, action):
         return self.step_fn(action), 0., False, None
 
 
+class Linear:
+    """ Declarative linear transform of an observable,
+
+        y = scale * x[channel][..., index] + offset
+
+    Unlike an equivalent lambda, Linear transforms used as `pre` of a 
+    Composite agent are compiled into its execution plan: transforms of the
+    same input are evaluated together by a single ufunc call into a 
+    preallocated buffer, so that no arrays are allocated per step. Within a
+    plan, scale and offset are read when the plan is compiled (on reset).
+
+    Example: pre={'a': Linear('fpsp', scale=alpha)} is equivalent to
+    pre=lambda x: {'a': x['fpsp']*alpha}.
+
+    Args:
+        channel (str): input channel, None for the value transformed itself
+            (e.g. the agent output when used as `post`).
+        scale (float or np.array): factor, broadcast against the input.
+        offset (float or np.array): offset, broadcast against the input.
+        index (int, slice or list): selection along the last axis of the
+            input, None for all.
+    """
+    def __init__(self, channel=None, scale=1., offset=0., index=None):
+        self.channel = channel
+        self.scale = scale
+        self.offset = offset
+        self.index = index
+
+    def __call__(self, x):
+        v = x if self.channel is None else x[self.channel]
+        if self.index is not None:
+            v = np.asarray(v)[..., self.index]
+        if isinstance(self.offset, np.ndarray) or self.offset != 0:
+            return v * self.scale + self.offset
+        return v * self.scale
+
+
+class _LinearGroup:
+    """ Linear transforms of the same input, evaluated in place into the rows
+    of a (k, ...) buffer. """
+    def __init__(self, transforms):
+        self.channel = transforms[0].channel
+        self.index = transforms[0].index
+        # python scalars stay weakly typed in the result dtype, so that float32
+        # inputs scaled by python floats are evaluated in float32
+        self.dtypes = [x for t in transforms for x in (t.scale, t.offset)]
+        self.scale = [np.asarray(t.scale) for t in transforms]
+        self.offset = [np.asarray(t.offset) for t in transforms]
+        self.has_offset = any(o.ndim > 0 or o != 0 for o in self.offset)
+        self.shape = None
+        self.buffer = None
+        self.rows = None
+
+    def _allocate(self, v):
+        """ Stacks parameters and allocates the buffer for inputs like v. """
+        shape = np.broadcast_shapes(v.shape, *[x.shape for x in self.scale + self.offset])
+        dtype = np.result_type(v, *self.dtypes, 0.)
+        self._scale = self._stack(self.scale, shape).astype(dtype, copy=False)
+        self._offset = self._stack(self.offset, shape).astype(dtype, copy=False)
+        self.buffer = np.empty((len(self.scale), ) + shape, dtype=dtype)
+        self.rows = list(self.buffer)
+        self.shape = v.shape
+
+    @staticmethod
+    def _stack(xs, shape):
+        """ Stacks parameters xs to broadcast against a (k, ) + shape buffer. """
+        if all(x.ndim == 0 for x in xs):
+            return np.array(xs).reshape((len(xs), ) + (1, ) * len(shape))
+        return np.stack([np.broadcast_to(x, shape) for x in xs])
+
+    def __call__(self, observable):
+        v = observable if self.channel is None else observable[self.channel]
+        if type(v) is not np.ndarray:
+            v = np.asarray(v)
+        if self.index is not None:
+            v = v[..., self.index]
+        if v.shape != self.shape:
+            self._allocate(v)
+        np.multiply(v, self._scale, out=self.buffer)
+        if self.has_offset:
+            np.add(self.buffer, self._offset, out=self.buffer)
+        return self.rows
+
+
+def _apply_pre(pre, observable):
+    """ Evaluates a `pre` transform: None, a callable or a dict mapping input
+    names to channel names, callables (e.g. Linear) or constants. """
+    if pre is None:
+        return observable
+    if isinstance(pre, dict):
+        return {k: Agent._get_input(v, observable) for k, v in pre.items()}
+    return pre(observable)
+
+
 class Composite(Agent):
 
     def __init__(self, order='concurrent'):
@@ -151,6 +311,8 @@ class Composite(Agent):
         self.order = order
         self.agents = []
         self.observable = None
+        self.profiler = None
+        self._plan = None
         
         
         # TODO: set the following as required by gym.Env
@@ -168,10 +330,11 @@ class Composite(Agent):
         Args:
             agent (Agent): agent to be wrapped.
             out (str): agent output channel name.
-            pre (callable): function applied to observable input before `step`
-                is called.
+            pre (callable or dict): function applied to observable input before
+                `step` is called, or a dict mapping agent input names to 
+                channel names, Linear transforms, callables or constants.
             post (callable): function applied to agent output before sending it
-                to `out`.
+                to `out`, e.g. Linear(scale=...).
         """
         
         def __init__(self, agent, out, pre=None, post=None):
@@ -189,17 +352,102 @@ class Composite(Agent):
             o, r, d, i = self.agent.step(self._wrap_input(observable))
             return self._wrap_output(o), r, d, i
         
+        def get_state(self):
+            return self.agent.get_state()
+        
+        def set_state(self, state):
+            self.agent.set_state(state)
+            
+        def fork_state(self, state, index):
+            return self.agent.fork_state(state, index)
+        
         def _wrap_input(self, observable):
-            return observable if self.pre is None else self.pre(observable)
+            return _apply_pre(self.pre, observable)
         
         def _wrap_output(self, output):
             return {self.out: output if self.post is None else self.post(output)}  
     
     def add(self, agent, out, pre=None, post=None):
+        """ Adds an agent writing to channel `out`, see Composite.Internal.
+
+        Declarative pre transforms, i.e. Linear or dicts of Linear, are 
+        evaluated in place by the execution plan; any other callable is 
+        called as is.
+        """
         self.agents.append(self.Internal(agent=agent, out=out, pre=pre, post=post))
-    
+        self._plan = None
+
+    def compile(self):
+        """ Compiles agents, channels and transforms into the fixed execution
+        plan used by `step`: a list of (step, out, pre, buffers, post) where 
+        step is the agent's step method and pre evaluates declarative 
+        transforms into the preallocated buffers. While profiling, step, pre
+        and post are wrapped by the profiler.
+
+        Called by `reset`. Call it again after modifying `agents` directly.
+        """
+        self._plan = []
+        for a in self.agents:
+            step, (pre, buffers), post = a.agent.step, self._compile_pre(a.pre), a.post
+            if self.profiler is not None:
+                step = self.profiler.timed(step, '{}/{}.step'.format(a.out, type(a.agent).__name__), agent=a.agent)
+                pre = None if pre is None else self.profiler.timed(pre, '{}/pre'.format(a.out))
+                post = None if post is None else self.profiler.timed(post, '{}/post'.format(a.out))
+            self._plan.append((step, a.out, pre, buffers, post))
+        self._batch_size = max([getattr(a.agent, 'batch_size', 1) for a in self.agents] + [1])
+
+    def profile(self, enable=True, memory=False):
+        """ Switches instrumentation of `step` on or off, see clds.profiling.
+
+        Args:
+            enable (bool): profile subsequent steps.
+            memory (bool): also trace bytes allocated per step.
+
+        Returns:
+            the Profiler collecting measurements (None when switched off), 
+            which is kept until profiling is switched off.
+        """
+        if enable:
+            if self.profiler is None:
+                self.profiler = Profiler(memory=memory)
+            self.profiler.start()
+        elif self.profiler is not None:
+            self.profiler.stop()
+            self.profiler.unwatch()
+            self.profiler = None
+        self.compile()
+        return self.profiler
+
+    @staticmethod
+    def _compile_pre(pre):
+        """ Returns pre as a function of the observable evaluating Linear 
+        transforms in place, and the list of its buffers (None if it has 
+        none). """
+        if isinstance(pre, Linear):
+            group = _LinearGroup([pre])
+            buffers = [group]
+            return lambda observable: group(observable)[0], buffers
+        if isinstance(pre, dict):
+            # one group per distinct input
+            groups = {}
+            for k, v in pre.items():
+                if isinstance(v, Linear):
+                    groups.setdefault((v.channel, repr(v.index)), []).append((k, v))
+            groups = [([k for k, _ in g], _LinearGroup([v for _, v in g])) for g in groups.values()]
+            other = [(k, v) for k, v in pre.items() if not isinstance(v, Linear)]
+            def apply(observable):
+                x = {}
+                for keys, group in groups:
+                    x.update(zip(keys, group(observable)))
+                for k, v in other:
+                    x[k] = Agent._get_input(v, observable)
+                return x
+            return apply, [g for _, g in groups] or None
+        return pre, None
+
     def reset(self):
         """ Resets observable by resetting all agents. """
+        self.compile()
         self.observable = {}
         for agent in self.agents:
             o = agent.reset()
@@ -227,21 +475,232 @@ class Composite(Agent):
             for k, v in action.items():
                 self.observable[k] = v
                 
+        if self._plan is None:
+            self.compile()
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.begin_step()
+
         if self.order == 'concurrent':
             observable, reward, done, info = {}, 0, False, None
-            for agent in self.agents:
-                o, r, d, i = agent.step(self.observable)
-                for k, v in o.items():
-                    observable[k] = v
+            source = self.observable
                     
         if self.order == 'sequential':
             # initialize current step's output with previous step's output.
             observable, reward, done, info = dict(self.observable), 0, False, None
-            for agent in self.agents:
-                # agents receive latest outputs from all agents
-                o, r, d, i = agent.step(observable) 
-                for k, v in o.items():
-                    observable[k] = v
+            # agents receive latest outputs from all agents
+            source = observable
+
+        for step, out, pre, buffers, post in self._plan:
+            o = step(source if pre is None else pre(source))[0]
+            if buffers is not None and isinstance(o, np.ndarray) and \
+                    any(np.may_share_memory(o, g.buffer) for g in buffers):
+                # buffers are overwritten next step
+                o = np.array(o)
+            observable[out] = o if post is None else post(o)
             
         self.observable = observable
-        return observable, reward, done, info
\ No newline at end of file
+        if profiler is not None:
+            profiler.end_step(self._batch_size)
+        return observable, reward, done, info
+
+    def run(self, n_steps, record=None, every=1, callback=None, reset=True, reducers=None, stop=None):
+        """ Resets the composite and steps it n_steps times, writing selected
+        observables straight into preallocated (T, ...) arrays.
+
+        Equivalent to `[env.reset()] + [env.step()[0] for _ in range(n_steps)]`
+        followed by stacking the channels of interest, without keeping the
+        per-step dictionaries.
+
+        Args:
+            n_steps (int): number of steps.
+            record (list or dict): observables to record. A list of channel
+                names records these channels. A dict maps output names to
+                - a channel name,
+                - a tuple (channel, index): index selects along the last
+                  axis of the channel; a slice or list of indices is summed,
+                  e.g. ('model', slice(1, 6)) records I+D+A+R+T,
+                - a callable applied to the observable.
+                By default all channels are recorded, unless reducers are 
+                given, in which case nothing is recorded by default.
+            every (int): record the observable every k-th step. Step 0 (the
+                initial observable) is always recorded, hence
+                T = n_steps // every + 1.
+            callback (callable): called as callback(i) before step i, e.g.
+                to change agent parameters during the run.
+            reset (bool): reset before stepping. If False, the run continues
+                from the current observable.
+            reducers (dict): clds.reducers.Reducer instances updated at every
+                step (irrespective of `every`). Their results are returned
+                under their keys.
+            stop (dict): clds.reducers.StopCondition instances. Once any of
+                them is done for a batch member, its simulation is stopped:
+                agents supporting `set_active` (e.g. BatchSIDARTHE) no longer
+                integrate it, so that its state is frozen at its final value,
+                which is what later records and reducers observe. Once all 
+                members are stopped, no further steps are taken: the final 
+                observable fills the remaining records and is passed to 
+                Reducer.hold. The step at which each member was done is 
+                returned under the keys of stop.
+
+        Returns:
+            dict of np.array with shape (T, ...) per recorded output, and the
+            result of each reducer. Keys of record, reducers and stop must be
+            distinct.
+        """
+        observable = self.reset() if reset else self.observable
+        reducers = {} if reducers is None else reducers
+        stop = {} if stop is None else stop
+        assert not set(reducers) & set(stop), 'reducers and stop share keys'
+        reducers = dict(reducers, **stop)
+        reduced = {k: r.var for k, r in reducers.items()}
+        for k, x in self._select(observable, reduced).items():
+            reducers[k].reset(x, n_steps)
+        if record is None:
+            record = [] if reducers else list(observable.keys())
+        n_done = 0
+        if not isinstance(record, dict):
+            record = {k: k for k in record}
+        assert not set(record) & set(reducers), 'record and reducers (or stop) share keys'
+
+        n_records = n_steps // every + 1
+        # agents may return scalars on reset and batches on step, hence
+        # arrays are allocated once the first step has been recorded.
+        initial = {k: np.array(v) for k, v in self._select(observable, record).items()}
+        out = None
+        for i in range(n_steps):
+            if callback is not None:
+                callback(i)
+            observable = self.step()[0]
+            for k, x in self._select(observable, reduced).items():
+                reducers[k].update(i + 1, x)
+            if stop:
+                done = np.logical_or.reduce([s.done for s in stop.values()])
+                if done.sum() > n_done:
+                    n_done = done.sum()
+                    self.set_active(np.flatnonzero(~done))
+            if (i + 1) % every == 0:
+                values = self._select(observable, record)
+                if out is None:
+                    out = self._allocate(values, n_records)
+                    for k, v in initial.items():
+                        out[k][0] = v
+                for k, v in values.items():
+                    out[k][(i + 1) // every] = v
+            if stop and done.all() and i + 1 < n_steps:
+                # the observable stays constant for the remaining steps
+                for k, x in self._select(observable, reduced).items():
+                    reducers[k].hold(i + 2, n_steps + 1, x)
+                values = self._select(observable, record)
+                if out is None:
+                    out = self._allocate(values, n_records)
+                    for k, v in initial.items():
+                        out[k][0] = v
+                for k, v in values.items():
+                    out[k][(i + 1) // every + 1:] = v
+                break
+        if out is None:
+            out = self._allocate(initial, n_records)
+            for k, v in initial.items():
+                out[k][0] = v
+        for k, r in reducers.items():
+            out[k] = r.result()
+        return out
+
+    def set_active(self, idx):
+        """ Restricts simulation to batch members idx (all if None) in all 
+        agents supporting it. """
+        for agent in self.agents:
+            if hasattr(agent.agent, 'set_active'):
+                agent.agent.set_active(idx)
+
+    def get_state(self):
+        """ Returns a snapshot of the observable and of the dynamic state of 
+        all agents, see Agent.get_state. Together with `fork`, scenarios 
+        sharing a common prefix (e.g. FPSP cycles before switching_start) 
+        simulate it once:
+
+            prefix = sweep.fpsp_env(1, 1, batch_size=1)
+            prefix.run(49)
+            env = sweep.fpsp_env(steps_high, steps_low, batch_size=n)
+            env.fork(prefix.get_state())
+            out = env.run(730 - 49, reset=False)
+
+        Steps of the continued run are counted from the snapshot, e.g. the
+        start of reducers.
+        """
+        return {'observable': copy.deepcopy(self.observable),
+                'batch_size': self._batch_size,
+                'agents': [a.get_state() for a in self.agents]}
+
+    def set_state(self, state):
+        """ Restores a snapshot of `get_state` taken from this composite or 
+        one with the same agents and batch size. Parameters of the agents 
+        are kept, hence they may differ from those of the snapshot. """
+        assert len(state['agents']) == len(self.agents), 'snapshot of a different composite'
+        self.reset()
+        for agent, s in zip(self.agents, state['agents']):
+            agent.set_state(s)
+        self.observable = copy.deepcopy(state['observable'])
+        return self.observable
+
+    def fork_state(self, state, index=None):
+        """ Replicates batch members of a snapshot for the batch size of 
+        this composite, see Agent.fork_state.
+
+        Args:
+            state (dict): snapshot of `get_state`.
+            index (np.array): snapshot member continued by each member of this
+                composite, by default member 0 if the snapshot has a batch 
+                of one, otherwise the same member.
+
+        Returns:
+            snapshot to be restored by `set_state`.
+        """
+        assert len(state['agents']) == len(self.agents), 'snapshot of a different composite'
+        if self._plan is None:
+            self.compile()
+        if index is None:
+            index = np.zeros(self._batch_size, dtype=np.int64) if state['batch_size'] == 1 \
+                else np.arange(self._batch_size)
+        index = np.asarray(index)
+        # observables with a leading batch axis are replicated, others shared
+        observable = {k: v[index] if isinstance(v, np.ndarray) and v.ndim > 0 and v.shape[0] == state['batch_size']
+                      else copy.deepcopy(v) for k, v in state['observable'].items()}
+        return {'observable': observable,
+                'batch_size': index.shape[0],
+                'agents': [a.fork_state(s, index) for a, s in zip(self.agents, state['agents'])]}
+
+    def fork(self, state, index=None):
+        """ Continues the members of a snapshot with the parameters of this
+        composite, i.e. `set_state(fork_state(state, index))`. Call `run` 
+        with reset=False afterwards.
+
+        Returns:
+            the restored observable.
+        """
+        return self.set_state(self.fork_state(state, index))
+
+    @staticmethod
+    def _select(observable, record):
+        """ Evaluates the record specification of `run` on an observable. """
+        values = {}
+        for name, var in record.items():
+            if isinstance(var, tuple):
+                channel, index = var
+                x = np.asarray(observable[channel])[..., index]
+                values[name] = x if isinstance(index, (int, np.integer)) else np.sum(x, axis=-1)
+            else:
+                values[name] = Agent._get_input(var, observable)
+        return values
+
+    @staticmethod
+    def _allocate(values, n_records):
+        """ Allocates (n_records, ...) arrays matching the given values. 
+        Integer and boolean channels are recorded as floats. """
+        out = {}
+        for name, x in values.items():
+            x = np.asarray(x)
+            dtype = np.float64 if x.dtype.kind in 'biu' else x.dtype
+            out[name] = np.empty((n_records,) + x.shape, dtype=dtype)
+        return out
@@ -0,0 +1,302 @@
+""" Fused whole-horizon kernel of the FPSP + SIDARTHE (+ outer loop) wiring.
+
+`simulate` runs the composite of `clds.sweep.fpsp_env`, optionally with the
+supervisory outer loop, either step by step as a Composite of the batch
+agents ('numpy' backend) or as a single compiled kernel looping over batch
+members, days and integration substeps ('numba' backend). The kernel repeats
+the floating point operations of the agents in the same order, hence both
+backends agree bit for bit, unless the compiler contracts multiply-adds.
+
+Numba is optional: the 'auto' backend uses it when it is installed and falls
+back to the Composite otherwise. Compiled kernels are cached on disk (in
+__pycache__ next to this file, or in NUMBA_CACHE_DIR), so that only the first
+run on a machine pays for compilation.
+
+    from clds import fused
+    out = fused.simulate(730, steps_high=[1, 2], steps_low=[6, 5], batch_size=2, peak_start=50)
+"""
+import numpy as np
+
+from . import agents
+from . import reducers
+from .sweep import ALPHA, BETA, GAMMA, DELTA, fpsp_env
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# BatchSIDARTHE rates in the order of the kernel arguments
+RATES = ['epsilon', 'zeta', 'eta', 'theta', 'kappa', 'h', 'mu', 'nu', 'xi', 'rho', 'sigma', 'tau']
+DEFAULT_RATES = {'epsilon': 0.171, 'zeta': 0.125, 'eta': 0.125, 'theta': 0.371, 'kappa': 0.017,
+                 'h': 0.034, 'mu': 0.012, 'nu': 0.027, 'xi': 0.017, 'rho': 0.034, 'sigma': 0.017,
+                 'tau': 0.003}
+DEFAULT_OUTER_LOOP = {'period': 7, 'x_init': 1, 'x_min': 0, 'x_max': 7, 'alpha_x': 0.4, 'alpha_y': 0.0}
+
+
+def _jit(**options):
+    """ numba.njit with on-disk caching if numba is available, else no-op. """
+    if numba is None:
+        return lambda fn: fn
+    return numba.njit(cache=True, **options)
+
+
+prange = range if numba is None else numba.prange
+
+
+@_jit(inline='always')
+def _ode(S, I, D, A, R, T, a, b, g, d, N, epsilon, zeta, eta, theta, kappa, h, mu, nu, xi, rho,
+         sigma, tau, r_I, r_D, r_A, r_R, r_T):
+    """ Time derivative of one member, same arithmetic as BatchSIDARTHE._ode_inplace. """
+    newly_infected = S/N * (a*I + b*D + g*A + d*R)
+    return (-newly_infected,
+            newly_infected - r_I*I,
+            epsilon*I - r_D*D,
+            zeta*I - r_A*A,
+            eta*D + theta*A - r_R*R,
+            mu*A + nu*R - r_T*T,
+            h*I + rho*D + kappa*A + xi*R + sigma*T,
+            tau*T)
+
+
+@_jit(inline='always')
+def _fpsp(steps, beta_high, beta_low, steps_high, steps_low, suppression_start, switching_start):
+    """ BatchFPSP.beta of one member at step counter steps. """
+    if steps >= switching_start:
+        cycle_length = steps_high + steps_low
+        cycle_step = max(0, steps - switching_start)
+        if cycle_length != 0:
+            cycle_step = cycle_step % cycle_length
+        return beta_high if cycle_step < steps_high else beta_low
+    if steps >= suppression_start:
+        return beta_low
+    return beta_high
+
+
+@_jit(parallel=True)
+def _kernel(X0, contagion, N, rates, beta_high, beta_low, steps_high, steps_low,
+            suppression_start, switching_start, n_steps, n_substeps, rk4,
+            outer_loop, period, x_init, x_min, x_max, alpha_x, alpha_y,
+            peak_start, out_X, out_x, peak, peak_time):
+    """ Simulates all members over n_steps days. Policy parameters are
+    given per member.
+
+    Trajectories are written into out_X (n_steps+1, batch, 8) and duty cycles
+    into out_x (n_steps+1, batch) unless their first dimension is 0; the peak
+    of I+D+A+R+T from day peak_start (per member) and its day into peak and
+    peak_time.
+    """
+    h_ = 1/n_substeps
+    for m in prange(X0.shape[0]):
+        S, I, D, A, R, T, H, E = X0[m, 0], X0[m, 1], X0[m, 2], X0[m, 3], X0[m, 4], X0[m, 5], X0[m, 6], X0[m, 7]
+        a_, b_, g_, d_ = contagion[m, 0], contagion[m, 1], contagion[m, 2], contagion[m, 3]
+        N_ = N[m]
+        epsilon, zeta, eta, theta, kappa, h = rates[m, 0], rates[m, 1], rates[m, 2], rates[m, 3], rates[m, 4], rates[m, 5]
+        mu, nu, xi, rho, sigma, tau = rates[m, 6], rates[m, 7], rates[m, 8], rates[m, 9], rates[m, 10], rates[m, 11]
+        r_I = epsilon + zeta + h
+        r_D = eta + rho
+        r_A = theta + mu + kappa
+        r_R = nu + xi
+        r_T = sigma + tau
+        sh, sl = steps_high[m], steps_low[m]
+        t_suppression, t_switching = suppression_start[m], switching_start[m]
+        period_, x_min_, x_max_, alpha_x_, alpha_y_ = period[m], x_min[m], x_max[m], alpha_x[m], alpha_y[m]
+        x = x_init[m]
+        o_k = 0.
+        o_k1 = 0.
+        if out_X.shape[0] > 0:
+            out_X[0, m] = X0[m]
+        if out_x.shape[0] > 0:
+            out_x[0, m] = x
+        peak[m] = -np.inf
+        peak_time[m] = -1
+        peak_start_ = peak_start[m]
+        if peak_start_ <= 0:
+            peak[m] = (((I + D) + A) + R) + T
+            peak_time[m] = 0
+        u = beta_high[m] # FPSP output of the previous day, beta_high on reset
+        for day in range(1, n_steps + 1):
+            a, b, g, d = u*a_, u*b_, u*g_, u*d_
+            for _ in range(n_substeps):
+                if rk4:
+                    k1 = _ode(S, I, D, A, R, T, a, b, g, d, N_, epsilon, zeta, eta, theta, kappa, h,
+                              mu, nu, xi, rho, sigma, tau, r_I, r_D, r_A, r_R, r_T)
+                    k2 = _ode(k1[0]*(h_/2) + S, k1[1]*(h_/2) + I, k1[2]*(h_/2) + D, k1[3]*(h_/2) + A,
+                              k1[4]*(h_/2) + R, k1[5]*(h_/2) + T, a, b, g, d, N_, epsilon, zeta, eta,
+                              theta, kappa, h, mu, nu, xi, rho, sigma, tau, r_I, r_D, r_A, r_R, r_T)
+                    k3 = _ode(k2[0]*(h_/2) + S, k2[1]*(h_/2) + I, k2[2]*(h_/2) + D, k2[3]*(h_/2) + A,
+                              k2[4]*(h_/2) + R, k2[5]*(h_/2) + T, a, b, g, d, N_, epsilon, zeta, eta,
+                              theta, kappa, h, mu, nu, xi, rho, sigma, tau, r_I, r_D, r_A, r_R, r_T)
+                    k4 = _ode(k3[0]*h_ + S, k3[1]*h_ + I, k3[2]*h_ + D, k3[3]*h_ + A,
+                              k3[4]*h_ + R, k3[5]*h_ + T, a, b, g, d, N_, epsilon, zeta, eta,
+                              theta, kappa, h, mu, nu, xi, rho, sigma, tau, r_I, r_D, r_A, r_R, r_T)
+                    S = S + (k1[0] + (k2[0] + k3[0])*2 + k4[0])*(h_/6)
+                    I = I + (k1[1] + (k2[1] + k3[1])*2 + k4[1])*(h_/6)
+                    D = D + (k1[2] + (k2[2] + k3[2])*2 + k4[2])*(h_/6)
+                    A = A + (k1[3] + (k2[3] + k3[3])*2 + k4[3])*(h_/6)
+                    R = R + (k1[4] + (k2[4] + k3[4])*2 + k4[4])*(h_/6)
+                    T = T + (k1[5] + (k2[5] + k3[5])*2 + k4[5])*(h_/6)
+                    H = H + (k1[6] + (k2[6] + k3[6])*2 + k4[6])*(h_/6)
+                    E = E + (k1[7] + (k2[7] + k3[7])*2 + k4[7])*(h_/6)
+                else:
+                    dX = _ode(S, I, D, A, R, T, a, b, g, d, N_, epsilon, zeta, eta, theta, kappa, h,
+                              mu, nu, xi, rho, sigma, tau, r_I, r_D, r_A, r_R, r_T)
+                    S = S + dX[0]*h_
+                    I = I + dX[1]*h_
+                    D = D + dX[2]*h_
+                    A = A + dX[3]*h_
+                    R = R + dX[4]*h_
+                    T = T + dX[5]*h_
+                    H = H + dX[6]*h_
+                    E = E + dX[7]*h_
+
+            if outer_loop:
+                # BatchOuterLoopFPSP.step with step counter day-1, observing D+R
+                o_k += D + R
+                do_update_buffer = (day - 1 - t_switching) % period_ == 0
+                if do_update_buffer and day - 1 >= t_switching:
+                    if o_k < (1 - alpha_x_) * o_k1:
+                        x += 1
+                    if o_k > (1 + alpha_y_) * o_k1:
+                        x -= 1
+                x = x_min_ if x <= x_min_ else (x if x < x_max_ else x_max_)
+                if do_update_buffer:
+                    o_k1 = o_k
+                    o_k = 0.
+                sh, sl = x, x_max_ - x
+            u = _fpsp(day, beta_high[m], beta_low[m], sh, sl, t_suppression, t_switching)
+
+            if out_X.shape[0] > 0:
+                out_X[day, m, 0] = S
+                out_X[day, m, 1] = I
+                out_X[day, m, 2] = D
+                out_X[day, m, 3] = A
+                out_X[day, m, 4] = R
+                out_X[day, m, 5] = T
+                out_X[day, m, 6] = H
+                out_X[day, m, 7] = E
+            if out_x.shape[0] > 0:
+                out_x[day, m] = x
+            if day >= peak_start_:
+                infected = (((I + D) + A) + R) + T
+                if infected > peak[m]:
+                    peak[m] = infected
+                    peak_time[m] = day
+
+
+def available():
+    """ Whether the compiled backend can be used. """
+    return numba is not None
+
+
+def supported(integrator='rk4', dtype=np.float64, **kwargs):
+    """ Whether simulate's arguments can be run by the kernel: float64 'euler'
+    or 'rk4' integration with fixed rates given in kwargs. """
+    return (integrator in ('euler', 'rk4')
+            and np.dtype(dtype) == np.float64
+            and all(k in RATES and not isinstance(v, str) and not callable(v) for k, v in kwargs.items()))
+
+
+def simulate(n_steps,
+             steps_high=1,
+             steps_low=1,
+             batch_size=1,
+             N=1e7,
+             s0=None,
+             lockdown_effectiveness=0.175,
+             suppression_start=20,
+             switching_start=50,
+             alpha=ALPHA,
+             beta=BETA,
+             gamma=GAMMA,
+             delta=DELTA,
+             step_size=0.25,
+             integrator='rk4',
+             outer_loop=None,
+             record=True,
+             peak_start=None,
+             backend='auto',
+             **kwargs):
+    """ Runs fpsp_env for n_steps days.
+
+    Args:
+        n_steps (int): number of simulated days.
+        steps_high ... outer_loop: see clds.sweep.fpsp_env.
+        record (bool): return trajectories.
+        peak_start (int or np.array): if given, return the peak of infected 
+            I+D+A+R+T from this day on (per member), as reducers.Max.
+        backend (str): one of
+            'numpy': Composite.run of the batch agents.
+            'numba': compiled kernel, falls back to 'numpy' with a warning if
+                numba is not installed or the arguments are not supported.
+            'auto': 'numba' if available and supported, else 'numpy'.
+        kwargs: further BatchSIDARTHE parameters.
+
+    Returns:
+        dict with, if record, 'model' of shape (n_steps+1, batch, 8) and with
+        an outer loop 'duty_cycle' of shape (n_steps+1, batch), and if
+        peak_start is given 'peak', a dict with keys 'max' and 'argmax'.
+    """
+    assert backend in ('auto', 'numba', 'numpy'), backend
+    use_kernel = backend != 'numpy' and available() and supported(integrator, **kwargs)
+    if backend == 'numba' and not use_kernel:
+        print("Warning: numba backend {}, falling back to numpy".format(
+            'not supported for these arguments' if available() else 'not available'))
+
+    if not use_kernel:
+        env = fpsp_env(steps_high, steps_low, batch_size=batch_size, N=N, s0=s0,
+                       lockdown_effectiveness=lockdown_effectiveness,
+                       suppression_start=suppression_start, switching_start=switching_start,
+                       alpha=alpha, beta=beta, gamma=gamma, delta=delta,
+                       step_size=step_size, integrator=integrator, outer_loop=outer_loop, **kwargs)
+        record_ = {}
+        if record:
+            record_['model'] = 'model'
+            if outer_loop is not None:
+                record_['duty_cycle'] = ('outer', 0)
+        reducers_ = {} if peak_start is None else {'peak': reducers.Max(('model', slice(1, 6)), start=peak_start)}
+        return env.run(n_steps, record=record_, reducers=reducers_)
+
+    def batch(x, dtype=np.float64):
+        return np.ascontiguousarray(np.broadcast_to(np.asarray(x, dtype=dtype), (batch_size, )))
+
+    s0 = agents.sidarthe.initial_state(N) if s0 is None else s0
+    X0 = np.ascontiguousarray(np.broadcast_to(np.asarray(s0, dtype=np.float64), (batch_size, 8)))
+    rates = dict(DEFAULT_RATES, **kwargs)
+    ol = dict(DEFAULT_OUTER_LOOP, **({} if outer_loop is None else outer_loop))
+    n_records = n_steps + 1 if record else 0
+    out_X = np.empty((n_records, batch_size, 8))
+    out_x = np.empty((n_records if outer_loop is not None else 0, batch_size))
+    peak = np.empty(batch_size)
+    peak_time = np.empty(batch_size, dtype=np.int64)
+    _kernel(X0,
+            np.stack([batch(alpha), batch(beta), batch(gamma), batch(delta)], axis=1),
+            batch(N),
+            np.stack([batch(rates[k]) for k in RATES], axis=1),
+            batch(1.),
+            batch(lockdown_effectiveness),
+            batch(steps_high, np.int64),
+            batch(steps_low, np.int64),
+            batch(suppression_start, np.int64),
+            batch(switching_start, np.int64),
+            n_steps,
+            int(1/step_size),
+            integrator == 'rk4',
+            outer_loop is not None,
+            batch(ol['period'], np.int64),
+            batch(ol['x_init'], np.int64),
+            batch(ol['x_min'], np.int64),
+            batch(ol['x_max'], np.int64),
+            batch(ol['alpha_x']),
+            batch(ol['alpha_y']),
+            batch(-1 if peak_start is None else peak_start, np.int64),
+            out_X, out_x, peak, peak_time)
+
+    out = {}
+    if record:
+        out['model'] = out_X
+        if outer_loop is not None:
+            out['duty_cycle'] = out_x
+    if peak_start is not None:
+        out['peak'] = {'max': peak, 'argmax': peak_time}
+    return out
@@ -0,0 +1,49 @@
+""" Optional gym adapter.
+
+clds agents implement the gym.Env interface without depending on gym, so
+that `import clds` stays fast. Where a gym.Env instance is required, e.g. by
+gym wrappers or RL libraries, wrap the agent:
+
+    import clds.gym_env
+    env = clds.gym_env.GymEnv(agent)
+
+Importing this module imports gym.
+"""
+import gym
+
+
+class GymEnv(gym.Env):
+    """ gym.Env forwarding to a clds Agent.
+
+    Args:
+        agent (clds.Agent): wrapped agent. Its action_space,
+            observation_space, metadata, reward_range and spec are exposed.
+    """
+    def __init__(self, agent):
+        self.agent = agent
+        self.action_space = agent.action_space
+        self.observation_space = agent.observation_space
+        self.metadata = agent.metadata
+        self.reward_range = agent.reward_range
+        self.spec = agent.spec
+
+    def reset(self, **kwargs):
+        return self.agent.reset(**kwargs)
+
+    def step(self, action):
+        return self.agent.step(action)
+
+    def render(self, mode='human'):
+        return self.agent.render(mode=mode)
+
+    def close(self):
+        return self.agent.close()
+
+    def seed(self, seed=None):
+        return self.agent.seed(seed)
+
+    def __getattr__(self, name):
+        # attributes not defined by gym.Env, e.g. state or batch_size
+        if name == 'agent':
+            raise AttributeError(name)
+        return getattr(self.agent, name)
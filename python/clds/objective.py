@@ -0,0 +1,154 @@
+""" Batched evaluation of FPSP configurations for Bayesian optimization.
+
+A configuration is a dict with the parameters of the level curve experiments
+(notebook 04):
+
+    R0 (float): basic reproduction number without restrictions.
+    q (float): lockdown effectiveness, i.e. beta_low of FPSP.
+    d (float): compensatory behavior, beta_high = 1+d after suppression start.
+    period (int): FPSP period in weeks.
+    X (int): days of work per week.
+
+All configurations of a list are mapped to per-member parameters of a single
+BatchSIDARTHE + BatchFPSP composite and simulated in one vectorized run:
+
+    outcomes = clds.objective.evaluate([{'R0': 2.4, 'q': 0.175, 'd': 0., 'period': 1, 'X': 2},
+                                        {'R0': 3.1, 'q': 0.175, 'd': 0., 'period': 1, 'X': 4}])
+    # [{'peak_daily': (mean, sem)}, ...]
+
+With Ax, whole batch trials are evaluated at once with `trial_data`, e.g. a
+1000 point Sobol initialisation is a single simulation:
+
+    trial = exp.new_batch_trial(generator_run=sobol.gen(1000))
+    exp.attach_data(clds.objective.trial_data(trial))
+"""
+import numpy as np
+
+from . import reducers
+from .sweep import ALPHA, BETA, GAMMA, DELTA, fpsp_env
+
+# R0 of the contagion rates ALPHA, BETA, GAMMA, DELTA
+R0_BASE = 2.38461532
+
+SUPPRESSION_START = 20
+SWITCHING_START = 50
+
+
+def parameters(configs):
+    """ Maps configurations to per-member arrays of fpsp_env arguments.
+
+    Args:
+        configs (list): configurations, see module documentation.
+
+    Returns:
+        dict of np.array with keys alpha, beta, gamma, delta,
+        lockdown_effectiveness, compensation, steps_high and steps_low.
+    """
+    R0 = np.array([c['R0'] for c in configs], dtype=np.float64)
+    correction = R0 / R0_BASE
+    period = [c['period'] * 7 for c in configs]
+    # duty cycle rounded down as in the notebooks
+    duty_cycle = np.array([int(c['X']/7*p) for c, p in zip(configs, period)])
+    return {'alpha': ALPHA * correction,
+            'beta': BETA * correction,
+            'gamma': GAMMA * correction,
+            'delta': DELTA * correction,
+            'lockdown_effectiveness': np.array([c['q'] for c in configs], dtype=np.float64),
+            'compensation': np.array([c.get('d', 0.) for c in configs], dtype=np.float64),
+            'steps_high': duty_cycle,
+            'steps_low': np.array(period) - duty_cycle}
+
+
+def evaluate(configs, n_steps=365, N=1e7, peak_start=SWITCHING_START,
+             step_size=0.001, integrator='euler', max_batch=None):
+    """ Outcome metrics of a list of configurations.
+
+    Args:
+        configs (list): configurations, see module documentation.
+        n_steps (int): number of simulated days.
+        N (float): population size.
+        peak_start (int): first day considered for the peak.
+        step_size (float), integrator (str): see BatchSIDARTHE. The defaults
+            reproduce the notebooks; integrator='rk4' with step_size=0.25
+            agrees to ~0.2% at a fraction of the cost.
+        max_batch (int): maximum number of configurations per simulation,
+            by default all of them.
+
+    Returns:
+        list of dicts {'peak_daily': (mean, sem)}, the peak of daily
+        infected (I+D+A+R+T) in % of the population from peak_start onwards,
+        aligned with configs.
+    """
+    peak = outcomes(configs, n_steps, N, peak_start, step_size, integrator, max_batch)['peak_daily']
+    return [{'peak_daily': (p, 0.0)} for p in peak]
+
+
+def outcomes(configs, n_steps=365, N=1e7, peak_start=SWITCHING_START,
+             step_size=0.001, integrator='euler', max_batch=None):
+    """ Outcome arrays of a list of configurations, see evaluate.
+
+    Returns:
+        dict with keys 'peak_daily' (see evaluate) and 'peak_time' (day of
+        the peak) of np.array aligned with configs.
+    """
+    configs = list(configs)
+    max_batch = max(1, len(configs)) if max_batch is None else max_batch
+    out = {'peak_daily': np.empty(len(configs)), 'peak_time': np.empty(len(configs))}
+    for i in range(0, len(configs), max_batch):
+        idx = slice(i, i + max_batch)
+        peak = _peak(configs[idx], n_steps, N, peak_start, step_size, integrator)
+        out['peak_daily'][idx] = peak['max'] / N * 100
+        out['peak_time'][idx] = peak['argmax']
+    return out
+
+
+def _peak(configs, n_steps, N, peak_start, step_size, integrator):
+    p = parameters(configs)
+    compensation = p.pop('compensation')
+    env = fpsp_env(batch_size=len(configs),
+                   N=N,
+                   suppression_start=SUPPRESSION_START,
+                   switching_start=SWITCHING_START,
+                   step_size=step_size,
+                   integrator=integrator,
+                   **p)
+    fpsp = env.agents[1].agent
+
+    def callback(i):
+        if i > SUPPRESSION_START:
+            fpsp.beta_high = 1 + compensation
+
+    out = env.run(n_steps, callback=callback, reducers={
+        'peak': reducers.Max(('model', slice(1, 6)), start=peak_start)})
+    return out['peak']
+
+
+def eval_fn(params):
+    """ Single configuration evaluation function, e.g. for ax.SimpleExperiment. """
+    return evaluate([params])[0]
+
+
+def trial_data(trial, metric_name='peak_daily', **kwargs):
+    """ Evaluates all arms of an Ax (batch) trial in one simulation.
+
+    Args:
+        trial (ax.BaseTrial): trial whose arms are configurations.
+        metric_name (str): name of the outcome metric.
+        kwargs: see evaluate.
+
+    Returns:
+        ax.Data, to be attached to the experiment with `attach_data`. The
+        trial is marked completed.
+    """
+    import ax
+    import pandas as pd
+
+    arms = list(trial.arms_by_name.items())
+    outcomes = evaluate([arm.parameters for _, arm in arms], **kwargs)
+    trial.mark_running(no_runner_required=True)
+    trial.mark_completed()
+    return ax.Data(df=pd.DataFrame([{'arm_name': name,
+                                     'metric_name': metric_name,
+                                     'mean': o[metric_name][0],
+                                     'sem': o[metric_name][1],
+                                     'trial_index': trial.index} for (name, _), o in zip(arms, outcomes)]))
@@ -0,0 +1,158 @@
+""" Sharded execution of large batches on a pool of worker processes.
+
+A batch of batch_size simulations is split into shards of consecutive
+members. Each shard is simulated by a worker with `Composite.run`, and its
+recorded channels and reducer results are written into
+`multiprocessing.shared_memory` arrays allocated by the parent, so that no
+trajectories are pickled back.
+
+Example:
+
+    def make_env(idx):
+        # Composite simulating batch members idx (a slice) of the full batch
+        return clds.sweep.fpsp_env(steps_high[idx], steps_low[idx],
+                                   batch_size=idx.stop-idx.start)
+
+    with clds.parallel.ShardedExecutor(n_workers=8) as ex:
+        out = ex.run(make_env, batch_size=10000, n_steps=365,
+                     record={'infected': ('model', slice(1, 6))})
+
+make_env has to be picklable, i.e. defined at module level or a
+functools.partial of such a function.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class ShardedExecutor:
+    """ Pool of warm worker processes running shards of a batch.
+
+    Args:
+        n_workers (int): number of processes, by default os.cpu_count().
+        shard_size (int): number of batch members per shard. Results do not
+            depend on the number of workers, since shards and their seeds
+            depend on shard_size only. By default batches are split into
+            n_workers shards.
+        mp_context (str): start method of the workers, by default that of 
+            the platform. Forked workers hang once compiled parallel kernels
+            (e.g. clds.fused with numba) have started threads in the parent, 
+            use 'forkserver' or 'spawn' then.
+    """
+    def __init__(self, n_workers=None, shard_size=None, mp_context=None):
+        self.n_workers = os.cpu_count() if n_workers is None else n_workers
+        self.shard_size = shard_size
+        context = None if mp_context is None else multiprocessing.get_context(mp_context)
+        self.pool = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=context)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown()
+
+    def run(self, make_env, batch_size, n_steps, record=None, reducers=None, every=1, seed=0):
+        """ Simulates batch_size members in shards.
+
+        Args:
+            make_env (callable): make_env(idx) returns the Composite simulating
+                batch members idx (a slice).
+            batch_size (int): total number of batch members.
+            n_steps, record, every: see Composite.run. Recorded channels must
+                have the batch along axis 0.
+            reducers (callable): returns a dict of fresh reducers (see
+                Composite.run) for a shard. Reducer results must have the
+                batch along axis 0 (e.g. Max, Sum, FirstCrossing).
+            seed (int): root seed. Each shard seeds np.random with its own
+                seed spawned from it before make_env is called.
+
+        Returns:
+            dict of np.array as returned by Composite.run for the full batch;
+            dict valued reducer results are flattened to 'name.key'.
+        """
+        shard_size = self.shard_size
+        if shard_size is None:
+            shard_size = -(-batch_size // self.n_workers)
+        shards = [slice(i, min(i + shard_size, batch_size)) for i in range(0, batch_size, shard_size)]
+        seeds = [s.generate_state(1)[0] for s in np.random.SeedSequence(seed).spawn(len(shards))]
+
+        # probe output shapes on a single member, in a worker so that the
+        # caller's global random state is left untouched
+        probe = self.pool.submit(_run_shard, make_env, slice(0, 1), min(n_steps, every), record, reducers,
+                                 every, seeds[0]).result()
+        n_records = n_steps // every + 1
+        reduced = set() if reducers is None else set(reducers())
+        layout = {}
+        for k, v in probe.items():
+            if k.split('.', 1)[0] in reduced:
+                layout[k] = ((batch_size, ) + v.shape[1:], v.dtype, 0)
+            else:
+                layout[k] = ((n_records, batch_size) + v.shape[2:], v.dtype, 1)
+
+        blocks = {}
+        try:
+            for k, (shape, dtype, _) in layout.items():
+                size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                blocks[k] = shared_memory.SharedMemory(create=True, size=size)
+            targets = {k: (blocks[k].name, ) + layout[k] for k in layout}
+            futures = [self.pool.submit(_shard_worker, make_env, idx, n_steps, record, reducers, every, s, targets)
+                       for idx, s in zip(shards, seeds)]
+            for f in futures:
+                f.result()
+            out = {}
+            for k, (shape, dtype, _) in layout.items():
+                out[k] = np.array(np.ndarray(shape, dtype=dtype, buffer=blocks[k].buf))
+        finally:
+            for b in blocks.values():
+                b.close()
+                b.unlink()
+        return out
+
+
+def run_sharded(make_env, batch_size, n_steps, n_workers=None, shard_size=None, mp_context=None, **kwargs):
+    """ Runs a single sharded simulation on a temporary ShardedExecutor. """
+    with ShardedExecutor(n_workers=n_workers, shard_size=shard_size, mp_context=mp_context) as ex:
+        return ex.run(make_env, batch_size, n_steps, **kwargs)
+
+
+def _flatten(out):
+    flat = {}
+    for k, v in out.items():
+        if isinstance(v, dict):
+            for k_, v_ in v.items():
+                flat['{}.{}'.format(k, k_)] = v_
+        else:
+            flat[k] = v
+    return flat
+
+
+def _run_shard(make_env, idx, n_steps, record, reducers, every, seed):
+    np.random.seed(seed)
+    env = make_env(idx)
+    out = env.run(n_steps,
+                  record=record,
+                  every=every,
+                  reducers=None if reducers is None else reducers())
+    return {k: np.asarray(v) for k, v in _flatten(out).items()}
+
+
+def _shard_worker(make_env, idx, n_steps, record, reducers, every, seed, targets):
+    """ Runs a shard and writes its results into shared memory. """
+    out = _run_shard(make_env, idx, n_steps, record, reducers, every, seed)
+    for k, (name, shape, dtype, axis) in targets.items():
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            target = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            if axis == 0:
+                target[idx] = out[k]
+            else:
+                target[:, idx] = out[k]
+            del target
+        finally:
+            block.close()
@@ -0,0 +1,147 @@
+""" Low-overhead instrumentation of Composite simulations.
+
+Profiling is switched on and off at runtime with `Composite.profile`. While
+it is off, the execution plan of the composite calls agents and transforms
+directly, so that it costs nothing. While it is on, the plan calls them
+through timing wrappers:
+
+    profiler = env.profile()
+    env.run(365)
+    print(profiler.report())
+    profiler.to_json('profile.json')
+    env.profile(False)
+
+Recorded per entry (agents' step, pre and post transforms, watched methods,
+Composite bookkeeping): wall time and call counts, and for agents with an
+`n_evals` counter (e.g. BatchSIDARTHE) the number of ode evaluations. Per
+step: wall time, batch throughput in member-days per second and, with
+memory=True, the peak bytes allocated during a step (via tracemalloc, which
+slows down the simulation noticeably).
+"""
+import json
+import time
+import tracemalloc
+
+
+class Profiler:
+    """ Wall time, call and ode evaluation counts per named entry.
+
+    Args:
+        memory (bool): trace bytes allocated per step with tracemalloc.
+    """
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.clear()
+
+    def clear(self):
+        """ Discards all measurements. """
+        self.stats = {} # name -> [calls, seconds, ode evaluations]
+        self.steps = 0
+        self.member_steps = 0
+        self.seconds = 0.
+        self.bytes = 0
+        self.max_bytes = 0
+        self._watched = []
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def timed(self, fn, name, agent=None):
+        """ Wraps fn so that its calls are timed under name. If agent is given,
+        ode evaluations made during calls are counted from its n_evals 
+        attribute, if any. """
+        stat = self.stats.setdefault(name, [0, 0., 0])
+        if agent is not None:
+            def wrapper(*args, **kwargs):
+                n = getattr(agent, 'n_evals', 0)
+                t = time.perf_counter()
+                y = fn(*args, **kwargs)
+                stat[1] += time.perf_counter() - t
+                stat[0] += 1
+                stat[2] += getattr(agent, 'n_evals', 0) - n
+                return y
+        else:
+            def wrapper(*args, **kwargs):
+                t = time.perf_counter()
+                y = fn(*args, **kwargs)
+                stat[1] += time.perf_counter() - t
+                stat[0] += 1
+                return y
+        return wrapper
+
+    def watch(self, obj, method, name=None):
+        """ Times calls of obj.method, e.g. watch(model, 'euler_step'), until
+        `unwatch` is called. Only calls through the instance are timed. """
+        name = '{}.{}'.format(type(obj).__name__, method) if name is None else name
+        setattr(obj, method, self.timed(getattr(obj, method), name, agent=obj))
+        self._watched.append((obj, method))
+
+    def unwatch(self):
+        """ Restores watched methods. """
+        for obj, method in self._watched:
+            delattr(obj, method)
+        self._watched = []
+
+    def begin_step(self):
+        if self.memory:
+            tracemalloc.reset_peak()
+            self._memory = tracemalloc.get_traced_memory()[0]
+        self._t = time.perf_counter()
+
+    def end_step(self, batch_size):
+        self.seconds += time.perf_counter() - self._t
+        self.steps += 1
+        self.member_steps += batch_size
+        if self.memory:
+            allocated = tracemalloc.get_traced_memory()[1] - self._memory
+            self.bytes += allocated
+            self.max_bytes = max(self.max_bytes, allocated)
+
+    def to_dict(self):
+        """ Measurements as a dict of plain Python types. """
+        entries = {name: {'calls': calls,
+                          'seconds': seconds,
+                          'us_per_call': seconds / calls * 1e6 if calls else 0.,
+                          'ode_evals': evals}
+                   for name, (calls, seconds, evals) in self.stats.items()}
+        # time spent in Composite.step outside of agents and transforms
+        children = sum(s for name, (_, s, _) in self.stats.items() if '/' in name)
+        entries['Composite.step (bookkeeping)'] = {'calls': self.steps,
+                                                   'seconds': max(0., self.seconds - children),
+                                                   'us_per_call': max(0., self.seconds - children) / max(1, self.steps) * 1e6,
+                                                   'ode_evals': 0}
+        return {'steps': self.steps,
+                'seconds': self.seconds,
+                'member_days_per_second': self.member_steps / self.seconds if self.seconds else 0.,
+                'bytes_per_step': self.bytes / self.steps if self.memory and self.steps else None,
+                'max_bytes_per_step': self.max_bytes if self.memory else None,
+                'entries': entries}
+
+    def to_json(self, filename=None):
+        """ Returns the measurements as JSON, written to filename if given. """
+        s = json.dumps(self.to_dict(), indent=2)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(s)
+        return s
+
+    def report(self):
+        """ Text report of entries sorted by total time. """
+        d = self.to_dict()
+        lines = ['{} steps in {:.3f} s, {:.4g} member-days/s'.format(
+            d['steps'], d['seconds'], d['member_days_per_second'])]
+        if d['bytes_per_step'] is not None:
+            lines.append('allocated per step: {:.0f} bytes (max {} bytes)'.format(
+                d['bytes_per_step'], d['max_bytes_per_step']))
+        lines.append('{:<40} {:>10} {:>10} {:>12} {:>7} {:>12}'.format(
+            'entry', 'calls', 'seconds', 'us/call', '%step', 'ode evals'))
+        for name, e in sorted(d['entries'].items(), key=lambda x: -x[1]['seconds']):
+            lines.append('{:<40} {:>10} {:>10.4f} {:>12.2f} {:>7.1f} {:>12}'.format(
+                name, e['calls'], e['seconds'], e['us_per_call'],
+                100 * e['seconds'] / d['seconds'] if d['seconds'] else 0., e['ode_evals']))
+        return '\n'.join(lines)
@@ -0,0 +1,380 @@
+import numpy as np
+
+
+class Reducer:
+    """ Online summary of an observable, updated once per step of a
+    `Composite.run` in O(batch) memory.
+
+    Args:
+        var: observable to reduce, specified as in the `record` argument of
+            `Composite.run`, i.e. a channel name, a tuple (channel, index) or
+            a callable applied to the observable.
+
+    The main methods are:
+        reset: called with the initial observable value and the number of steps.
+        update: called with the step index (1..n_steps) and the observable value.
+        hold: called with a range of steps over which the observable is 
+            constant, e.g. once all members of a run are stopped.
+        result: returns the summary.
+    """
+    def __init__(self, var):
+        self.var = var
+
+    def reset(self, x, n_steps):
+        raise NotImplementedError
+
+    def update(self, t, x):
+        raise NotImplementedError
+
+    def hold(self, t_start, t_stop, x):
+        """ Updates with the same observable x at steps t_start..t_stop-1. 
+        Reducers override it where a single update suffices. """
+        for t in range(t_start, t_stop):
+            self.update(t, x)
+
+    def result(self):
+        raise NotImplementedError
+
+
+class Max(Reducer):
+    """ Running maximum and the step at which it is first attained, e.g.
+    peak and peak time of the number of infected.
+
+    Args:
+        var: observable, see Reducer.
+        start (int or np.array): first step taken into account, per batch
+            member if an array.
+    """
+    def __init__(self, var, start=0):
+        super().__init__(var)
+        self.start = start
+
+    def reset(self, x, n_steps):
+        x = np.asarray(x, dtype=np.float64)
+        self.max = np.full(x.shape, -np.inf)
+        self.argmax = np.full(x.shape, -1)
+        self.update(0, x)
+
+    def update(self, t, x):
+        if np.ndim(self.start) > 0:
+            is_max = (x > self.max) & (t >= self.start)
+        elif t < self.start:
+            return
+        else:
+            is_max = x > self.max
+        np.copyto(self.max, x, where=is_max)
+        np.copyto(self.argmax, t, where=is_max)
+
+    def hold(self, t_start, t_stop, x):
+        # the first step taken into account is the only one that can set the max
+        t = np.maximum(t_start, self.start)
+        is_max = (x > self.max) & (t < t_stop)
+        np.copyto(self.max, x, where=is_max)
+        np.copyto(self.argmax, t, where=is_max)
+
+    def result(self):
+        return {'max': self.max, 'argmax': self.argmax}
+
+
+class PeakSensitivity(Reducer):
+    """ Peak of a sum of compartments of a BatchSIDARTHE with forward
+    sensitivities, and the gradients of peak and peak time w.r.t. the
+    model's sensitivity parameters, e.g. of infected (I+D+A+R+T).
+
+    The peak time is refined by the vertex of the parabola through the
+    maximum and its neighbouring steps, so that it is differentiable.
+
+    Args:
+        model (BatchSIDARTHE): model with sensitivities.
+        channel (str): output channel of the model.
+        index (slice or list): summed compartments.
+        start (int): first step taken into account.
+
+    Result keys: 'max', 'argmax' (as Max), 'grad_max' (batch, parameters), 
+    'peak_time' (interpolated) and 'grad_peak_time' (batch, parameters).
+    """
+    def __init__(self, model, channel='model', index=slice(1, 6), start=0):
+        super().__init__((channel, index))
+        self.model = model
+        self.channel = channel
+        self.index = index
+        self.start = start
+
+    def _grad(self):
+        return self.model.sensitivity[:, self.index].sum(axis=1)
+
+    def reset(self, x, n_steps):
+        x = np.asarray(x, dtype=np.float64)
+        g = self._grad()
+        self.max = np.full(x.shape, -np.inf)
+        self.argmax = np.full(x.shape, -1)
+        # values and gradients before (left), at (center) and after (right) the maximum
+        self.left, self.right = np.full(x.shape, np.nan), np.full(x.shape, np.nan)
+        self.grad_left, self.grad, self.grad_right = [np.full(g.shape, np.nan) for _ in range(3)]
+        self.prev, self.grad_prev = np.full(x.shape, np.nan), np.full(g.shape, np.nan)
+        self.update(0, x)
+
+    def update(self, t, x):
+        g = self._grad()
+        if t >= self.start:
+            is_right = self.argmax == t - 1
+            np.copyto(self.right, x, where=is_right)
+            np.copyto(self.grad_right, g, where=is_right[:,None])
+            is_max = x > self.max
+            np.copyto(self.max, x, where=is_max)
+            np.copyto(self.argmax, t, where=is_max)
+            np.copyto(self.left, self.prev, where=is_max)
+            np.copyto(self.right, np.nan, where=is_max)
+            np.copyto(self.grad_left, self.grad_prev, where=is_max[:,None])
+            np.copyto(self.grad, g, where=is_max[:,None])
+            np.copyto(self.grad_right, np.nan, where=is_max[:,None])
+        self.prev = np.array(x, dtype=np.float64)
+        self.grad_prev = np.array(g, dtype=np.float64)
+
+    def result(self):
+        # vertex offset d = (a-c) / (2(a-2b+c)) of the parabola through a, b, c
+        a, b, c = self.left, self.max, self.right
+        da, db, dc = self.grad_left, self.grad, self.grad_right
+        den = a - 2*b + c
+        valid = np.isfinite(den) & (den < 0)
+        den = np.where(valid, den, -1.)
+        offset = np.where(valid, 0.5*(a - c)/den, 0.)
+        dden = da - 2*db + dc
+        grad_offset = 0.5*((da - dc)*den[:,None] - (a - c)[:,None]*dden)/den[:,None]**2
+        grad_offset = np.where(valid[:,None], grad_offset, 0.)
+        return {'max': self.max, 
+                'argmax': self.argmax, 
+                'grad_max': self.grad,
+                'peak_time': self.argmax + offset, 
+                'grad_peak_time': grad_offset}
+
+
+class Sum(Reducer):
+    """ Cumulative total of an observable over steps.
+
+    Args:
+        var: observable, see Reducer.
+        start (int): first step taken into account.
+    """
+    def __init__(self, var, start=0):
+        super().__init__(var)
+        self.start = start
+
+    def reset(self, x, n_steps):
+        self.total = np.zeros(np.shape(x))
+        self.update(0, x)
+
+    def update(self, t, x):
+        if t >= self.start:
+            self.total += x
+
+    def hold(self, t_start, t_stop, x):
+        self.total += max(0, t_stop - max(t_start, self.start)) * np.asarray(x)
+
+    def result(self):
+        return self.total
+
+
+class FirstCrossing(Reducer):
+    """ First step at which an observable crosses a threshold, -1 if it never
+    does.
+
+    Args:
+        var: observable, see Reducer.
+        threshold (float or np.array): threshold (per batch member).
+        above (bool): detect x >= threshold if True, x <= threshold otherwise.
+        start (int): first step taken into account.
+    """
+    def __init__(self, var, threshold, above=True, start=0):
+        super().__init__(var)
+        self.threshold = threshold
+        self.above = above
+        self.start = start
+
+    def reset(self, x, n_steps):
+        self.step = np.full(np.shape(x), -1)
+        self.update(0, x)
+
+    def update(self, t, x):
+        if t < self.start:
+            return
+        crossed = (x >= self.threshold) if self.above else (x <= self.threshold)
+        np.copyto(self.step, t, where=crossed & (self.step < 0))
+
+    def hold(self, t_start, t_stop, x):
+        t = max(t_start, self.start)
+        if t < t_stop:
+            self.update(t, x)
+
+    def result(self):
+        return self.step
+
+
+class Quantiles(Reducer):
+    """ Exact quantiles across the batch (axis 0) at every step.
+
+    Args:
+        var: observable, see Reducer.
+        q (list): quantiles, e.g. [0.5, 0.75, 0.95].
+
+    Result has shape (n_steps+1, len(q)) + var.shape[1:].
+    """
+    def __init__(self, var, q):
+        super().__init__(var)
+        self.q = np.asarray(q)
+
+    def reset(self, x, n_steps):
+        x = np.asarray(x)
+        self.stats = np.empty((n_steps+1, ) + self.q.shape + x.shape[1:])
+        self.update(0, x)
+
+    def update(self, t, x):
+        self.stats[t] = np.quantile(x, self.q, axis=0)
+
+    def hold(self, t_start, t_stop, x):
+        self.stats[t_start:t_stop] = np.quantile(x, self.q, axis=0)
+
+    def result(self):
+        return self.stats
+
+
+class HistogramQuantiles(Reducer):
+    """ Approximate per-step quantiles across the batch from fixed-bin
+    histograms.
+
+    Unlike Quantiles, histograms of several runs (e.g. chunks of an ensemble
+    too large to simulate at once) can be combined with `merge`, so that
+    quantiles of the whole ensemble are obtained in one pass. Quantiles are
+    interpolated linearly within bins, so that the error is bounded by the bin
+    width.
+
+    Args:
+        var: observable of shape (batch, ), see Reducer.
+        q (list): quantiles, e.g. [0.5, 0.75, 0.95].
+        bins (np.array): increasing bin edges. By default 1000 log-spaced
+            edges between 1e-2 and 1e8 (relative resolution ~2.3%), suitable
+            for compartment sizes.
+    """
+    def __init__(self, var, q, bins=None):
+        super().__init__(var)
+        self.q = np.asarray(q)
+        self.bins = np.logspace(-2, 8, 1000) if bins is None else np.asarray(bins)
+
+    def reset(self, x, n_steps):
+        self.counts = np.zeros((n_steps+1, self.bins.shape[0]+1), dtype=np.int64)
+        self.update(0, x)
+
+    def update(self, t, x):
+        idx = np.searchsorted(self.bins, x)
+        self.counts[t] += np.bincount(idx, minlength=self.bins.shape[0]+1)
+
+    def hold(self, t_start, t_stop, x):
+        idx = np.searchsorted(self.bins, x)
+        self.counts[t_start:t_stop] += np.bincount(idx, minlength=self.bins.shape[0]+1)
+
+    def merge(self, other):
+        """ Adds the histograms of another HistogramQuantiles with equal bins. """
+        assert (self.bins == other.bins).all()
+        self.counts += other.counts
+        return self
+
+    def result(self):
+        cum = np.cumsum(self.counts, axis=1)
+        total = cum[:,-1:]
+        # bin j spans [edges[j-1], edges[j]), under/overflow bins are clamped
+        edges = np.concatenate([self.bins[:1], self.bins, self.bins[-1:]])
+        stats = np.empty((self.counts.shape[0], self.q.shape[0]))
+        for i, q in enumerate(self.q):
+            j = np.argmax(cum >= q*total, axis=1)
+            c_hi = cum[np.arange(cum.shape[0]), j]
+            c_lo = c_hi - self.counts[np.arange(cum.shape[0]), j]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                frac = np.where(c_hi > c_lo, (q*total[:,0] - c_lo)/(c_hi - c_lo), 0.)
+            stats[:,i] = edges[j] + frac * (edges[j+1] - edges[j])
+        return stats
+
+
+class StopCondition(Reducer):
+    """ Per-member stop condition of `Composite.run`.
+
+    Besides the Reducer interface, stop conditions expose `done`, a boolean
+    array marking batch members whose simulation can be stopped. The result is
+    the step at which each member was first done, -1 if never.
+    """
+    def reset(self, x, n_steps):
+        self.done = np.zeros(np.shape(x), dtype=bool)
+        self.step = np.full(np.shape(x), -1)
+        self.update(0, x)
+
+    def update(self, t, x):
+        done = self.is_done(t, x)
+        np.copyto(self.step, t, where=done & ~self.done)
+        self.done |= done
+
+    def is_done(self, t, x):
+        raise NotImplementedError
+
+    def hold(self, t_start, t_stop, x):
+        # held once all members are done, which no update changes
+        if not self.done.all():
+            super().hold(t_start, t_stop, x)
+
+    def result(self):
+        return self.step
+
+
+class Below(StopCondition):
+    """ Done once the observable falls below a threshold, e.g. infected < 1.
+
+    Args:
+        var: observable, see Reducer.
+        threshold (float or np.array): threshold (per batch member).
+        start (int): first step taken into account.
+    """
+    def __init__(self, var, threshold, start=0):
+        super().__init__(var)
+        self.threshold = threshold
+        self.start = start
+
+    def is_done(self, t, x):
+        return (t >= self.start) & (np.asarray(x) < self.threshold)
+
+
+class PeakConfirmed(StopCondition):
+    """ Done once the observable has fallen to a fraction of its running
+    maximum, i.e. its peak has been passed unambiguously.
+
+    Args:
+        var: observable, see Reducer.
+        fraction (float): fraction of the running maximum.
+        start (int): first step taken into account.
+    """
+    def __init__(self, var, fraction=0.5, start=0):
+        super().__init__(var)
+        self.fraction = fraction
+        self.start = start
+
+    def reset(self, x, n_steps):
+        self.max = np.full(np.shape(x), -np.inf)
+        super().reset(x, n_steps)
+
+    def is_done(self, t, x):
+        if t < self.start:
+            return np.zeros(self.done.shape, dtype=bool)
+        np.maximum(self.max, x, out=self.max)
+        return x <= self.fraction * self.max
+
+
+class Predicate(StopCondition):
+    """ Done where a user predicate holds.
+
+    Args:
+        var: observable, see Reducer.
+        fn (callable): fn(t, x) returns a boolean array.
+    """
+    def __init__(self, var, fn):
+        super().__init__(var)
+        self.fn = fn
+
+    def is_done(self, t, x):
+        return np.asarray(self.fn(t, x), dtype=bool)
@@ -0,0 +1,276 @@
+""" Chunked on-disk trajectory store with random access.
+
+A store is a folder holding
+
+    store.json                  number of members and parameter names
+    params/<name>.npy           per member parameters, e.g. steps_high
+    <channel>/<start>_<stop>.npy  trajectories of members start..stop-1 of
+                                a channel, shape (T, stop-start, ...)
+
+Chunks are written incrementally while a Composite runs, by a reducer that
+writes each step into a memory-mapped .npy file, so that trajectories never
+have to fit into memory. All files are plain .npy files opened as memmaps
+when reading, hence a member, time window or compartment within a chunk is
+read zero-copy:
+
+    store = clds.store.create('results/trajectories', params={'steps_high': sh, 'steps_low': sl})
+    for idx in chunks:
+        env = clds.sweep.fpsp_env(sh[idx], sl[idx], batch_size=idx.stop-idx.start)
+        env.run(730, reducers={'model': store.writer('model', idx)})
+
+    store = clds.store.TrajectoryStore('results/trajectories')
+    m = store.find(steps_high=1, steps_low=6)[0]
+    infected = store.read('model', m, t=slice(50, 200), index=slice(1, 6)).sum(axis=-1)
+
+Trajectories of the MATLAB simulations (e.g. data/figure_3_timeseries.mat)
+are converted once with `from_mat`.
+"""
+import bisect
+import json
+import os
+
+import numpy as np
+
+from .reducers import Reducer
+
+VERSION = 1
+
+
+def create(path, params=None, n_members=None):
+    """ Creates an empty store.
+
+    Args:
+        path (str): folder of the store, created if needed.
+        params (dict): per member parameters, np.array of shape (n_members, ).
+        n_members (int): number of members, by default the length of params.
+
+    Returns:
+        TrajectoryStore opened for writing.
+    """
+    params = {} if params is None else {k: np.asarray(v) for k, v in params.items()}
+    if n_members is None:
+        assert params, 'n_members or params are required'
+        n_members = len(next(iter(params.values())))
+    for k, v in params.items():
+        assert v.shape[0] == n_members, (k, v.shape, n_members)
+
+    os.makedirs(os.path.join(path, 'params'), exist_ok=True)
+    for k, v in params.items():
+        np.save(os.path.join(path, 'params', k + '.npy'), v)
+    with open(os.path.join(path, 'store.json'), 'w') as f:
+        json.dump({'version': VERSION, 'n_members': int(n_members), 'params': sorted(params)}, f, indent=2)
+    return TrajectoryStore(path, mode='r+')
+
+
+class TrajectoryStore:
+    """ Random access to a store created by `create` or `from_mat`.
+
+    Args:
+        path (str): folder of the store.
+        mode (str): 'r' to read, 'r+' to also write chunks.
+
+    Attributes:
+        n_members (int): number of members.
+        params (dict): per member parameters, memory-mapped.
+    """
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, 'store.json')) as f:
+            meta = json.load(f)
+        assert meta['version'] == VERSION, meta['version']
+        self.n_members = meta['n_members']
+        self.params = {k: np.load(os.path.join(path, 'params', k + '.npy'), mmap_mode='r')
+                       for k in meta['params']}
+        self._chunks = {}
+
+    @property
+    def channels(self):
+        """ Names of channels with at least one written chunk. """
+        return sorted(k for k in os.listdir(self.path)
+                      if k != 'params' and os.path.isdir(os.path.join(self.path, k)) and self._list(k))
+
+    def _list(self, channel):
+        """ Sorted (start, stop, filename) of the complete chunks of a channel. """
+        folder = os.path.join(self.path, channel)
+        chunks = []
+        for filename in os.listdir(folder):
+            name, ext = os.path.splitext(filename)
+            if ext == '.npy':
+                start, stop = map(int, name.split('_'))
+                chunks.append((start, stop, os.path.join(folder, filename)))
+        return sorted(chunks)
+
+    def refresh(self):
+        """ Forgets opened chunks, e.g. after chunks were written by other processes. """
+        self._chunks = {}
+
+    def chunks(self, channel):
+        """ Sorted list of (start, stop, memmap) of a channel. """
+        if channel not in self._chunks:
+            self._chunks[channel] = [(start, stop, np.load(filename, mmap_mode='r'))
+                                     for start, stop, filename in self._list(channel)]
+        return self._chunks[channel]
+
+    def find(self, **conditions):
+        """ Indices of members whose parameters equal the given values. """
+        mask = np.ones(self.n_members, dtype=bool)
+        for k, v in conditions.items():
+            mask &= self.params[k] == v
+        return np.flatnonzero(mask)
+
+    def member(self, i):
+        """ Parameters of member i. """
+        return {k: v[i] for k, v in self.params.items()}
+
+    def read(self, channel, members, t=slice(None), index=None):
+        """ Trajectories of members of a channel.
+
+        Args:
+            channel (str): channel name.
+            members (int, slice or array of int): member indices. An int or a
+                slice within one chunk returns a memmap view (zero-copy),
+                otherwise the selected members are copied.
+            t (int, slice or array): time steps.
+            index: index along the last dimension, e.g. slice(1, 6), None
+                for all.
+
+        Returns:
+            np.array of shape (T, ...) for a single member and (T, members, ...)
+            otherwise, with T and ... selected by t and index.
+        """
+        chunks = self.chunks(channel)
+        starts = [c[0] for c in chunks]
+        if isinstance(members, (int, np.integer)):
+            start, stop, x = self._find_chunk(chunks, starts, members)
+            return self._index(x[t, members - start], index)
+        if isinstance(members, slice):
+            first, last, step = members.indices(self.n_members)
+            start, stop, x = self._find_chunk(chunks, starts, first)
+            if last <= stop:
+                return self._index(x[t, first-start:last-start:step], index)
+            members = np.arange(first, last, step)
+        members = np.asarray(members)
+        out = []
+        for m in members:
+            start, stop, x = self._find_chunk(chunks, starts, m)
+            out.append(self._index(x[t, m - start], index))
+        return np.stack(out, axis=0 if isinstance(t, (int, np.integer)) else 1)
+
+    @staticmethod
+    def _index(x, index):
+        return x if index is None else x[..., index]
+
+    def _find_chunk(self, chunks, starts, m):
+        i = bisect.bisect_right(starts, m) - 1
+        if i < 0 or m >= chunks[i][1]:
+            raise KeyError('member {} has not been written'.format(m))
+        return chunks[i]
+
+    def writer(self, channel, members, var=None, every=1):
+        """ Reducer writing a channel of a Composite run into a new chunk.
+
+        Args:
+            channel (str): channel name in the store.
+            members (slice): members start..stop-1 simulated by the run.
+            var: observable to write, see Reducer, by default the channel of
+                the same name.
+            every (int): write every k-th step, as in Composite.run.
+        """
+        assert self.mode == 'r+', 'store opened read-only'
+        return StoreWriter(self, channel, members, channel if var is None else var, every)
+
+
+class StoreWriter(Reducer):
+    """ Writes an observable at every step of a Composite run into a chunk
+    file of a TrajectoryStore, see TrajectoryStore.writer.
+
+    The chunk is written as <start>_<stop>.npy.partial and renamed once the
+    run has finished, so that interrupted runs leave no incomplete chunks.
+    """
+    def __init__(self, store, channel, members, var, every=1):
+        super().__init__(var)
+        assert isinstance(members, slice) and members.step in (None, 1), members
+        self.store = store
+        self.channel = channel
+        self.members = members
+        self.start, self.stop, _ = members.indices(store.n_members)
+        self.every = every
+        self.filename = os.path.join(store.path, channel, '{:012d}_{:012d}.npy'.format(self.start, self.stop))
+        self.out = None
+
+    def reset(self, x, n_steps):
+        x = np.asarray(x)
+        assert x.shape[0] == self.stop - self.start, (x.shape, self.start, self.stop)
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        dtype = np.float64 if x.dtype.kind in 'biu' else x.dtype
+        self.out = np.lib.format.open_memmap(self.filename + '.partial', mode='w+', dtype=dtype,
+                                             shape=(n_steps // self.every + 1, ) + x.shape)
+        self.out[0] = x
+
+    def update(self, t, x):
+        if t % self.every == 0:
+            self.out[t // self.every] = x
+
+    def hold(self, t_start, t_stop, x):
+        self.out[-(-t_start // self.every):(t_stop - 1) // self.every + 1] = x
+
+    def result(self):
+        self.out.flush()
+        del self.out
+        self.out = None
+        os.replace(self.filename + '.partial', self.filename)
+        self.store.refresh()
+        return self.filename
+
+
+def from_mat(mat_file, path, var='TimeSeries', param_names=('steps_high', 'steps_low'), chunk_size=1024):
+    """ Converts MATLAB trajectories into a store, once.
+
+    The variable var of the .mat file is a cell array with a row per
+    simulation holding its parameters, a time vector and a (time, columns)
+    state matrix, e.g. {x, y, ts, ys} in data/figure_3_timeseries.mat. Time
+    grids of the MATLAB solver differ between simulations, hence trajectories
+    are padded with NaN to the longest one and the number of valid samples is
+    stored as parameter 'length'.
+
+    Args:
+        mat_file (str): .mat file (up to version 7.2, read by scipy.io).
+        path (str): folder of the new store.
+        var (str): name of the cell array.
+        param_names (tuple): names of the leading scalar entries of each row.
+        chunk_size (int): members per chunk.
+
+    Returns:
+        TrajectoryStore with channels 'time' (T, n) and 'state' (T, n, columns).
+    """
+    import scipy.io as scio
+    rows = scio.loadmat(mat_file, variable_names=[var])[var]
+    n = rows.shape[0]
+    k = len(param_names)
+    params = {name: np.array([np.asarray(rows[i][j]).reshape(-1)[0] for i in range(n)])
+              for j, name in enumerate(param_names)}
+    params['length'] = np.array([np.asarray(rows[i][k]).size for i in range(n)])
+    n_columns = np.asarray(rows[0][k+1]).shape[1]
+    T = int(params['length'].max())
+
+    store = create(path, params=params)
+    for channel in ['time', 'state']:
+        os.makedirs(os.path.join(path, channel), exist_ok=True)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        name = '{:012d}_{:012d}.npy'.format(start, stop)
+        time = np.lib.format.open_memmap(os.path.join(path, 'time', name), mode='w+', shape=(T, stop-start))
+        state = np.lib.format.open_memmap(os.path.join(path, 'state', name), mode='w+',
+                                          shape=(T, stop-start, n_columns))
+        time[...] = np.nan
+        state[...] = np.nan
+        for i in range(start, stop):
+            length = params['length'][i]
+            time[:length, i-start] = np.asarray(rows[i][k]).reshape(-1)
+            state[:length, i-start] = rows[i][k+1]
+        time.flush()
+        state.flush()
+        del time, state
+    store.refresh()
+    return store
@@ -0,0 +1,326 @@
+""" Vectorized sweeps over FPSP cycle lengths.
+
+A whole grid of (steps_high, steps_low) policies is packed into batches of a
+single BatchSIDARTHE + BatchFPSP composite, chunked to a memory budget, and
+reduced on the fly to the peak of infected (I+D+A+R+T) and its time.
+
+The peak table of Figure 3 is regenerated from the `python/` folder with
+
+    python -m clds.sweep --max-high 112 --max-low 112 --out results/figure_3
+
+Results are written chunk by chunk to the output folder, so that an
+interrupted sweep resumes where it stopped when the command is repeated.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from .core import Composite, Lambda, Linear
+from . import agents
+from . import reducers
+
+# contagion rates of the notebooks, modulated by the policy
+ALPHA = 0.570
+BETA = 0.011
+GAMMA = 0.456
+DELTA = 0.011
+
+# estimated working memory per batch member in bytes (state and integrator
+# buffers, policy and reducer arrays, temporaries).
+BYTES_PER_MEMBER = 1024
+
+
+def fpsp_env(steps_high,
+             steps_low,
+             batch_size=1,
+             N=1e7,
+             s0=None,
+             lockdown_effectiveness=0.175,
+             suppression_start=20,
+             switching_start=50,
+             alpha=ALPHA,
+             beta=BETA,
+             gamma=GAMMA,
+             delta=DELTA,
+             step_size=0.25,
+             integrator='rk4',
+             dtype=np.float64,
+             outer_loop=None,
+             sensitivities=None,
+             extrapolate=False,
+             **kwargs):
+    """ SIDARTHE model controlled by FPSP, wired as in the notebooks.
+
+    Args:
+        steps_high, steps_low (int or np.array): FPSP cycle (per batch member).
+        batch_size (int): number of simulations.
+        N (float): population size.
+        s0 (np.array): initial state, by default sidarthe.initial_state(N).
+        lockdown_effectiveness (float or np.array): beta_low of the policy.
+        suppression_start, switching_start (int or np.array): FPSP phases.
+        alpha, beta, gamma, delta (float or np.array): contagion rates
+            without restrictions.
+        step_size (float), integrator (str): see BatchSIDARTHE.
+        dtype (np.dtype): precision of model state and policy output, see
+            BatchSIDARTHE.
+        outer_loop (dict): if given, the FPSP duty cycle is set by a 
+            supervisory BatchOuterLoopFPSP starting at switching_start, with
+            these parameters (period, x_init, x_min, x_max, alpha_x, alpha_y,
+            each a number or np.array per batch member), observing the 
+            detected infected D+R. steps_high and steps_low are then ignored.
+        sensitivities (list of str): parameters whose forward sensitivities
+            are integrated by the model, see BatchSIDARTHE.sensitivity:
+            'lockdown_effectiveness', 'contagion' (a common relative scale of
+            alpha..delta at 1, i.e. d/d log R0) or rates epsilon..tau. The
+            FPSP cycle lengths are integers, hence not differentiable.
+        extrapolate (bool): extrapolate settled FPSP cycles of the model
+            instead of integrating them, see the period argument of
+            BatchSIDARTHE. Not supported with an outer loop.
+        kwargs: further BatchSIDARTHE parameters.
+
+    Returns:
+        Composite with output channels 'model' and 'fpsp', and with an outer
+        loop also 'o' (observed D+R) and 'outer' (duty cycle x, x_max-x).
+        With sensitivity 'lockdown_effectiveness' also 'dfpsp', the
+        derivative of the FPSP output w.r.t. lockdown_effectiveness.
+    """
+    s0 = agents.sidarthe.initial_state(N) if s0 is None else s0
+    sensitivities = [] if sensitivities is None else list(sensitivities)
+    pre = {'a': Linear('fpsp', scale=alpha),
+           'b': Linear('fpsp', scale=beta),
+           'g': Linear('fpsp', scale=gamma),
+           'd': Linear('fpsp', scale=delta)}
+    input_sensitivities = {}
+    if 'contagion' in sensitivities:
+        input_sensitivities['contagion'] = ('a', 'b', 'g', 'd')
+    if 'lockdown_effectiveness' in sensitivities:
+        input_sensitivities['lockdown_effectiveness'] = ('da/dq', 'db/dq', 'dg/dq', 'dd/dq')
+        pre.update({'da/dq': Linear('dfpsp', scale=alpha),
+                    'db/dq': Linear('dfpsp', scale=beta),
+                    'dg/dq': Linear('dfpsp', scale=gamma),
+                    'dd/dq': Linear('dfpsp', scale=delta)})
+    if sensitivities:
+        kwargs = dict(kwargs, sensitivities=sensitivities, input_sensitivities=input_sensitivities)
+    if extrapolate:
+        assert outer_loop is None, 'the outer loop changes the FPSP cycle'
+        kwargs = dict(kwargs, period=np.add(steps_high, steps_low), period_start=switching_start)
+    model = agents.BatchSIDARTHE(s0=s0,
+                                 alpha='a',
+                                 beta='b',
+                                 gamma='g',
+                                 delta='d',
+                                 N=N,
+                                 batch_size=batch_size,
+                                 step_size=step_size,
+                                 integrator=integrator,
+                                 dtype=dtype,
+                                 **kwargs)
+    schedule = dict(steps_high=steps_high if outer_loop is None else 'x',
+                    steps_low=steps_low if outer_loop is None else 'y',
+                    suppression_start=suppression_start,
+                    switching_start=switching_start,
+                    batch_size=batch_size,
+                    dtype=dtype)
+    fpsp = agents.BatchFPSP(beta_high=1, beta_low=lockdown_effectiveness, **schedule)
+    # derivative of the FPSP output w.r.t. beta_low: 1 where restrictions apply
+    dfpsp = agents.BatchFPSP(beta_high=0, beta_low=1, **schedule) \
+        if 'lockdown_effectiveness' in sensitivities else None
+
+    env = Composite(order='concurrent' if outer_loop is None else 'sequential')
+    env.add(model, pre=pre, out='model')
+    if outer_loop is None:
+        env.add(fpsp, out='fpsp')
+        if dfpsp is not None:
+            env.add(dfpsp, out='dfpsp')
+        return env
+
+    env.add(Lambda(reset_fn=lambda: 0, step_fn=lambda x: x['model'][:,2] + x['model'][:,4]), out='o')
+    env.add(agents.BatchOuterLoopFPSP(start=switching_start, o='o', batch_size=batch_size, **outer_loop),
+            out='outer')
+    env.add(fpsp, out='fpsp', pre=lambda x: {'x': x['outer'][:,0], 'y': x['outer'][:,1]})
+    if dfpsp is not None:
+        env.add(dfpsp, out='dfpsp', pre=lambda x: {'x': x['outer'][:,0], 'y': x['outer'][:,1]})
+    return env
+
+
+def chunk_size(max_memory=2**28):
+    """ Number of batch members that fit in max_memory bytes. """
+    return max(1, int(max_memory // BYTES_PER_MEMBER))
+
+
+def fpsp_sweep(steps_high, steps_low, n_steps=730, peak_start=None,
+               max_batch=None, max_memory=2**28, backend='numpy', share_prefix=True, **kwargs):
+    """ Peak and peak time of infected (I+D+A+R+T) for each FPSP cycle.
+
+    Args:
+        steps_high, steps_low (np.array): cycles to simulate.
+        n_steps (int): number of simulated days.
+        peak_start (int or np.array): first day considered for the peak, by 
+            default the switching start (per member).
+        max_batch (int): maximum batch size, by default derived from
+            max_memory.
+        max_memory (int): memory budget in bytes.
+        backend (str): 'numpy', 'numba' or 'auto', see clds.fused.simulate.
+        share_prefix (bool): with the numpy backend, simulate the days before
+            switching_start, which all cycles share, once and fork all 
+            batches from it, see Composite.fork. Ignored with an outer loop
+            or per-member kwargs, whose prefixes differ.
+        kwargs: see fpsp_env. Arrays with one entry per cycle, e.g. 
+            switching_start or outer_loop parameters, are given per member 
+            and split into batches with the cycles.
+
+    Returns:
+        dict with keys 'peak' and 'peak_time' of np.array aligned with the
+        inputs.
+    """
+    steps_high = np.asarray(steps_high).reshape(-1)
+    steps_low = np.asarray(steps_low).reshape(-1)
+    assert steps_high.shape == steps_low.shape
+    if peak_start is None:
+        peak_start = kwargs.get('switching_start', 50)
+    max_batch = chunk_size(max_memory) if max_batch is None else max_batch
+
+    # FPSP outputs of the first switching_start-1 steps do not depend on the
+    # cycle, and the peak is reduced from peak_start on. Members share them 
+    # only if all other parameters are shared, see _members.
+    prefix, snapshot = 0, None
+    is_scalar = all(np.ndim(v) == 0 or (k == 's0' and np.ndim(v) < 2)
+                    for k, v in kwargs.items() if k != 'sensitivities')
+    if backend == 'numpy' and share_prefix and is_scalar and kwargs.get('outer_loop') is None:
+        prefix = max(0, min(np.min(kwargs.get('switching_start', 50)) - 1, np.min(peak_start), n_steps))
+    if prefix > 0:
+        env = fpsp_env(steps_high[:1], steps_low[:1], batch_size=1, **kwargs)
+        env.run(prefix, record=[])
+        snapshot = env.get_state()
+
+    peak = np.empty(steps_high.shape[0])
+    peak_time = np.empty(steps_high.shape[0], dtype=np.int64)
+    for i in range(0, steps_high.shape[0], max_batch):
+        idx = slice(i, i + max_batch)
+        batch_size = steps_high[idx].shape[0]
+        batch_kwargs = _members(kwargs, idx, steps_high.shape[0])
+        batch_peak_start = _members({'peak_start': peak_start}, idx, steps_high.shape[0])['peak_start']
+        if backend == 'numpy':
+            env = fpsp_env(steps_high[idx], steps_low[idx], batch_size=batch_size, **batch_kwargs)
+            if snapshot is not None:
+                env.fork(snapshot)
+            out = env.run(n_steps - prefix, reset=snapshot is None, reducers={
+                'peak': reducers.Max(('model', slice(1, 6)), start=batch_peak_start - prefix)})
+            out['peak']['argmax'] += prefix
+        else:
+            from . import fused
+            out = fused.simulate(n_steps, steps_high[idx], steps_low[idx], batch_size=batch_size,
+                                 record=False, peak_start=batch_peak_start, backend=backend, **batch_kwargs)
+        peak[idx] = out['peak']['max']
+        peak_time[idx] = out['peak']['argmax']
+    return {'peak': peak, 'peak_time': peak_time}
+
+
+def _members(kwargs, idx, n):
+    """ kwargs of the members idx of n: arrays with an entry per member 
+    (also within dicts, e.g. outer_loop) are sliced, other values shared. 
+    sensitivities are names, and s0 is per member only if 2-dimensional. """
+    out = {}
+    for k, v in kwargs.items():
+        if isinstance(v, dict):
+            out[k] = _members(v, idx, n)
+        elif k == 'sensitivities' or (k == 's0' and np.ndim(v) < 2) or \
+                np.ndim(v) == 0 or np.shape(v)[0] != n:
+            out[k] = v
+        else:
+            out[k] = np.asarray(v)[idx]
+    return out
+
+
+def grid(max_high, max_low, min_high=0, min_low=0):
+    """ All (steps_high, steps_low) pairs of a grid, except (0, 0). """
+    steps_high, steps_low = np.meshgrid(np.arange(min_high, max_high+1),
+                                        np.arange(min_low, max_low+1),
+                                        indexing='ij')
+    steps_high, steps_low = steps_high.reshape(-1), steps_low.reshape(-1)
+    keep = (steps_high + steps_low) > 0
+    return steps_high[keep], steps_low[keep]
+
+
+def _save(filename, **arrays):
+    """ Atomically writes arrays to filename (.npz). """
+    tmp = filename + '.tmp.npz'
+    np.savez(tmp, **arrays)
+    os.replace(tmp, filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', required=True, help='output folder')
+    parser.add_argument('--max-high', type=int, default=112)
+    parser.add_argument('--max-low', type=int, default=112)
+    parser.add_argument('--min-high', type=int, default=0)
+    parser.add_argument('--min-low', type=int, default=0)
+    parser.add_argument('--n-steps', type=int, default=730)
+    parser.add_argument('--q', type=float, default=0.175, help='lockdown effectiveness')
+    parser.add_argument('--suppression-start', type=int, default=20)
+    parser.add_argument('--switching-start', type=int, default=50)
+    parser.add_argument('--step-size', type=float, default=0.25)
+    parser.add_argument('--integrator', default='rk4', choices=sorted(agents.BatchSIDARTHE.integrators))
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'],
+                        help='precision of the simulation state')
+    parser.add_argument('--backend', default='auto', choices=['auto', 'numba', 'numpy'],
+                        help='fused numba kernel or numpy composite, see clds.fused')
+    parser.add_argument('--max-memory', type=int, default=2**28, help='memory budget in bytes')
+    parser.add_argument('--mat', action='store_true', help='also write peaks.mat (requires scipy)')
+    args = parser.parse_args(argv)
+
+    config = {k: v for k, v in vars(args).items() if k not in ('out', 'max_memory', 'mat', 'backend')}
+    max_batch = chunk_size(args.max_memory)
+    config['max_batch'] = max_batch
+
+    os.makedirs(args.out, exist_ok=True)
+    config_file = os.path.join(args.out, 'config.json')
+    if os.path.exists(config_file):
+        with open(config_file) as f:
+            if json.load(f) != config:
+                parser.error('{} contains a sweep with a different configuration'.format(args.out))
+    else:
+        with open(config_file, 'w') as f:
+            json.dump(config, f, indent=2)
+
+    steps_high, steps_low = grid(args.max_high, args.max_low, args.min_high, args.min_low)
+    n_chunks = (steps_high.shape[0] + max_batch - 1) // max_batch
+    for c in range(n_chunks):
+        filename = os.path.join(args.out, 'chunk_{:05d}.npz'.format(c))
+        if os.path.exists(filename):
+            continue
+        print('chunk {}/{}'.format(c+1, n_chunks), flush=True)
+        idx = slice(c*max_batch, (c+1)*max_batch)
+        result = fpsp_sweep(steps_high[idx],
+                            steps_low[idx],
+                            n_steps=args.n_steps,
+                            max_batch=max_batch,
+                            lockdown_effectiveness=args.q,
+                            suppression_start=args.suppression_start,
+                            switching_start=args.switching_start,
+                            step_size=args.step_size,
+                            integrator=args.integrator,
+                            dtype=np.dtype(args.dtype),
+                            backend=args.backend)
+        _save(filename, steps_high=steps_high[idx], steps_low=steps_low[idx], **result)
+
+    # assemble peak tables indexed by [steps_high, steps_low] as in data/figure_3_peaks.mat
+    peak = np.full((args.max_high+1, args.max_low+1), np.nan)
+    peak_time = np.full((args.max_high+1, args.max_low+1), np.nan)
+    for c in range(n_chunks):
+        with np.load(os.path.join(args.out, 'chunk_{:05d}.npz'.format(c))) as f:
+            peak[f['steps_high'], f['steps_low']] = f['peak']
+            peak_time[f['steps_high'], f['steps_low']] = f['peak_time']
+    _save(os.path.join(args.out, 'peaks.npz'), peak=peak, peakTime=peak_time)
+    if args.mat:
+        import scipy.io as scio
+        scio.savemat(os.path.join(args.out, 'peaks.mat'), {'peak': peak, 'peakTime': peak_time})
+    print('written', os.path.join(args.out, 'peaks.npz'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+import numpy as np
+
+from clds import cache, sweep
+
+
+def test_key_of_default_fpsp_env():
+    assert cache.key(sweep.fpsp_env(1, 6)) == cache.key(sweep.fpsp_env(1, 6))
+    assert cache.key(sweep.fpsp_env(1, 6)) != cache.key(sweep.fpsp_env(1, 6, dtype=np.float32))
+
+
+def test_cached_run_of_fpsp_env(tmp_path):
+    c = cache.Cache(str(tmp_path))
+    first = c.run(sweep.fpsp_env(1, 6), 60, record=['model'])
+    second = c.run(sweep.fpsp_env(1, 6), 60, record=['model'])
+    np.testing.assert_array_equal(first['model'], second['model'])
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_cached_run_continuing_from_current_state(tmp_path):
+    c = cache.Cache(str(tmp_path))
+    env = sweep.fpsp_env(1, 6)
+    env.run(10)
+    first = c.run(env, 5, reset=False, record=['model'])
+    env.run(30, reset=False)
+    second = c.run(env, 5, reset=False, record=['model'])
+    assert not np.array_equal(first['model'], second['model'])
+    expected = sweep.fpsp_env(1, 6).run(50, record=['model'])['model'][45:]
+    np.testing.assert_array_equal(second['model'], expected)
+
+
+def test_key_of_reducers_ignores_their_state():
+    from clds import reducers
+    peak = reducers.Max(('model', slice(1, 6)), start=50)
+    before = cache.key(peak)
+    sweep.fpsp_env(1, 6).run(60, reducers={'peak': peak})
+    assert cache.key(peak) == before == cache.key(reducers.Max(('model', slice(1, 6)), start=50))
+    assert before != cache.key(reducers.Max(('model', slice(1, 6)), start=40))
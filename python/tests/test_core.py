@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from clds import reducers, sweep
+
+
+def test_run_rejects_shared_output_keys():
+    env = sweep.fpsp_env(1, 6)
+    with pytest.raises(AssertionError):
+        env.run(10, record=['model'], reducers={'model': reducers.Max(('model', 1))})
+    with pytest.raises(AssertionError):
+        env.run(10, reducers={'s': reducers.Max(('model', 1))}, stop={'s': reducers.Below(('model', 1), 1.)})
+    out = env.run(10, record=['model'], reducers={'peak': reducers.Max(('model', 1))})
+    assert out['model'].shape == (11, 1, 8)
+
+
+def test_run_stops_once_all_members_are_done(monkeypatch, tmp_path):
+    from clds import store
+
+    def run(env, default_hold):
+        if default_hold:
+            for cls in (reducers.Max, reducers.Sum, reducers.FirstCrossing, reducers.Quantiles,
+                        reducers.HistogramQuantiles, reducers.StopCondition, store.StoreWriter):
+                monkeypatch.setattr(cls, 'hold', reducers.Reducer.hold)
+        steps = []
+        s = store.create(str(tmp_path / str(default_hold)), n_members=3)
+        out = env.run(300, every=7, callback=steps.append, record={'I': ('model', 1)},
+                      reducers={'max': reducers.Max(('model', 1), start=np.array([0, 100, 250])),
+                                'sum': reducers.Sum(('model', 1), start=20),
+                                'cross': reducers.FirstCrossing(('model', 1), 1e3, above=False, start=280),
+                                'q': reducers.Quantiles(('model', 1), [.5]),
+                                'hq': reducers.HistogramQuantiles(('model', 1), [.5]),
+                                'store': s.writer('model', slice(0, 3), every=7)},
+                      stop={'peak': reducers.PeakConfirmed(('model', slice(1, 6)), 0.5, start=60)})
+        out['store'] = np.load(out['store'])
+        monkeypatch.undo()
+        return out, len(steps)
+
+    env = sweep.fpsp_env(np.array([1, 0, 2]), np.array([6, 7, 5]), batch_size=3)
+    out, n = run(env, False)
+    expected, n_expected = run(env, True)
+    assert n < 300 and n == n_expected
+    np.testing.assert_array_equal(out['peak'], expected['peak'])
+    np.testing.assert_array_equal(out['I'], expected['I'])
+    np.testing.assert_array_equal(out['I'][n // 7 + 1:], out['I'][n // 7 + 1:][:1].repeat(len(out['I']) - n // 7 - 1, 0))
+    for k in ('max', 'cross', 'q', 'hq', 'store'):
+        for a, b in zip(np.atleast_1d(out[k]) if not isinstance(out[k], dict) else out[k].values(),
+                        np.atleast_1d(expected[k]) if not isinstance(expected[k], dict) else expected[k].values()):
+            np.testing.assert_array_equal(a, b)
+    np.testing.assert_allclose(out['sum'], expected['sum'], rtol=1e-12)
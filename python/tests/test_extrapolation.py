@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from clds import sweep
+
+# (steps_high, steps_low) of FPSP policies whose infections decay
+STEPS_HIGH = np.array([2, 1, 1, 3, 1, 2, 4, 7, 13, 5])
+STEPS_LOW = np.array([5, 1, 3, 4, 6, 2, 10, 7, 9, 14])
+
+
+def infected(n_steps, **kwargs):
+    env = sweep.fpsp_env(STEPS_HIGH, STEPS_LOW, batch_size=STEPS_HIGH.shape[0], **kwargs)
+    out = env.run(n_steps, record={'infected': ('model', slice(1, 6))})
+    return out['infected'], env.agents[0].agent
+
+
+@pytest.mark.parametrize('period_rtol', [1e-4, 1e-3])
+def test_extrapolation_error_against_full_integration(period_rtol):
+    ref, _ = infected(730)
+    out, model = infected(730, extrapolate=True, period_rtol=period_rtol)
+    assert model.n_extrapolated > 0.1 * ref.size
+    # period_rtol holds per extrapolation, errors of successive ones add up
+    error = np.abs(out / ref - 1).max(axis=0)
+    np.testing.assert_array_less(error, 2 * period_rtol * np.maximum(model.n_extrapolations, 1))
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from clds import fused
+
+numba = pytest.importorskip('numba')
+
+
+@pytest.mark.parametrize('integrator', ['euler', 'rk4'])
+@pytest.mark.parametrize('outer_loop', [None, dict(period=np.array([7, 5, 3, 7]), alpha_x=0.3)])
+def test_compiled_kernel_matches_numpy(integrator, outer_loop):
+    kwargs = dict(steps_high=np.array([0, 1, 3, 5]), steps_low=np.array([4, 6, 2, 5]), batch_size=4,
+                  switching_start=np.array([40, 50, 60, 45]), integrator=integrator,
+                  step_size=0.25 if integrator == 'rk4' else 0.1, outer_loop=outer_loop, peak_start=30)
+    compiled = fused.simulate(200, backend='numba', **kwargs)
+    expected = fused.simulate(200, backend='numpy', **kwargs)
+    np.testing.assert_array_equal(compiled['model'], expected['model'])
+    np.testing.assert_array_equal(compiled['peak']['argmax'], expected['peak']['argmax'])
+    if outer_loop is not None:
+        np.testing.assert_array_equal(compiled['duty_cycle'], expected['duty_cycle'])
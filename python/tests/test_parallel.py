@@ -0,0 +1,25 @@
+import functools
+
+import numpy as np
+
+from clds import parallel, reducers, sweep
+
+
+def make_env(idx, steps_high):
+    return sweep.fpsp_env(steps_high[idx], 5, batch_size=idx.stop - idx.start, round_state=True)
+
+
+def peak():
+    return {'peak': reducers.Max(('model', slice(1, 6)))}
+
+
+def test_run_sharded_keeps_global_random_state():
+    np.random.seed(7)
+    expected = np.random.rand()
+    np.random.seed(7)
+    make = functools.partial(make_env, steps_high=np.arange(4))
+    # forkserver: other tests may have started numba threads in this process
+    out = parallel.run_sharded(make, 4, 30, n_workers=2, mp_context='forkserver',
+                               record={'I': ('model', 1)}, reducers=peak)
+    assert np.random.rand() == expected
+    assert out['I'].shape == (31, 4) and out['peak.max'].shape == (4, )
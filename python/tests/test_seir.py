@@ -0,0 +1,39 @@
+import numpy as np
+
+from clds import agents
+
+
+def linear_serial_seir(ei, ir, N, e0, i0, R0, n_steps):
+    """ SerialSEIR before circular buffers, with schedules of length n_steps + support. """
+    survival_ir = 1 - np.cumsum(ir)
+    psi = survival_ir / survival_ir.sum()
+    n_contacts = np.zeros(n_steps + psi.shape[0] + 1)
+    e2i_ = np.zeros(n_steps + ei.shape[0] + 1)
+    i2r_ = np.zeros(n_steps + ir.shape[0] + 1)
+    s, e, i, r = N - e0 - i0, e0, i0, 0
+    n_contacts[:psi.shape[0]] = i * psi
+    i2r_[:ir.shape[0]] = i * ir
+    e2i_[1:1+ei.shape[0]] = e * ei
+    out = []
+    for t in range(1, n_steps + 1):
+        s2e = n_contacts[t-1] * s/N * R0
+        e2i_[t:t+ei.shape[0]] += s2e * ei
+        e2i = e2i_[t]
+        n_contacts[t:t+psi.shape[0]] += e2i * psi
+        i2r_[t:t+ir.shape[0]] += e2i * ir
+        i2r = i2r_[t]
+        s, e, i, r = s - s2e, e + s2e - e2i, i + e2i - i2r, r + i2r
+        out.append([s, e, i, r])
+    return np.array(out)
+
+
+def test_serial_seir_matches_linear_buffers_across_wraps():
+    ei = np.array([0., .3, .4, .3])
+    ir = 0.2 * 0.8 ** np.arange(20)
+    ir /= ir.sum()
+    seir = agents.SerialSEIR(ei, ir, N=1e5, e0=10, i0=100, R0=2.)
+    n_steps = 5 * seir.buffer_size
+    seir.reset()
+    states = np.array([seir.step()[0] for _ in range(n_steps)])
+    expected = linear_serial_seir(ei, ir, 1e5, 10, 100, 2., n_steps)
+    np.testing.assert_array_equal(states, expected)
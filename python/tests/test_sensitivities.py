@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from clds import reducers, sweep
+
+STEPS_HIGH = np.array([3, 5, 7])
+STEPS_LOW = np.array([4, 2, 7])
+PARAMS = {'lockdown_effectiveness': 0.175, 'contagion': 1., 'epsilon': 0.171}
+
+
+def run(integrator, sensitivities=None, lockdown_effectiveness=0.175, contagion=1., epsilon=0.171):
+    env = sweep.fpsp_env(STEPS_HIGH, STEPS_LOW, batch_size=3, integrator=integrator,
+                         step_size=0.25 if integrator == 'rk4' else 0.1,
+                         lockdown_effectiveness=lockdown_effectiveness, epsilon=epsilon,
+                         alpha=sweep.ALPHA*contagion, beta=sweep.BETA*contagion,
+                         gamma=sweep.GAMMA*contagion, delta=sweep.DELTA*contagion,
+                         sensitivities=sensitivities)
+    model = env.agents[0].agent
+    peak = reducers.PeakSensitivity(model, start=50) if sensitivities else reducers.Max(('model', slice(1, 6)), start=50)
+
+    def stop_member_1(i):
+        # integrates members 0 and 2 only from day 120 on
+        if i == 120:
+            env.set_active(np.array([0, 2]))
+    out = env.run(160, record=['model'], reducers={'peak': peak}, callback=stop_member_1)
+    return out, model
+
+
+@pytest.mark.parametrize('integrator', ['euler', 'rk4'])
+def test_sensitivities_match_finite_differences(integrator):
+    out, model = run(integrator, sensitivities=list(PARAMS))
+    # member 1 is frozen, as without sensitivities
+    np.testing.assert_array_equal(out['model'], run(integrator)[0]['model'])
+    np.testing.assert_array_equal(out['model'][121:, 1], out['model'][121:122, 1].repeat(40, 0))
+    for i, (p, value) in enumerate(PARAMS.items()):
+        h = 1e-5 * value
+        plus, minus = run(integrator, **{p: value + h})[0], run(integrator, **{p: value - h})[0]
+        fd = (plus['model'][-1] - minus['model'][-1]) / (2*h)
+        np.testing.assert_allclose(model.sensitivity[..., i], fd, rtol=1e-5, atol=1e-6 * np.abs(fd).max())
+        fd_peak = (plus['peak']['max'] - minus['peak']['max']) / (2*h)
+        np.testing.assert_allclose(out['peak']['grad_max'][:, i], fd_peak, rtol=1e-5)
@@ -0,0 +1,79 @@
+import numpy as np
+
+from clds import sweep
+
+STEPS_HIGH = np.array([0, 1, 3, 5])
+STEPS_LOW = np.array([4, 6, 2, 5])
+
+
+def single_runs(n_steps=200, **kwargs):
+    """ fpsp_sweep of each member on its own, with member m of array kwargs. """
+    out = [sweep.fpsp_sweep(STEPS_HIGH[m:m+1], STEPS_LOW[m:m+1], n_steps=n_steps, share_prefix=False,
+                            **{k: v[m] if np.ndim(v) > 0 else v for k, v in kwargs.items()})
+           for m in range(STEPS_HIGH.shape[0])]
+    return {k: np.concatenate([o[k] for o in out]) for k in out[0]}
+
+
+def assert_equal(a, b):
+    for k in ('peak', 'peak_time'):
+        np.testing.assert_array_equal(a[k], b[k])
+
+
+def test_shared_prefix_matches_full_runs():
+    assert_equal(sweep.fpsp_sweep(STEPS_HIGH, STEPS_LOW, n_steps=200, max_batch=3),
+                 sweep.fpsp_sweep(STEPS_HIGH, STEPS_LOW, n_steps=200, max_batch=3, share_prefix=False))
+
+
+def test_shared_prefix_falls_back_for_per_member_kwargs():
+    q = np.array([.1, .2, .3, .15])
+    assert_equal(sweep.fpsp_sweep(STEPS_HIGH, STEPS_LOW, n_steps=200, lockdown_effectiveness=q),
+                 single_runs(lockdown_effectiveness=q))
+
+
+PER_MEMBER = dict(switching_start=np.array([40, 50, 60, 45]),
+                  suppression_start=np.array([15, 20, 25, 10]),
+                  lockdown_effectiveness=np.array([.1, .2, .3, .15]))
+
+
+def test_per_member_kwargs_unchunked():
+    assert_equal(sweep.fpsp_sweep(STEPS_HIGH, STEPS_LOW, n_steps=200, **PER_MEMBER),
+                 single_runs(**PER_MEMBER))
+
+
+def test_per_member_kwargs_chunked():
+    expected = single_runs(**PER_MEMBER)
+    for max_batch in (1, 3):
+        for share_prefix in (True, False):
+            assert_equal(sweep.fpsp_sweep(STEPS_HIGH, STEPS_LOW, n_steps=200, max_batch=max_batch,
+                                          share_prefix=share_prefix, **PER_MEMBER), expected)
+
+
+def test_per_member_outer_loop_chunked():
+    outer_loop = dict(period=np.array([7, 5, 3, 7]), alpha_x=np.array([.4, .2, .1, .3]))
+    expected = [sweep.fpsp_sweep(STEPS_HIGH[m:m+1], STEPS_LOW[m:m+1], n_steps=200,
+                                 outer_loop={k: v[m] for k, v in outer_loop.items()}, **{
+                                     k: v[m] for k, v in PER_MEMBER.items()})
+                for m in range(STEPS_HIGH.shape[0])]
+    out = sweep.fpsp_sweep(STEPS_HIGH, STEPS_LOW, n_steps=200, max_batch=3, outer_loop=outer_loop, **PER_MEMBER)
+    for k in ('peak', 'peak_time'):
+        np.testing.assert_array_equal(out[k], np.concatenate([e[k] for e in expected]))
+
+
+def test_kernel_per_member_kwargs(monkeypatch):
+    from clds import fused
+    # without numba the kernel runs as plain python
+    monkeypatch.setattr(fused, 'available', lambda: True)
+    kwargs = dict(PER_MEMBER, n_steps=120, max_batch=3, outer_loop=dict(period=np.array([7, 5, 3, 7])))
+    assert_equal(sweep.fpsp_sweep(STEPS_HIGH, STEPS_LOW, backend='numba', **kwargs),
+                 sweep.fpsp_sweep(STEPS_HIGH, STEPS_LOW, backend='numpy', **kwargs))
+
+
+def test_shared_prefix_with_initial_state(monkeypatch):
+    from clds.core import Composite
+    forks = []
+    fork = Composite.fork
+    monkeypatch.setattr(Composite, 'fork', lambda self, *args, **kwargs: forks.append(1) or fork(self, *args, **kwargs))
+    s0 = sweep.agents.sidarthe.initial_state(1e7)
+    out = sweep.fpsp_sweep(STEPS_HIGH, STEPS_LOW, n_steps=200, max_batch=3, s0=s0)
+    assert len(forks) == 2
+    assert_equal(out, sweep.fpsp_sweep(STEPS_HIGH, STEPS_LOW, n_steps=200, max_batch=3, s0=s0, share_prefix=False))